@@ -0,0 +1,80 @@
+"""Compare per-call latency of the pooled pycw_client against one connection per call.
+
+Starts a catwalk server on the given port through pycw_client (CW_BINARY_FILEPATH must be set).
+"""
+
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import argh
+import requests
+
+sys.path.append(".")
+from pyclient.pycw_client import CatWalk  # noqa: E402
+
+
+def time_calls(fn, N):
+    times = list()
+    for _ in range(N):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return times
+
+
+def report(label, times):
+    times = sorted(times)
+    print(
+        f"{label:40} mean {statistics.mean(times) * 1e6:8.0f} us  "
+        f"p50 {times[len(times) // 2] * 1e6:8.0f} us  "
+        f"p99 {times[int(len(times) * 0.99)] * 1e6:8.0f} us"
+    )
+
+
+def go(
+    N=2000,
+    threads=8,
+    reference_filepath="reference/nc_045512.fasta",
+    mask_filepath="reference/covid-exclude.txt",
+    bind_port=5998,
+):
+    """Main function."""
+    cw = CatWalk(
+        cw_binary_filepath=None,
+        reference_name="bench",
+        reference_filepath=reference_filepath,
+        mask_filepath=mask_filepath,
+        max_n_positions=130000,
+        bind_host="localhost",
+        bind_port=bind_port,
+        unittesting=True,
+        pool_maxsize=threads,
+    )
+    for i in range(100):
+        cw.add_sample_from_refcomp(
+            f"s{i}", {"A": [100 + i], "C": [], "G": [], "T": [], "N": []}
+        )
+    url = cw.cw_url
+
+    report(
+        "requests.get /neighbours (new connection)",
+        time_calls(lambda: requests.get(f"{url}/neighbours/s0/5").json(), N),
+    )
+    report("CatWalk.neighbours (pooled)", time_calls(lambda: cw.neighbours("s0", 5), N))
+
+    with ThreadPoolExecutor(threads) as pool:
+        t0 = time.perf_counter()
+        list(pool.map(lambda _: requests.get(f"{url}/neighbours/s0/5").json(), range(N)))
+        unpooled = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        list(pool.map(lambda _: cw.neighbours("s0", 5), range(N)))
+        pooled = time.perf_counter() - t0
+    print(f"{threads} threads, {N} calls: new connection {unpooled:.2f} s, pooled {pooled:.2f} s")
+
+    cw.stop()
+
+
+if __name__ == "__main__":
+    argh.dispatch_command(go)
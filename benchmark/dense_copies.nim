@@ -0,0 +1,55 @@
+## Times all pairwise distances of synthetic samples with and without dense
+## copies (--dense), for both diffset layouts, in full and with a cutoff,
+## and reports the memory the dense copies take.
+##
+## nim c -d:danger --path:../src dense_copies.nim
+## ./dense_copies --reference-length=29903 -n 300 --cutoff=20
+
+import times
+import random
+import strformat
+import intsets
+
+import cligen
+
+import catwalk
+
+proc main(reference_length: int = 29903,
+          n: int = 300,
+          cutoff: int = 20,
+          n_diffs: seq[int] = @[50, 100, 200, 400, 800],
+          n_ns: int = 200) =
+  var rng = initRand(3)
+  var refseq = newString(reference_length)
+  for i in 0..<reference_length:
+    refseq[i] = "ACGT"[rng.rand(3)]
+  for diffs in n_diffs:
+    var sequences: seq[string]
+    for i in 0..<n:
+      var s = refseq
+      for j in 0..<diffs:
+        s[rng.rand(s.len - 1)] = "ACGT"[rng.rand(3)]
+      for j in 0..<n_ns:
+        s[rng.rand(s.len - 1)] = 'N'
+      sequences.add(s)
+    for packed in [false, true]:
+      var results: seq[seq[int]]
+      for dense in [false, true]:
+        var
+          c = new_CatWalk("bench", "ref", refseq, (name: "none", positions: initIntSet()), 130000,
+                          packed_diffsets = packed, use_dense = dense, dense_cutoff = cutoff)
+          names: seq[string]
+        for i, s in sequences:
+          c.add_sample("s" & $i, s, true)
+          names.add("s" & $i)
+        var line = fmt"{diffs} differences, {(if packed: ""packed"" else: ""per-base"")}, dense {dense}:"
+        for max_distance in [-1, cutoff]:
+          let t0 = epochTime()
+          results.add(c.get_cross_distances(names, names, max_distance))
+          line.add(fmt" cutoff {max_distance} {epochTime() - t0:.2f}s")
+        line.add(fmt", dense copies {c.memory_breakdown().dense div 1024} KiB, diffsets {c.memory_breakdown().diffsets div 1024} KiB")
+        echo line
+      doAssert results[0] == results[2] and results[1] == results[3], "dense copies change distances"
+
+when isMainModule:
+  dispatch(main)
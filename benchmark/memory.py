@@ -0,0 +1,86 @@
+"""Record catwalk's /memory breakdown over time and plot it."""
+
+import json
+import time
+
+import argh
+import matplotlib.pyplot as plt
+import requests
+
+COMPONENTS = [
+    "diffsets",
+    "n_positions",
+    "signatures",
+    "dense",
+    "mutation_log",
+    "sample_table",
+    "name_tables",
+    "reference_and_mask",
+    "unaccounted",
+    "allocator_overhead",
+]
+
+
+def get_memory(url, n):
+    return requests.get(f"{url}/memory", params={"n": n}).json()
+
+
+def record(out_filename, url="http://localhost:5000", interval=60, count=0, n=100000):
+    """Append a memory breakdown to out_filename (one json object per line) every interval seconds.
+
+    count=0 records until interrupted. n is the number of additional samples to project for.
+    """
+    i = 0
+    while not count or i < count:
+        row = get_memory(url, n)
+        row["time"] = time.time()
+        with open(out_filename, "a") as out:
+            out.write(json.dumps(row) + "\n")
+        print(
+            f"{row['n_samples']} samples, {row['occupied_mem'] / 1e6:.1f} mb occupied, "
+            f"{row['per_sample']['mean']:.0f} bytes/sample, "
+            f"{row['projection']['total_mem'] / 1e6:.1f} mb projected for {n} more"
+        )
+        i += 1
+        if not count or i < count:
+            time.sleep(interval)
+
+
+def plot(filename):
+    """Plot memory per component against the number of samples."""
+    with open(filename) as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    rows.sort(key=lambda row: row["time"])
+    xs = [row["n_samples"] for row in rows]
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, sharex=True)
+    ax1.stackplot(
+        xs,
+        [[row["components"][k] / 1e6 for row in rows] for k in COMPONENTS],
+        labels=COMPONENTS,
+    )
+    ax1.plot(
+        xs,
+        [row["projection"]["total_mem"] / 1e6 for row in rows],
+        color="black",
+        linestyle="dashed",
+        label=f"projected (+{rows[-1]['projection']['additional_samples']} samples)",
+    )
+    ax1.set_ylabel("mb")
+    ax1.legend(fontsize="x-small")
+
+    for k in ["mean", "p50", "p95", "p99"]:
+        ax2.plot(xs, [row["per_sample"][k] for row in rows], label=k)
+    ax2.set_xlabel("Samples")
+    ax2.set_ylabel("Bytes per sample")
+    ax2.legend(fontsize="x-small")
+
+    fig.set_size_inches(6, 8)
+    save_file = f"{filename}-memory.pdf"
+    print(f"saving to {save_file}")
+    plt.savefig(save_file)
+    plt.close()
+
+
+if __name__ == "__main__":
+    argh.dispatch_commands([record, plot])
@@ -9,11 +9,11 @@ import scipy.stats
 import plotille
 
 
-def get_neighbours(sample_name, snp_distance):
-    """Get neighbours from running catwalk server."""
+def get_neighbour_histogram(sample_name, snp_distance):
+    """Get the number of neighbours at each distance up to snp_distance, in one scan."""
     return requests.get(
-        f"http://localhost:5000/neighbours/{sample_name}/{snp_distance}"
-    ).json()
+        f"http://localhost:5000/neighbour_histogram/{sample_name}/{snp_distance}"
+    ).json()["counts"]
 
 
 def get_neighbours_times():
@@ -36,7 +36,7 @@ def go(N=100, distance=20):
     random_samples = [random.choice(all_samples) for _ in range(N)]
     neighbours_count = list()
     for sample_name in random_samples:
-        neighbours_count.append(len(get_neighbours(sample_name, distance)))
+        neighbours_count.append(sum(get_neighbour_histogram(sample_name, distance)))
     print(scipy.stats.describe(neighbours_count))
     print(plotille.hist(neighbours_count, 10, 40))
     print(sorted_counter(neighbours_count))
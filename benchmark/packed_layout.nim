@@ -0,0 +1,56 @@
+## Compares the per-base and packed diffset layouts (see CompressedSequence
+## in catwalk.nim) on the same samples: load time, diffset memory, and the
+## time for all pairwise distances, in full and with a cutoff.
+##
+## nim c -d:danger --path:../src packed_layout.nim
+## ./packed_layout --reference-filepath=../reference/nc_045512.fasta \
+##   --mask-filepath=../reference/covid-exclude.txt --mfsl-filepath=cog_all.fasta -n 2000
+
+import times
+import strformat
+
+import cligen
+
+import catwalk
+import fasta
+
+proc load(packed: bool, refseq: string, mask: Mask, mfsl_filepath: string, n: int, max_n_positions: int): (CatWalk, seq[string]) =
+  var
+    c = new_CatWalk("bench", "ref", refseq, mask, max_n_positions, packed_diffsets = packed)
+    names: seq[string]
+  for header, sequence in parse_multifasta_singleline_file(mfsl_filepath):
+    if names.len == n:
+      break
+    c.add_sample(header, sequence, true)
+    names.add(header)
+  (c, names)
+
+proc main(reference_filepath: string,
+          mask_filepath: string,
+          mfsl_filepath: string,
+          n: int = 2000,
+          cutoff: int = 20,
+          max_n_positions: int = 130000) =
+  let
+    (_, refseq) = parse_fasta_file(reference_filepath)
+    mask = new_Mask(mask_filepath, readFile(mask_filepath))
+  var results: seq[seq[int]]
+  for packed in [false, true]:
+    let
+      layout = if packed: "packed" else: "per-base"
+      t0 = epochTime()
+      (c, names) = load(packed, refseq, mask, mfsl_filepath, n, max_n_positions)
+      load_time = epochTime() - t0
+      pairs = names.len * names.len
+    echo fmt"{layout}: loaded {names.len} samples in {load_time:.2f}s, diffsets {c.memory_breakdown().diffsets div 1024} KiB"
+    for max_distance in [-1, cutoff]:
+      let
+        t1 = epochTime()
+        distances = c.get_cross_distances(names, names, max_distance)
+        dt = epochTime() - t1
+      results.add(distances)
+      echo fmt"{layout}: {pairs} distances (cutoff {max_distance}) in {dt:.2f}s, {pairs.float / dt / 1e6:.2f}M per second"
+  doAssert results[0] == results[2] and results[1] == results[3], "layouts disagree"
+
+when isMainModule:
+  dispatch(main)
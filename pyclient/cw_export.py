@@ -0,0 +1,107 @@
+"""
+Loads a catwalk store exported with /export (CatWalk.export) into numpy
+
+The export is a directory of .npy files, which are memory-mapped, so opening an export of millions
+of samples is immediate and only the pages used are read.  Samples are rows, in the order they
+were added; the positions of each base are stored CSR style, as one array of positions and one of
+offsets into it.
+
+    ex = CatWalkExport("covid_export")
+    i = ex.index("sample1")
+    ex.positions("N", i)              # sorted N positions of sample1
+    ex.counts("A")                    # number of A differences of every sample
+    ex.rows("C"), ex.positions("C")   # (sample, position) of every C difference
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+BASES = "ACGTN"
+
+
+class CatWalkExport:
+    """a catwalk store written by /export"""
+
+    def __init__(self, path, mmap_mode="r"):
+        """
+        Parameters:
+        path: the export directory
+        mmap_mode: passed to np.load; None reads the arrays into memory
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["format"] != 1:
+            raise ValueError("unsupported export format {0}".format(self.meta["format"]))
+
+        def load(name):
+            return np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode)
+
+        self._names = load("names")
+        self._name_offsets = load("name_offsets")
+        self.status = load("status")
+        self.status_names = self.meta["statuses"]
+        self._positions = {base: load(base + "_positions") for base in BASES}
+        self._offsets = {base: load(base + "_offsets") for base in BASES}
+        self._index = None
+
+    def __len__(self):
+        return self.meta["n_samples"]
+
+    def name(self, i):
+        """the name of sample i"""
+        return bytes(self._names[self._name_offsets[i] : self._name_offsets[i + 1]]).decode("utf-8")
+
+    @property
+    def names(self):
+        """the names of all samples, in row order"""
+        data = bytes(self._names).decode("utf-8")
+        # offsets are in bytes, so only ascii names can be cut from the decoded string
+        if len(data) == len(self._names):
+            return [data[a:b] for a, b in zip(self._name_offsets[:-1], self._name_offsets[1:])]
+        return [self.name(i) for i in range(len(self))]
+
+    def index(self, name):
+        """the row of the sample called name; raises KeyError if there is none"""
+        if self._index is None:
+            self._index = {n: i for i, n in enumerate(self.names)}
+        return self._index[name]
+
+    def status_name(self, i):
+        """the status of sample i, e.g. 'Ok' or 'TooManyNs'"""
+        return self.status_names[self.status[i]]
+
+    def positions(self, base, i=None):
+        """the sorted positions at which sample i has base (one of ACGTN), or if i is None,
+        those of every sample concatenated in row order"""
+        if i is None:
+            return self._positions[base]
+        offsets = self._offsets[base]
+        return self._positions[base][offsets[i] : offsets[i + 1]]
+
+    def offsets(self, base):
+        """the offsets of each sample's positions in positions(base); len(self) + 1 of them"""
+        return self._offsets[base]
+
+    def counts(self, base):
+        """the number of positions with base, for every sample"""
+        return np.diff(self._offsets[base])
+
+    def rows(self, base):
+        """the row of every entry of positions(base), e.g. to build a sparse matrix"""
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.counts(base))
+
+    def refcomp(self, i):
+        """sample i as a dict with ACGTN keys and lists of positions as values, as
+        CatWalk.sample_refcomp returns"""
+        return {base: self.positions(base, i).tolist() for base in BASES}
@@ -0,0 +1,181 @@
+"""
+An asyncio catwalk client for python
+
+Talks to already running catwalk servers; use pycw_client.CatWalk to start and stop them.
+Requests go over a pooled aiohttp connection, and a semaphore limits how many are in flight.
+One semaphore (and session) can be shared between clients for several servers:
+
+    limit = asyncio.Semaphore(200)
+    async with AsyncCatWalk("http://host1:5000", semaphore=limit) as cw1, \\
+               AsyncCatWalk("http://host2:5000", semaphore=limit) as cw2:
+        results = await asyncio.gather(*[cw1.neighbours(name, 12) for name in names])
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+"""
+
+import asyncio
+import json
+import logging
+
+import aiohttp
+
+from pyclient.pycw_client import filter_refcomp, CatWalkServerInsertError
+
+
+class AsyncCatWalk:
+    """communicate with a running CatWalk server from asyncio code"""
+
+    def __init__(
+        self,
+        cw_url,
+        max_concurrency=100,
+        semaphore=None,
+        session=None,
+        pool_maxsize=100,
+        timeout=None,
+    ):
+        """
+        Parameters:
+        cw_url: the server's url, e.g. http://localhost:5000
+        max_concurrency: the maximum number of requests in flight; ignored if semaphore is given
+        semaphore: an asyncio.Semaphore, to share one limit between several clients.
+                   Create it inside the event loop it will be used from
+        session: an aiohttp.ClientSession, to share one connection pool between several clients.
+                 A session passed in is not closed by close()
+        pool_maxsize: the number of connections kept open to each server, if the client creates its own session
+        timeout: total seconds allowed per request; None waits indefinitely
+        """
+        self.cw_url = cw_url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self._semaphore = semaphore
+        self.pool_maxsize = pool_maxsize
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = session
+        self._owns_session = session is None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit_per_host=self.pool_maxsize),
+                timeout=self.timeout,
+            )
+        return self._session
+
+    def _get_semaphore(self):
+        # made on first use, inside the running loop: before python 3.10 a
+        # semaphore binds to the loop current when it is created
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def close(self):
+        """closes the connection pool, if this client created it"""
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, path, expect_json=True, **kwargs):
+        """returns (status code, parsed json or text) for a request"""
+        async with self._get_semaphore():
+            async with self._get_session().request(
+                method, "{0}{1}".format(self.cw_url, path), **kwargs
+            ) as r:
+                r.raise_for_status()
+                if expect_json:
+                    return r.status, await r.json(content_type=None)
+                return r.status, await r.text()
+
+    async def info(self):
+        """
+        Get status information from catwalk
+        """
+        _, info = await self._request("GET", "/info")
+        return info
+
+    async def add_sample_from_refcomp(self, name, refcomp):
+        """
+        Add a reference compressed (dict with ACGTN keys and list of positions as values) sample.
+        See pycw_client.CatWalk.add_sample_from_refcomp
+
+        Returns:
+        status code
+        201 = added successfully
+        200 = was already present
+        """
+        if refcomp is None:
+            logging.warning("Asked to reload catwalk with {0} but the refcomp was None".format(name))
+
+        payload = {"name": name, "refcomp": json.dumps(filter_refcomp(refcomp)), "keep": True}
+        status, text = await self._request(
+            "POST", "/add_sample_from_refcomp", expect_json=False, json=payload
+        )
+        if status not in [200, 201]:
+            raise CatWalkServerInsertError(
+                expression=None,
+                message="Failed to insert {0}; return code was {1}".format(name, text),
+            )
+        return status
+
+    async def remove_sample(self, name):
+        """deletes a sample called name"""
+        status, _ = await self._request(
+            "GET", "/remove_sample/{0}".format(name), expect_json=False
+        )
+        return status
+
+    async def neighbours(self, name, distance=None):
+        """get neighbours.  neighbours are recomputed on demand.
+
+        Parameters:
+        name:  the name of the sample to search for
+        distance: the maximum distance reported.  if distance is not supplied, 99 is used.
+        """
+        if not distance:
+            logging.warning("no distance supplied. Using 99")
+            distance = 99
+
+        distance = int(distance)
+        _, j = await self._request("GET", "/neighbours/{0}/{1}".format(name, distance))
+        return [(sample_name, int(distance_str)) for (sample_name, distance_str) in j]
+
+    async def neighbour_histogram(self, name, distance, names=False):
+        """get the number of samples at each distance 0..distance from name.
+        See pycw_client.CatWalk.neighbour_histogram"""
+        params = {"names": 1} if names else {}
+        _, j = await self._request(
+            "GET", "/neighbour_histogram/{0}/{1}".format(name, int(distance)), params=params
+        )
+        return j["names"] if names else j["counts"]
+
+    async def nearest(self, name, k):
+        """get the k samples nearest to name, as (name, distance) sorted by distance then name"""
+        _, j = await self._request("GET", "/nearest/{0}/{1}".format(name, int(k)))
+        return [(sample_name, int(distance_str)) for (sample_name, distance_str) in j]
+
+    async def sample_names(self):
+        """get a list of samples in catwalk"""
+        _, j = await self._request("GET", "/list_samples")
+        return j
+
+    async def sample_ok_names(self):
+        """get a list of samples in catwalk with 'Ok' status"""
+        _, j = await self._request("GET", "/list_ok_samples")
+        return j
+
+    async def pairwise_distances(self, sample_name_list):
+        """get the distance matrix for the given sample names."""
+        _, j = await self._request("POST", "/get_pairwise_distances", json=sample_name_list)
+        return j
@@ -20,12 +20,20 @@ by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and
 import shlex
 import time
 import json
+import numpy as np
 import requests
 import logging
 import os
 import psutil
+import subprocess
+import tempfile
+import threading
 import uuid
 import warnings
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 class CatWalkServerInsertError(Exception):
@@ -65,6 +73,31 @@ class CatWalkMultipleServersRunningError(Exception):
     def __init__(self, message):
         self.message = message
 
+class CatWalkIncompleteResultError(Exception):
+    """the server's deadline expired before a scan finished"""
+
+    def __init__(self, expression, message):
+        self.expression = expression
+        self.message = message
+
+def filter_refcomp(refcomp):
+    """examines the keys in a dictionary, refcomp, and only lets through keys with a list
+    This will remove Ms (linked to a dictionary) and invalid keys which are linked to an integer.
+    These keys are not required by catwalk
+    """
+    refcompressed = {}
+    for key in refcomp.keys():
+        if isinstance(refcomp[key], set):
+            refcompressed[key] = list(refcomp[key])
+        elif isinstance(refcomp[key], list):
+            refcompressed[key] = refcomp[key]
+        elif hasattr(refcomp[key], "tolist"):  # numpy arrays, as made by refcompress.py
+            refcompressed[key] = refcomp[key].tolist()
+        else:
+            pass  # drop everything else, such as invalid
+    return refcompressed
+
+
 class CatWalk:
     """start, stop, and communicate with a CatWalk server"""
 
@@ -79,6 +112,18 @@ class CatWalk:
         bind_port,
         identity_token=None,
         unittesting=False,
+        pool_maxsize=10,
+        connect_timeout=5,
+        read_timeout=None,
+        max_retries=3,
+        backoff_factor=0.1,
+        startup_timeout=300,
+        stop_timeout=30,
+        server_args=(),
+        neighbour_cache_size=0,
+        neighbour_cache_ttl=1.0,
+        deadline=None,
+        allow_partial=False,
     ):
         """
         Start the catwalk process in the background, if it not running.
@@ -93,6 +138,19 @@ class CatWalk:
 
         identity_token: a string identifying the process.  If not provided, a guid is generated
         unittesting: if True, will shut down and restart (empty) any catwalk on bind_port on creation
+        pool_maxsize: the number of keep-alive connections kept open to the server.  Set this to at least the number of threads sharing the client
+        connect_timeout, read_timeout: seconds passed to requests; None waits indefinitely
+        max_retries: number of retries on connection errors and 502/503/504 responses
+        backoff_factor: retries sleep backoff_factor * 2 ** (retry number - 1) seconds
+        startup_timeout: seconds to wait for a started server to load its instance directory and answer /info
+        stop_timeout: seconds stop() waits for the server to save queued samples and exit before killing it
+        server_args: more command line arguments for cw_server, e.g. ["--readers", "4"]
+        neighbour_cache_size: if > 0, keep up to this many neighbours() results in an LRU cache, tagged with the server's store generation.
+                              A cached result is returned without a request if the latest generation seen by this client, at most
+                              neighbour_cache_ttl seconds ago, is unchanged; otherwise it is revalidated with a conditional request,
+                              which the server answers without recomputing if nothing has been added or removed
+        deadline: seconds the server may spend on each scan (neighbours, nearest, pairwise distances); None uses the server's default
+        allow_partial: if True, return what a scan found before the deadline, with a warning; otherwise raise CatWalkIncompleteResultError
         """
 
         no_catwalk_exe_message = """
@@ -139,6 +197,37 @@ in either
         self.instance_name = "{0}-MAXN-{1}-{2}".format(
             self.instance_stem, self.max_n_positions, identity_token
         )
+        # the server on this port is identified by the pid in this file, kept in a fixed
+        # directory so that clients started from any directory find it
+        self.pidfile = os.path.join(tempfile.gettempdir(), "catwalk", "{0}.pid".format(self.instance_stem))
+        self.startup_timeout = startup_timeout
+        self.stop_timeout = stop_timeout
+        self.server_args = list(server_args)
+        self._process = None
+
+        self.pool_maxsize = pool_maxsize
+        # one connection pool, shared by the per-thread sessions returned by _session()
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+            total=max_retries,
+            read=0,  # don't repeat requests the server may already be working on
+            backoff_factor=backoff_factor,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),  # catwalk posts are idempotent
+            raise_on_status=False,
+        )
+        self._adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry
+        )
+        self._local = threading.local()
+        self.deadline = deadline
+        self.allow_partial = allow_partial
+
+        self.neighbour_cache_size = neighbour_cache_size
+        self.neighbour_cache_ttl = neighbour_cache_ttl
+        self._neighbour_cache = OrderedDict()       # (name, distance) -> (generation tag, neighbours)
+        self._generation = (None, 0)                # (latest generation tag seen, time.monotonic() when seen)
+        self._cache_lock = threading.Lock()
 
         # start up if not running
         if unittesting and self.server_is_running():
@@ -148,22 +237,62 @@ in either
             self.start()
 
         if not self.server_is_running():  # startup failed
-            raise CatWalkServerDidNotStartError()
+            raise CatWalkServerDidNotStartError(
+                expression=None, message="no cw_server running for {0}".format(self.instance_stem)
+            )
+
+    def _is_server(self, proc):
+        """true if proc is a live cw_server started for this port"""
+        try:
+            if proc.status() == psutil.STATUS_ZOMBIE:
+                return False
+            cmdline_parts = proc.cmdline()
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            return False
+        for i, cmdline_part in enumerate(cmdline_parts[:-1]):
+            if cmdline_part == "--instance_name":
+                if cmdline_parts[i + 1].startswith(self.instance_stem):
+                    return True
+        return False
+
+    def _server_process(self):
+        """returns the psutil.Process of the server for this port, if it is running.
+
+        The server this client started is used if it is still running, then the pidfile's
+        process; failing both (e.g. the pidfile was removed), a server answering on the port
+        reports its pid in /info.  Running processes are not scanned."""
+        candidates = []
+        if self._process is not None and self._process.poll() is None:
+            candidates.append(lambda: self._process.pid)
+
+        def from_pidfile():
+            with open(self.pidfile) as f:
+                return int(f.read().strip())
+
+        def from_info():
+            r = requests.get("{0}/info".format(self.cw_url), timeout=(1, 5))
+            return int(r.json()["server_pid"])
+
+        candidates += [from_pidfile, from_info]
+        for candidate in candidates:
+            try:
+                proc = psutil.Process(candidate())
+            except (OSError, ValueError, KeyError, requests.exceptions.RequestException, psutil.NoSuchProcess):
+                continue
+            # guard against the pid having been reused by another process
+            if self._is_server(proc):
+                return proc
+        return None
 
     def _running_servers(self):
         """ returns details of running servers matching the details of this server
 
         There should be either 0 or 1 of these only """
 
-        servers = []
-        for proc in psutil.process_iter():
-            if "cw_server" in proc.name():
-                cmdline_parts = proc.cmdline()
-                for i, cmdline_part in enumerate(proc.cmdline()):
-                    if cmdline_part == "--instance_name":
-                        if cmdline_parts[i + 1].startswith(self.instance_stem):
-                            servers.append(cmdline_parts)
-        return servers
+        proc = self._server_process()
+        if proc is None:
+            return []
+        return [proc.cmdline()]
 
     def server_is_running(self):
         """returns true if the relevant process is running, otherwise false.
@@ -181,34 +310,86 @@ in either
             raise CatWalkMultipleServersRunningError(message = "{0} servers with specification {1} detected".format(len(servers), self.instance_stem))      # there cannot be multiple servers running
 
     def start(self):
-        """starts a catwalk process in the background"""
-        cw_binary_filepath = shlex.quote(self.cw_binary_filepath)
-        instance_name = shlex.quote(self.instance_name)
-        reference_filepath = shlex.quote(self.reference_filepath)
-        mask_filepath = shlex.quote(self.mask_filepath)
-
+        """starts a catwalk process in the background, and waits until it answers requests"""
         if not self.server_is_running():
-            cmd = f"nohup {cw_binary_filepath} --instance_name {instance_name}  --bind_host {self.bind_host} --bind_port {self.bind_port} --reference_filepath {reference_filepath}  --mask_filepath {mask_filepath} --max_n_positions {self.max_n_positions} > cw_server_nohup.out &"
-            logging.info("Attempting startup of CatWalk server : {0}".format(cmd))
-
-            os.system(cmd)      # synchronous: will return when it has started
-
-            time.sleep(1)       # short break to ensure it has started
-        info = self.info()
-        if info is None:
-            raise CatWalkServerDidNotStartError()
-        else:
-            logging.info("Catwalk server running: {0}".format(info))
+            cmd = [
+                self.cw_binary_filepath,
+                "--instance_name", self.instance_name,
+                "--bind_host", self.bind_host,
+                "--bind_port", str(self.bind_port),
+                "--reference_filepath", self.reference_filepath,
+                "--mask_filepath", self.mask_filepath,
+                "--max_n_positions", str(self.max_n_positions),
+            ] + self.server_args
+            logging.info("Attempting startup of CatWalk server : {0}".format(" ".join(map(shlex.quote, cmd))))
+
+            with open("cw_server_nohup.out", "ab") as out:
+                self._process = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=out,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=True,     # keep running if this process exits, like nohup
+                )
+            os.makedirs(os.path.dirname(self.pidfile), exist_ok=True)
+            with open(self.pidfile, "w") as f:
+                f.write(str(self._process.pid))
+
+        info = self._wait_until_ready()
+        logging.info("Catwalk server running: {0}".format(info))
+
+    def _wait_until_ready(self):
+        """polls /info with exponential backoff until it answers.
+
+        cw_server only starts listening once it has loaded its instance directory."""
+        deadline = time.monotonic() + self.startup_timeout
+        delay = 0.005
+        while True:
+            if self._process is not None and self._process.poll() is not None:
+                raise CatWalkServerDidNotStartError(
+                    expression=None,
+                    message="cw_server exited with code {0}; see cw_server_nohup.out".format(self._process.returncode),
+                )
+            try:
+                r = requests.get("{0}/info".format(self.cw_url), timeout=(1, self.startup_timeout))
+                if r.status_code == 200:
+                    return r.json()
+            except requests.exceptions.ConnectionError:
+                pass  # not listening yet
+            if time.monotonic() + delay > deadline:
+                raise CatWalkServerDidNotStartError(
+                    expression=None,
+                    message="cw_server did not answer within {0} seconds".format(self.startup_timeout),
+                )
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
 
     def stop(self):
-        """stops the catwalk server launched by this process, if running.  The process is identified by a uuid, so only one catwalk server will be shut down."""
-        for proc in psutil.process_iter():
-            if "cw_server" in proc.name():
-                cmdline_parts = proc.cmdline()
-                for i, cmdline_part in enumerate(proc.cmdline()):
-                    if cmdline_part == "--instance_name":
-                        if cmdline_parts[i + 1].startswith(self.instance_stem):
-                            proc.kill()
+        """stops the catwalk server for this port, if running.
+
+        The server is sent SIGTERM, on which it saves the samples it has queued and exits;
+        if it hasn't exited after stop_timeout seconds it is killed."""
+        proc = self._server_process()
+        if proc is not None:
+            proc.terminate()
+            if self._process is not None and self._process.pid == proc.pid:
+                try:
+                    self._process.wait(timeout=self.stop_timeout)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+                    self._process.wait()        # reap our own child
+            else:
+                try:
+                    proc.wait(timeout=self.stop_timeout)
+                except psutil.TimeoutExpired:
+                    proc.kill()
+                    try:
+                        proc.wait(timeout=10)
+                    except psutil.TimeoutExpired:
+                        pass
+        self._process = None
+        if os.path.exists(self.pidfile):
+            os.remove(self.pidfile)
         if self.server_is_running():
             warnings.warn(
                 "Attempt to shutdown a catwalk process with name cw_server and --instance_name beginning with {0} failed.  It may be that another process (with a different instance name) is running on port {1}.  Review running processes (ps x) and kill residual processes on this port  manually if appropriate".format(
@@ -230,31 +411,56 @@ in either
                 )
             )
 
+    def _session(self):
+        """returns the calling thread's requests session.  Sessions are not
+        thread safe, but the connection pool they share is"""
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", self._adapter)
+            session.mount("https://", self._adapter)
+            if self.deadline is not None:
+                session.headers["X-Catwalk-Deadline"] = str(self.deadline)
+            self._local.session = session
+        return session
+
+    def _get(self, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self._note_generation(self._session().get("{0}{1}".format(self.cw_url, path), **kwargs))
+
+    def _post(self, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self._note_generation(self._session().post("{0}{1}".format(self.cw_url, path), **kwargs))
+
+    def _note_generation(self, r):
+        """records the store generation tag sent with a response, and checks the response is complete"""
+        tag = r.headers.get("ETag")
+        if tag is not None:
+            with self._cache_lock:
+                self._generation = (tag, time.monotonic())
+        if r.headers.get("X-Catwalk-Complete") == "false":
+            message = "{0} stopped at the deadline; the result is incomplete".format(r.request.path_url)
+            if not self.allow_partial:
+                raise CatWalkIncompleteResultError(expression=None, message=message)
+            logging.warning(message)
+        return r
+
+    def close(self):
+        """closes pooled connections to the server"""
+        self._adapter.close()
+
     def info(self):
         """
         Get status information from catwalk
         """
-        target_url = "{0}/info".format(self.cw_url)
-
-        r = requests.get(target_url)
+        r = self._get("/info")
         r.raise_for_status()        # report errors
 
         return r.json()
 
     def _filter_refcomp(self, refcomp):
-        """examines the keys in a dictionary, refcomp, and only lets through keys with a list
-        This will remove Ms (linked to a dictionary) and invalid keys which are linked to an integer.
-        These keys are not required by catwalk
-        """
-        refcompressed = {}
-        for key in refcomp.keys():
-            if isinstance(refcomp[key], set):
-                refcompressed[key] = list(refcomp[key])
-            elif isinstance(refcomp[key], list):
-                refcompressed[key] = refcomp[key]
-            else:
-                pass  # drop everything else, such as invalid
-        return refcompressed
+        """see filter_refcomp"""
+        return filter_refcomp(refcomp)
 
     def add_sample_from_refcomp(self, name, refcomp):
         """
@@ -277,9 +483,7 @@ in either
         refcompressed = self._filter_refcomp(refcomp)
         payload = {"name": name, "refcomp": json.dumps(refcompressed), "keep": True}
 
-        r = requests.post(
-            "{0}/add_sample_from_refcomp".format(self.cw_url), json=payload
-        )
+        r = self._post("/add_sample_from_refcomp", json=payload)
         r.raise_for_status()
         if r.status_code not in [200, 201]:
             raise CatWalkServerInsertError(
@@ -290,7 +494,7 @@ in either
     def remove_sample(self, name):
         """deletes a sample called name"""
 
-        r = requests.get("{0}/remove_sample/{1}".format(self.cw_url, name))
+        r = self._get("/remove_sample/{0}".format(name))
         r.raise_for_status()
         if r.status_code not in [200]:
             raise CatWalkServerDeleteError(
@@ -311,27 +515,192 @@ in either
 
         distance = int(distance)        # if a float, url contstruction may fail
 
-        r = requests.get("{0}/neighbours/{1}/{2}".format(self.cw_url, name, distance))
+        if self.neighbour_cache_size <= 0:
+            return self._neighbours(name, distance)[1]
+
+        key = (name, distance)
+        with self._cache_lock:
+            cached = self._neighbour_cache.get(key)
+            if cached is not None:
+                self._neighbour_cache.move_to_end(key)
+                tag, seen = self._generation
+                if cached[0] == tag and time.monotonic() - seen <= self.neighbour_cache_ttl:
+                    return list(cached[1])
+
+        tag, result = self._neighbours(name, distance, cached[0] if cached else None)
+        if result is None:
+            result = cached[1]      # not modified
+        if tag is None:
+            return list(result)     # partial results are not tagged, so not cached
+        with self._cache_lock:
+            self._neighbour_cache[key] = (tag, result)
+            self._neighbour_cache.move_to_end(key)
+            while len(self._neighbour_cache) > self.neighbour_cache_size:
+                self._neighbour_cache.popitem(last=False)
+        return list(result)
+
+    def neighbour_histogram(self, name, distance, names=False):
+        """get the number of samples at each distance 0..distance from name, from one scan.
+
+        Returns a list of counts indexed by distance, or if names is True, a list of lists of
+        the sample names at each distance."""
+        params = {"names": 1} if names else {}
+        r = self._get("/neighbour_histogram/{0}/{1}".format(name, int(distance)), params=params)
+        r.raise_for_status()
+        j = r.json()
+        return j["names"] if names else j["counts"]
+
+    def build_index(self):
+        """builds the server's neighbour index now; returns the number of profiles indexed"""
+        r = self._post("/build_index")
+        r.raise_for_status()
+        return int(r.text)
+
+    def rereference(self):
+        """re-encodes the server's samples against a consensus of them, to save memory and time.
+        Results are unchanged.  Returns the number of positions at which the consensus differs
+        from the reference"""
+        r = self._post("/rereference")
+        r.raise_for_status()
+        return int(r.text)
+
+    def export(self, path=None):
+        """writes every sample to the directory path on the server as .npy files, which
+        pyclient.cw_export.CatWalkExport loads.  path is relative to the server's directory,
+        without '..', and replaces any earlier export there; the default is <instance name>_export.
+        Returns the server's reply, with path and n_samples"""
+        r = self._post("/export", json={} if path is None else {"path": path})
+        r.raise_for_status()
+        return r.json()
+
+    def nearest(self, name, k):
+        """get the k samples nearest to name, as (name, distance) sorted by distance then name.
+        Fewer are returned if fewer samples can be compared."""
+        r = self._get("/nearest/{0}/{1}".format(name, int(k)))
+        r.raise_for_status()
+        return [(sample_name, int(distance_str)) for (sample_name, distance_str) in r.json()]
+
+    def _neighbours(self, name, distance, if_none_match=None):
+        """returns (generation tag, neighbours); neighbours is None if the server's
+        generation still matches if_none_match"""
+        headers = {} if if_none_match is None else {"If-None-Match": if_none_match}
+        r = self._get("/neighbours/{0}/{1}".format(name, distance), headers=headers)
         r.raise_for_status()
+        if r.status_code == 304:
+            return r.headers.get("ETag"), None
         j = r.json()
-        return [(sample_name, int(distance_str)) for (sample_name, distance_str) in j]
+        return r.headers.get("ETag"), [(sample_name, int(distance_str)) for (sample_name, distance_str) in j]
+
+    def sample_refcomp(self, name):
+        """get the reference compressed sequence of a sample, as a dict with ACGTN keys
+        and lists of positions as values, and a 'status' key (e.g. 'Ok', 'TooManyNs')"""
+        r = self._get("/get_refcomp/{0}".format(name))
+        r.raise_for_status()
+        return r.json()
+
+    def neighbours_from_refcomp(self, name, refcomp, distance):
+        """get neighbours of a sample given as a refcomp, which need not be stored in this server.
+        A stored sample called name is not reported as its own neighbour."""
+        payload = {"name": name, "refcomp": json.dumps(filter_refcomp(refcomp)), "distance": int(distance)}
+        r = self._post("/neighbours_from_refcomp", json=payload)
+        r.raise_for_status()
+        return [(sample_name, int(distance_str)) for (sample_name, distance_str) in r.json()]
 
     def sample_names(self):
         """get a list of samples in catwalk"""
-        r = requests.get("{0}/list_samples".format(self.cw_url))
+        r = self._get("/list_samples")
         r.raise_for_status()
         return r.json()
 
     def sample_ok_names(self):
         """get a list of samples in catwalk with 'Ok' status"""
-        r = requests.get("{0}/list_ok_samples".format(self.cw_url))
+        r = self._get("/list_ok_samples")
         r.raise_for_status()
         return r.json()
 
     def pairwise_distances(self, sample_name_list):
         """get the distance matrix for the given sample names."""
-        r = requests.post(
-            "{0}/get_pairwise_distances".format(self.cw_url), json=sample_name_list
-        )
+        r = self._post("/get_pairwise_distances", json=sample_name_list)
         r.raise_for_status()
         return r.json()
+
+    def pairwise_distance_matrix(self, sample_name_list, as_dataframe=False):
+        """get the distance matrix for the given sample names as a square symmetric numpy int32 array.
+
+        Returns (sample names, matrix), where row and column i are sample_name_list[i],
+        or a pandas DataFrame indexed by sample name if as_dataframe is True.
+        The distances are transferred as binary, without the names."""
+        names = list(sample_name_list)
+        r = self._post("/get_pairwise_distances_condensed", json=names)
+        r.raise_for_status()
+        condensed = np.frombuffer(r.content, dtype="<i4")
+        n = len(names)
+        if len(condensed) != n * (n - 1) // 2:
+            raise ValueError(
+                "expected {0} distances for {1} samples, got {2}".format(n * (n - 1) // 2, n, len(condensed))
+            )
+        matrix = np.zeros((n, n), dtype=np.int32)
+        i, j = np.triu_indices(n, k=1)
+        matrix[i, j] = condensed
+        matrix[j, i] = condensed
+        if as_dataframe:
+            import pandas
+
+            return pandas.DataFrame(matrix, index=names, columns=names)
+        return names, matrix
+
+    def cross_distances(self, names_a, names_b, cutoff=None, sparse=False):
+        """get the distances between two lists of samples.
+
+        Returns a numpy int32 array with one row per sample in names_a and one column per sample
+        in names_b.  With a cutoff, distances above it are reported as cutoff + 1, which is faster
+        to compute.  With sparse=True (which requires a cutoff), returns an (n, 3) int32 array of
+        (index in names_a, index in names_b, distance) rows for the pairs within the cutoff."""
+        names_a, names_b = list(names_a), list(names_b)
+        payload = {"a": names_a, "b": names_b}
+        if cutoff is not None:
+            payload["cutoff"] = int(cutoff)
+        if sparse:
+            if cutoff is None:
+                raise ValueError("sparse output requires a cutoff")
+            payload["sparse"] = True
+        r = self._post("/get_cross_distances", json=payload)
+        r.raise_for_status()
+        block = np.frombuffer(r.content, dtype="<i4")
+        if sparse:
+            return block.reshape(-1, 3)
+        if len(block) != len(names_a) * len(names_b):
+            raise ValueError(
+                "expected {0} distances, got {1}".format(len(names_a) * len(names_b), len(block))
+            )
+        return block.reshape(len(names_a), len(names_b))
+
+    def pairwise_distance_matrix_tiled(
+        self, sample_name_list, tile_size=1000, max_workers=None, as_dataframe=False
+    ):
+        """as pairwise_distance_matrix, but split into tile_size x tile_size blocks which are
+        requested concurrently (max_workers threads, by default pool_maxsize) and written into
+        a preallocated matrix.  Only blocks on or above the diagonal are requested.
+
+        Each request and response holds at most tile_size ** 2 distances, so memory on both sides
+        is bounded by the tile size rather than by the number of samples."""
+        names = list(sample_name_list)
+        n = len(names)
+        matrix = np.zeros((n, n), dtype=np.int32)
+        starts = range(0, n, tile_size)
+        tiles = [(i, j) for i in starts for j in starts if j >= i]
+
+        def fetch(tile):
+            i, j = tile
+            block = self.cross_distances(names[i : i + tile_size], names[j : j + tile_size])
+            matrix[i : i + tile_size, j : j + tile_size] = block
+            matrix[j : j + tile_size, i : i + tile_size] = block.T
+
+        with ThreadPoolExecutor(max_workers or self.pool_maxsize) as pool:
+            for _ in pool.map(fetch, tiles):
+                pass
+        if as_dataframe:
+            import pandas
+
+            return pandas.DataFrame(matrix, index=names, columns=names)
+        return names, matrix
@@ -0,0 +1,104 @@
+"""
+A catwalk client for a store split across several cw_server processes
+
+Each sample lives on one shard, chosen by a stable hash of its name.  Inserts and removals go to
+the owning shard; neighbour queries fetch the sample's refcomp from its owner and ask every shard
+in parallel, and the results are merged here.
+
+    shards = [CatWalk(..., bind_port=port) for port in (5000, 5001, 5002)]
+    cw = ShardedCatWalk(shards)
+    cw.add_sample_from_refcomp("sample1", refcomp)
+    cw.neighbours("sample1", 12)
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+"""
+
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+def shard_index(name, n_shards):
+    """the shard a sample name belongs to.  Stable across processes and python versions,
+    so must not change while shards hold data"""
+    digest = hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % n_shards
+
+
+class ShardedCatWalk:
+    """distribute samples over several catwalk servers"""
+
+    def __init__(self, shards, max_workers=None):
+        """
+        Parameters:
+        shards: a list of pycw_client.CatWalk clients, one per server.  Their order defines
+                sample placement, so must stay the same for the lifetime of the data
+        max_workers: threads used to query shards in parallel; defaults to the number of shards
+        """
+        if len(shards) == 0:
+            raise ValueError("at least one shard is required")
+        self.shards = list(shards)
+        self._pool = ThreadPoolExecutor(max_workers or len(self.shards))
+
+    def close(self):
+        self._pool.shutdown()
+
+    def owner(self, name):
+        """returns the shard (CatWalk client) that stores sample name"""
+        return self.shards[shard_index(name, len(self.shards))]
+
+    def _map(self, fn):
+        """calls fn(shard) on all shards in parallel; returns the results in shard order"""
+        return list(self._pool.map(fn, self.shards))
+
+    def info(self):
+        """get status information from every shard"""
+        return self._map(lambda shard: shard.info())
+
+    def add_sample_from_refcomp(self, name, refcomp):
+        """add a reference compressed sample to its owning shard.  See CatWalk.add_sample_from_refcomp"""
+        return self.owner(name).add_sample_from_refcomp(name, refcomp)
+
+    def remove_sample(self, name):
+        """deletes a sample called name from its owning shard"""
+        return self.owner(name).remove_sample(name)
+
+    def neighbours(self, name, distance=None):
+        """get neighbours from all shards, sorted by distance then name.
+
+        Parameters:
+        name:  the name of the sample to search for
+        distance: the maximum distance reported.  if distance is not supplied, 99 is used.
+        """
+        if not distance:
+            logging.warning("no distance supplied. Using 99")
+            distance = 99
+        distance = int(distance)
+
+        owner = self.owner(name)
+        refcomp = owner.sample_refcomp(name)  # raises HTTPError (404) if there is no such sample
+        if refcomp.get("status") != "Ok":
+            return []  # as for a single server, samples that are not Ok have no neighbours
+
+        def query(shard):
+            if shard is owner:
+                return shard.neighbours(name, distance)
+            return shard.neighbours_from_refcomp(name, refcomp, distance)
+
+        merged = [n for shard_neighbours in self._map(query) for n in shard_neighbours]
+        return sorted(merged, key=lambda n: (n[1], n[0]))
+
+    def sample_names(self):
+        """get a list of samples in all shards"""
+        return [n for names in self._map(lambda shard: shard.sample_names()) for n in names]
+
+    def sample_ok_names(self):
+        """get a list of samples in all shards with 'Ok' status"""
+        return [n for names in self._map(lambda shard: shard.sample_ok_names()) for n in names]
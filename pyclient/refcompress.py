@@ -0,0 +1,134 @@
+"""
+Reference compression of sequences with numpy
+
+Produces the same A/C/G/T/N position lists as reference_compress in catwalk.nim, so that clients
+can send small refcomps to catwalk (CatWalk.add_sample_from_refcomp) instead of whole sequences.
+
+    rc = ReferenceCompressor("reference/nc_045512.fasta", "reference/covid-exclude.txt")
+    for name, refcomp in rc.compress_multifasta("samples.fasta", processes=8):
+        cw.add_sample_from_refcomp(name, refcomp)
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+"""
+
+import multiprocessing
+
+import numpy as np
+
+BASES = "ACGT"
+
+# byte -> uppercase for acgt only, as uppercase_acgt in catwalk.nim
+_UPPER = np.arange(256, dtype=np.uint8)
+for _b in BASES:
+    _UPPER[ord(_b.lower())] = ord(_b)
+
+# byte -> 0..3 for A, C, G, T (either case), 4 for anything else (stored as N)
+_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _b in enumerate(BASES):
+    _CODE[ord(_b)] = _i
+    _CODE[ord(_b.lower())] = _i
+
+
+def read_fasta(filepath):
+    """yields (header, sequence) from a fasta file; sequences may span several lines"""
+    header, lines = None, []
+    with open(filepath) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith(">"):
+                if header is not None:
+                    yield header, "".join(lines)
+                header, lines = line[1:], []
+            elif line:
+                lines.append(line)
+    if header is not None:
+        yield header, "".join(lines)
+
+
+def _as_bytes(sequence):
+    if isinstance(sequence, str):
+        sequence = sequence.encode("ascii")
+    return np.frombuffer(sequence, dtype=np.uint8)
+
+
+def read_mask(mask_filepath):
+    """returns the positions in a mask file.  As new_Mask in catwalk.nim, lines that are not
+    integers (blank lines, headers, comments) are skipped"""
+    positions = []
+    with open(mask_filepath) as f:
+        for line in f:
+            try:
+                positions.append(int(line.rstrip("\r\n")))
+            except ValueError:
+                continue
+    return positions
+
+
+class ReferenceCompressor:
+    """reference compresses sequences against one reference and mask"""
+
+    def __init__(self, reference_filepath, mask_filepath=None):
+        """
+        Parameters:
+        reference_filepath: fasta file containing the reference sequence
+        mask_filepath: file of zero-indexed positions to ignore, one per line, as given to cw_server
+        """
+        _, reference = next(read_fasta(reference_filepath))
+        self.reference = _UPPER[_as_bytes(reference)]
+        self.unmasked = np.ones(len(self.reference), dtype=bool)
+        if mask_filepath is not None:
+            positions = [p for p in read_mask(mask_filepath) if 0 <= p < len(self.reference)]
+            self.unmasked[np.array(positions, dtype=np.int64)] = False
+
+    def compress(self, sequence):
+        """returns a dict with A, C, G, T, N keys and sorted numpy arrays of the positions
+        at which sequence differs from the reference.  Masked positions are never reported."""
+        seq = _as_bytes(sequence)
+        if len(seq) != len(self.reference):
+            raise ValueError(
+                "sequence length {0} differs from reference length {1}".format(
+                    len(seq), len(self.reference)
+                )
+            )
+        positions = np.flatnonzero((_UPPER[seq] != self.reference) & self.unmasked)
+        codes = _CODE[seq[positions]]
+        refcomp = {base: positions[codes == i] for i, base in enumerate(BASES)}
+        refcomp["N"] = positions[codes == 4]
+        return refcomp
+
+    def compress_multifasta(self, filepath, processes=None, chunksize=16):
+        """yields (name, refcomp) for every sequence in a fasta file, in file order.
+
+        processes: number of worker processes; 1 compresses in this process, None uses all cpus.
+        Names are the headers with '/' replaced by '_', as cw_server's add_samples_from_mfsl does."""
+        records = (
+            (header.replace("/", "_"), sequence) for header, sequence in read_fasta(filepath)
+        )
+        if processes == 1:
+            for name, sequence in records:
+                yield name, self.compress(sequence)
+            return
+        with multiprocessing.Pool(
+            processes, initializer=_init_worker, initargs=(self,)
+        ) as pool:
+            yield from pool.imap(_compress_record, records, chunksize)
+
+
+_worker_compressor = None
+
+
+def _init_worker(compressor):
+    global _worker_compressor
+    _worker_compressor = compressor
+
+
+def _compress_record(record):
+    name, sequence = record
+    return name, _worker_compressor.compress(sequence)
@@ -1,18 +1,32 @@
 import tables
+import hashes
 import intsets
 import strutils
 import strformat
 import times
 import jsony
 import algorithm
+import heapqueue
+import deques
 import system
+import math
+import std/monotimes
 
 import symdiff
+import forkpool
+import vptree
+import dense
 
 type
   Sequence = string
 
-  CompressedSequence* = array[4, seq[int]]
+  # the positions at which a sample differs from the reference: one sorted
+  # seq per base (A, C, G, T), or if packed, a single sorted seq of
+  # position shl 2 or base, which count_diff2 compares in one merge
+  CompressedSequence* = object
+    packed*: bool
+    by_base: array[4, seq[int]]
+    codes: seq[int]
 
   SampleStatus* = enum
     Unknown
@@ -26,20 +40,135 @@ type
     diffsets: CompressedSequence
     n_positions: IntSet
 
+  # per-block counts of a profile's differences from the reference, then of
+  # its N positions, saturating at high(uint16)
+  Signature = array[128, uint16]
+
+  # signatures of all profiles, stored contiguously by profile id
+  SignatureStore = ref object
+    data: seq[uint16]
+
+  # 2-bit packed copies of the profiles far from the reference, by profile
+  # id; empty for the rest
+  DenseStore = ref object
+    # the dense copy of the reference, which the others start from
+    reference: DenseSequence
+    data: seq[DenseSequence]
+
+  CrossDistance* = tuple
+    a: int
+    b: int
+    distance: int
+
   Mask* = tuple
     name: string
     positions: IntSet
 
+  QueryRecord* = tuple
+    sample_name: string
+    distance: int
+    latency: float
+    candidates: int
+    hits: int
+
+  # a time limit for a scan; nil means none
+  Deadline* = ref object
+    at: MonoTime
+    checks: int
+    expired: bool
+
+  # an insert or removal, with the sample against reference_sequence as it
+  # was added; sample is unused for removals
+  Mutation* = tuple
+    generation: int
+    name: string
+    removed: bool
+    sample: Sample
+
+  # fixed-size ring buffer of the most recent neighbour queries
+  QueryLog* = tuple
+    records: seq[QueryRecord]
+    capacity: int
+    next: int
+    total: int
+
+  LatencySummary* = tuple
+    distance: int
+    count: int
+    p50: float
+    p95: float
+    p99: float
+    max: float
+
+  # estimated heap bytes per store component (see memory_breakdown)
+  MemoryBreakdown* = tuple
+    diffsets: int
+    n_positions: int
+    signatures: int
+    dense: int
+    mutation_log: int
+    sample_table: int
+    name_tables: int
+    reference: int
+    per_sample_mean: float
+    per_sample_p50: float
+    per_sample_p95: float
+    per_sample_p99: float
+    per_sample_max: float
+
   CatWalk* = tuple
     name: string
     reference_name: string
     reference_sequence: string
+    # diffsets are stored against internal_reference, which differs from
+    # reference_sequence at rebased_positions (see rereference). Samples
+    # going in and out of the store are against reference_sequence.
+    internal_reference: string
+    rebased_positions: IntSet
     max_n_positions: int
     mask: Mask
-    active_samples: TableRef[int, Sample]
+    # store diffsets in the packed layout (see CompressedSequence)
+    packed_diffsets: bool
+    # samples with identical diffsets, N positions and status share one
+    # profile. profile_of maps the index of every sample not removed to its
+    # profile id, and profile_samples lists the samples using each profile.
+    profiles: TableRef[int, Sample]
+    profile_samples: TableRef[int, seq[int]]
+    profile_of: TableRef[int, int]
+    profile_ids: TableRef[Hash, seq[int]]
+    next_sample_index: int
+    next_profile_id: int
+    # ids of dropped profiles, reused before next_profile_id so that the
+    # stores indexed by profile id don't grow with every removal
+    free_profile_ids: seq[int]
+    signatures: SignatureStore
+    # reference positions per signature block
+    signature_block: int
+    # keep dense copies of distant profiles (see dense.nim), and compare
+    # them whenever that is cheaper than merging their diff lists
+    use_dense: bool
+    # the distance cutoff dense copies are sized for (see store_dense)
+    dense_cutoff: int
+    dense: DenseStore
     all_sample_indexes: TableRef[string, int]
     all_sample_names: TableRef[int, string]
-    neighbours_times: Table[string, float]
+    # optional metric tree over the Ok profiles, used by neighbour queries
+    # once built. Profiles added since are scanned linearly. See vptree.nim.
+    use_index: bool
+    index_approximate: bool
+    index: VPTree
+    index_building: VPTree
+    # the Ok profiles not in the index, which neighbour queries scan
+    unindexed: IntSet
+    # removed profiles still in an index, which searches compare against
+    # until it is rebuilt without them
+    tombstones: TableRef[int, Sample]
+    query_log: QueryLog
+    # bumped on every insert and removal
+    generation: int
+    # the most recent mutations, oldest first, for followers to replay
+    mutations: Deque[Mutation]
+    mutation_log_size: int
 
 
 #
@@ -47,24 +176,55 @@ type
 #
 
 proc empty_compressed_sequence(cs: var CompressedSequence) =
-  for i in 0..3: cs[i] = @[]
+  for i in 0..3: cs.by_base[i] = @[]
+  cs.codes = @[]
+
+# the sorted positions at which the sample has base (0..3 for A, C, G, T)
+proc `[]`*(cs: CompressedSequence, base: int): seq[int] =
+  if not cs.packed:
+    return cs.by_base[base]
+  for code in cs.codes:
+    if (code and 3) == base:
+      result.add(code shr 2)
+
+# (base, position) for every difference
+iterator base_positions*(cs: CompressedSequence): (int, int) =
+  if cs.packed:
+    for code in cs.codes:
+      yield (code and 3, code shr 2)
+  else:
+    for i in 0..3:
+      for position in cs.by_base[i]:
+        yield (i, position)
+
+proc len*(cs: CompressedSequence): int =
+  if cs.packed: cs.codes.len
+  else: cs.by_base[0].len + cs.by_base[1].len + cs.by_base[2].len + cs.by_base[3].len
+
+proc pack(cs: CompressedSequence): CompressedSequence =
+  result.packed = true
+  for (base, position) in cs.base_positions:
+    result.codes.add(position shl 2 or base)
+  result.codes.sort()
 
 proc compressed_sequence_counts*(cs: CompressedSequence) : seq[int] =
   result = @[]
   for i in 0..3: result.add(len(cs[i]))
 
 proc count_diff2(cs1: CompressedSequence, cs2: CompressedSequence, sample1_n_positions: IntSet, sample2_n_positions: IntSet, max_distance: int) : int =
-  return sum_sym_diff1(cs1[0], cs2[0],
-                       cs1[1], cs2[1],
-                       cs1[2], cs2[2],
-                       cs1[3], cs2[3],
+  if cs1.packed != cs2.packed:
+    return count_diff2(cs1.pack(), cs2.pack(), sample1_n_positions, sample2_n_positions, max_distance)
+  if cs1.packed:
+    return packed_diff(cs1.codes, cs2.codes, sample1_n_positions, sample2_n_positions, max_distance)
+  return sum_sym_diff1(cs1.by_base[0], cs2.by_base[0],
+                       cs1.by_base[1], cs2.by_base[1],
+                       cs1.by_base[2], cs2.by_base[2],
+                       cs1.by_base[3], cs2.by_base[3],
                        sample1_n_positions, sample2_n_positions,
                        max_distance)
 
 proc ref_snp_distance(cs: CompressedSequence) : int =
-  result = 0
-  for i in 0..3:
-    result += len(cs[i])
+  cs.len
 
 proc add_position(cs: var CompressedSequence, base: char, position: int) {.inline.} =
   let index = case base:
@@ -77,7 +237,10 @@ proc add_position(cs: var CompressedSequence, base: char, position: int) {.inlin
     of 'g': 2
     of 't': 3
     else: 4
-  cs[index].add(position)
+  if cs.packed:
+    cs.codes.add(position shl 2 or index)
+  else:
+    cs.by_base[index].add(position)
 
 proc uppercase_acgt(base: char): char {.inline.} =
   case base:
@@ -99,17 +262,18 @@ proc uppercase_seq(sequence: string): string =
 # Sample
 #
 
-proc new_Sample*(): Sample =
+proc new_Sample*(packed: bool = false): Sample =
+  result.diffsets.packed = packed
   empty_compressed_sequence(result.diffsets)
   result.n_positions = initIntSet()
   result.status = Unknown
 
 proc is_n_position(c: char): bool {.inline.} =
-  c != 'A' and c != 'C' and c != 'G' and c != 'T' and c != 'a' and c != 'c' and c != 'g' and c != 'T'
+  c != 'A' and c != 'C' and c != 'G' and c != 'T' and c != 'a' and c != 'c' and c != 'g' and c != 't'
 
-proc reference_compress*(sample_sequence: string, ref_sequence: string, mask: Mask, max_n_positions: int): Sample =
+proc reference_compress*(sample_sequence: string, ref_sequence: string, mask: Mask, max_n_positions: int, packed: bool = false): Sample =
   var
-    sample = new_Sample()
+    sample = new_Sample(packed)
 
   if sample_sequence.len != ref_sequence.len:
     sample.status = InvalidLength
@@ -131,22 +295,90 @@ proc reference_compress*(sample_sequence: string, ref_sequence: string, mask: Ma
   return sample
 
 
+proc sample_from_refcomp*(refcomp_json: string, max_n_positions: int, reference_length: int, packed: bool = false): Sample =
+  let tbl = refcomp_json.fromJson(Table[string, seq[int]])
+
+  result = new_Sample(packed)
+  if tbl["N"].len > max_n_positions:
+    result.status = TooManyNs
+    return
+
+  # signatures, dense copies and rereferencing index by position
+  for base in ["A", "C", "G", "T", "N"]:
+    for position in tbl[base]:
+      if position < 0 or position >= reference_length:
+        raise newException(ValueError, fmt"{base} position {position} is outside the reference (length {reference_length})")
+
+  result.status = Ok
+  result.n_positions = toIntSet(tbl["N"])
+
+  var diffsets: CompressedSequence
+  diffsets.by_base[0] = tbl["A"]
+  diffsets.by_base[1] = tbl["C"]
+  diffsets.by_base[2] = tbl["G"]
+  diffsets.by_base[3] = tbl["T"]
+  for i in 0..3:
+    diffsets.by_base[i].sort()
+  result.diffsets = if packed: diffsets.pack() else: diffsets
+
+proc add_positions(s: var string, key: string, positions: seq[int]) =
+  s.add("\"" & key & "\":[")
+  for i, x in positions:
+    if i > 0:
+      s.add(',')
+    s.add($x)
+  s.add(']')
+
+# the refcomp JSON that sample_from_refcomp reads, with sorted positions.
+# Written directly rather than through a JsonNode.
+proc refcomp_json*(s: Sample): string =
+  var n_positions: seq[int]
+  for x in s.n_positions:
+    n_positions.add(x)
+  n_positions.sort()
+  result = "{"
+  result.add_positions("N", n_positions)
+  for base in 0..3:
+    result.add(',')
+    result.add_positions($"ACGT"[base], s.diffsets[base])
+  result.add('}')
+
+
 proc recover_sequence_str*(ref_sequence: string, ref_mask: IntSet, sample_diffsets: CompressedSequence, sample_n_positions: IntSet): string =
   result = ref_sequence
-  for i in sample_diffsets[0]:
-    result[i] = 'A'
-  for i in sample_diffsets[1]:
-    result[i] = 'C'
-  for i in sample_diffsets[2]:
-    result[i] = 'G'
-  for i in sample_diffsets[3]:
-    result[i] = 'T'
+  for (base, i) in sample_diffsets.base_positions:
+    result[i] = "ACGT"[base]
   for i in sample_n_positions:
     result[i] = 'N'
   for i in ref_mask:
     result[i] = 'N'
 
 
+# a sample encoded against from_ref, re-encoded against to_ref. positions
+# are those at which the two references differ, which must have only ACGT
+# in both.
+proc rebase(sample: Sample, from_ref: string, to_ref: string, positions: IntSet): Sample =
+  result = sample
+  if sample.status != Ok or positions.len == 0:
+    return
+  result.diffsets = CompressedSequence(packed: sample.diffsets.packed)
+  var
+    diffs: seq[(int, int)]
+    seen = initIntSet()
+  for (base, position) in sample.diffsets.base_positions:
+    if positions.contains(position):
+      seen.incl(position)
+      if "ACGT"[base] == to_ref[position]:
+        continue
+    diffs.add((position, base))
+  for position in positions:
+    if not seen.contains(position) and not sample.n_positions.contains(position):
+      diffs.add((position, "ACGT".find(from_ref[position])))
+  diffs.sort()
+  for (position, base) in diffs:
+    result.diffsets.add_position("ACGT"[base], position)
+
+
 #
 # Mask
 #
@@ -159,50 +391,424 @@ proc new_Mask*(mask_name: string, mask_str: string): Mask =
     except ValueError:
       echo fmt"Mask line is not an integer: '{line}'"
 
+#
+# Deadline
+#
+
+# a deadline seconds from now, or nil (none) if seconds <= 0
+proc new_Deadline*(seconds: float): Deadline =
+  if seconds > 0:
+    result = Deadline(at: getMonoTime() + initDuration(nanoseconds = int64(seconds * 1e9)))
+
+# true once the deadline has passed. Called once per comparison; the clock
+# is only read every 1024 calls.
+proc passed(d: Deadline): bool =
+  if d == nil:
+    return false
+  if not d.expired:
+    inc d.checks
+    if (d.checks and 1023) == 0 and getMonoTime() > d.at:
+      d.expired = true
+  return d.expired
+
+# true if a scan stopped early because the deadline passed
+proc incomplete*(d: Deadline): bool =
+  d != nil and d.expired
+
+#
+# QueryLog
+#
+
+proc new_QueryLog*(capacity: int): QueryLog =
+  result.capacity = max(capacity, 1)
+  result.records = newSeqOfCap[QueryRecord](result.capacity)
+
+proc add*(log: var QueryLog, record: QueryRecord) =
+  if log.records.len < log.capacity:
+    log.records.add(record)
+  else:
+    log.records[log.next] = record
+  log.next = (log.next + 1) mod log.capacity
+  inc log.total
+
+proc clear*(log: var QueryLog) =
+  log.records.setLen(0)
+  log.next = 0
+
+iterator items*(log: QueryLog): QueryRecord =
+  ## oldest to newest
+  if log.records.len < log.capacity:
+    for r in log.records:
+      yield r
+  else:
+    for i in 0..<log.capacity:
+      yield log.records[(log.next + i) mod log.capacity]
+
+proc percentile(sorted_xs: seq[float], p: float): float =
+  # nearest-rank percentile of an ascending sequence
+  if sorted_xs.len == 0:
+    return 0.0
+  let rank = int(ceil(p / 100.0 * sorted_xs.len.float))
+  return sorted_xs[clamp(rank - 1, 0, sorted_xs.high)]
+
+proc latency_summary*(log: QueryLog): seq[LatencySummary] =
+  var by_distance = initTable[int, seq[float]]()
+  for r in log:
+    by_distance.mgetOrPut(r.distance, @[]).add(r.latency)
+  for distance, latencies in by_distance.mpairs:
+    latencies.sort()
+    result.add((distance: distance,
+                count: latencies.len,
+                p50: percentile(latencies, 50),
+                p95: percentile(latencies, 95),
+                p99: percentile(latencies, 99),
+                max: latencies[latencies.high]))
+  result.sort(proc (x, y: LatencySummary): int = cmp(x.distance, y.distance))
+
+#
+# Signature
+#
+# The positions of a block where exactly one of two samples differs from
+# the reference, and the other has no N, each add one to their distance.
+# So for block counts cx, cy of differences and nx, ny of Ns,
+#
+#   distance >= sum over blocks of max(0, cx - cy - ny, cy - cx - nx)
+#
+# which rejects most distant candidates without touching their diffsets.
+# A saturated count is only a lower bound on the true count, so terms
+# subtracting one are skipped.
+
+const
+  signature_blocks = 64
+  signature_saturated = high(uint16).int
+
+proc make_signature(sample: Sample, block_size: int): Signature =
+  for (_, position) in sample.diffsets.base_positions:
+    let b = position div block_size
+    if result[b].int < signature_saturated:
+      inc result[b]
+  for position in sample.n_positions:
+    let b = signature_blocks + position div block_size
+    if result[b].int < signature_saturated:
+      inc result[b]
+
+proc set_signature(store: SignatureStore, profile_id: int, signature: Signature) =
+  let offset = profile_id * 2 * signature_blocks
+  if store.data.len < offset + 2 * signature_blocks:
+    store.data.setLen(offset + 2 * signature_blocks)
+  for i in 0..<2 * signature_blocks:
+    store.data[offset + i] = signature[i]
+
+# a lower bound on the distance between the query and a stored profile
+proc signature_bound(store: SignatureStore, q: Signature, profile_id: int): int {.inline.} =
+  let offset = profile_id * 2 * signature_blocks
+  for b in 0..<signature_blocks:
+    let
+      cx = q[b].int
+      nx = q[signature_blocks + b].int
+      cy = store.data[offset + b].int
+      ny = store.data[offset + signature_blocks + b].int
+    var bound = 0
+    if cy != signature_saturated and ny != signature_saturated:
+      bound = cx - cy - ny
+    if cx != signature_saturated and nx != signature_saturated:
+      bound = max(bound, cy - cx - nx)
+    result += max(bound, 0)
+
 #
 # CatWalk
 #
 
-proc new_CatWalk*(name: string, reference_name: string, reference_sequence: string, mask: Mask, max_n_positions: int) : CatWalk =
+proc new_CatWalk*(name: string, reference_name: string, reference_sequence: string, mask: Mask, max_n_positions: int, query_log_size: int = 10000, packed_diffsets: bool = false, use_dense: bool = false, mutation_log_size: int = 0, dense_cutoff: int = 20) : CatWalk =
   result.name = name
+  result.packed_diffsets = packed_diffsets
   result.reference_name = reference_name
   result.reference_sequence = uppercase_seq(reference_sequence)
+  result.internal_reference = result.reference_sequence
+  result.rebased_positions = initIntSet()
   result.mask = mask
   result.max_n_positions = max_n_positions
-  result.active_samples = newTable[int, Sample]()
+  result.profiles = newTable[int, Sample]()
+  result.tombstones = newTable[int, Sample]()
+  result.unindexed = initIntSet()
+  result.profile_samples = newTable[int, seq[int]]()
+  result.profile_of = newTable[int, int]()
+  result.profile_ids = newTable[Hash, seq[int]]()
+  result.signatures = SignatureStore()
+  result.signature_block = max(1, (result.reference_sequence.len + signature_blocks - 1) div signature_blocks)
   result.all_sample_indexes = newTable[string, int]()
   result.all_sample_names = newTable[int, string]()
+  result.query_log = new_QueryLog(query_log_size)
+  result.mutations = initDeque[Mutation]()
+  result.mutation_log_size = mutation_log_size
+  result.dense = DenseStore()
+  # dense sequences have no N in the reference, so unmasked reference
+  # positions other than ACGT would be compared wrongly
+  result.use_dense = use_dense
+  result.dense_cutoff = dense_cutoff
+  for i, base in result.reference_sequence:
+    if base notin {'A', 'C', 'G', 'T'} and not mask.positions.contains(i):
+      if use_dense:
+        echo "the reference has positions other than ACGT; not using dense sequences"
+      result.use_dense = false
+      break
+  if result.use_dense:
+    result.dense.reference = new_DenseSequence(result.reference_sequence)
+
+# the work to compare two samples by merging their diff lists, in dense
+# words. Each step probes an N set, about three words' work, and the
+# per-base layout also searches the buffer of differences found so far,
+# which stops growing at max_distance + 1.
+proc merge_cost(cs1: CompressedSequence, cs2: CompressedSequence, max_distance: int): int {.inline.} =
+  let n = cs1.len + cs2.len
+  if cs1.packed: 3 * n else: 3 * n + n * min(n, max_distance + 1) div 16
+
+proc make_dense(store: DenseStore, sample: Sample): DenseSequence =
+  result = store.reference
+  for (base, position) in sample.diffsets.base_positions:
+    result.set_base(position, base)
+  for position in sample.n_positions:
+    result.set_n(position)
+
+# a dense copy of sample, or an empty one if dense sequences are not used
+proc make_dense(c: CatWalk, sample: Sample): DenseSequence =
+  if not c.use_dense or sample.status != Ok:
+    return
+  c.dense.make_dense(sample)
+
+# the distance from sample1 to a stored profile. Dense copies are compared
+# if both have one and that is cheaper than merging the diff lists.
+proc profile_distance(store: DenseStore, sample1: Sample, dense1: DenseSequence, profile_id: int, sample2: Sample, max_distance: int): int {.inline.} =
+  if dense1.words > 0 and profile_id < store.data.len and store.data[profile_id].words > 0 and
+     merge_cost(sample1.diffsets, sample2.diffsets, max_distance) > dense1.words:
+    return dense_distance(dense1, store.data[profile_id], max_distance)
+  count_diff2(sample1.diffsets, sample2.diffsets, sample1.n_positions, sample2.n_positions, max_distance)
+
+# profile_distance for a query, whose dense copy dense1 is only made, by
+# copying the whole dense reference, the first time a comparison would use
+# it. Queries close to the reference never need one.
+proc query_distance(store: DenseStore, sample1: Sample, dense1: var DenseSequence, profile_id: int, sample2: Sample, max_distance: int): int {.inline.} =
+  if dense1.words == 0 and profile_id < store.data.len and store.data[profile_id].words > 0 and
+     merge_cost(sample1.diffsets, sample2.diffsets, max_distance) > store.reference.words:
+    dense1 = store.make_dense(sample1)
+  store.profile_distance(sample1, dense1, profile_id, sample2, max_distance)
+
+# the stored dense copy of a profile, or an empty one
+proc stored_dense(store: DenseStore, profile_id: int): DenseSequence =
+  if profile_id < store.data.len:
+    return store.data[profile_id]
+
+# a sample against the reference, re-encoded for storage
+proc to_internal(c: CatWalk, sample: Sample): Sample =
+  rebase(sample, c.reference_sequence, c.internal_reference, c.rebased_positions)
+
+# a dense copy may take at most this many times the memory of the diff
+# list it stands in for
+const dense_memory_ratio = 8
+
+# keeps a dense copy of a profile if comparing it with a profile like it,
+# within dense_cutoff, is cheaper dense than merged, and the copy isn't too
+# large (see dense_memory_ratio)
+proc store_dense(c: var CatWalk, profile_id: int, sample: Sample) =
+  if c.use_dense and
+     merge_cost(sample.diffsets, sample.diffsets, c.dense_cutoff) >= c.dense.reference.words and
+     c.dense.reference.bytes <= dense_memory_ratio * sizeof(int) * sample.diffsets.len:
+    if c.dense.data.len <= profile_id:
+      c.dense.data.setLen(profile_id + 1)
+    c.dense.data[profile_id] = c.make_dense(sample)
+
+# the stored profile of a sample that has not been removed
+proc get_sample*(c: CatWalk, sample_index: int): Sample =
+  c.profiles[c.profile_of[sample_index]]
 
-proc process_neighbours(c: var CatWalk, sample1: Sample, sample1_index: int, distance: int): seq[(int, int)] =
+proc get_sample*(c: CatWalk, sample_name: string): Sample =
+  c.get_sample(c.all_sample_indexes[sample_name])
+
+# a stored sample against reference_sequence, as it was added; get_sample
+# returns it as stored
+proc external_sample*(c: CatWalk, sample_index: int): Sample =
+  rebase(c.get_sample(sample_index), c.internal_reference, c.reference_sequence, c.rebased_positions)
+
+proc external_sample*(c: CatWalk, sample_name: string): Sample =
+  c.external_sample(c.all_sample_indexes[sample_name])
+
+# Removed for removed samples
+proc sample_status*(c: CatWalk, sample_index: int): SampleStatus =
+  if c.profile_of.hasKey(sample_index): c.get_sample(sample_index).status else: Removed
+
+# indexes of the samples not removed, in the order they were added
+iterator sample_indexes*(c: CatWalk): int =
+  for index in 0..<c.next_sample_index:
+    if c.profile_of.hasKey(index):
+      yield index
+
+proc n_samples*(c: CatWalk): int =
+  c.profile_of.len
+
+proc add_profile_hits(c: CatWalk, hits: var seq[(int, int)], profile_id: int, d: int, sample1_index: int) =
+  for sample2_index in c.profile_samples[profile_id]:
+    if sample2_index != sample1_index:
+      hits.add((sample2_index, d))
+
+# the profile an index refers to by profile_id, which may be a tombstone
+proc indexed_profile(samples: TableRef[int, Sample], tombstones: TableRef[int, Sample], profile_id: int): ptr Sample {.inline.} =
+  if tombstones.len > 0 and tombstones.hasKey(profile_id):
+    tombstones[profile_id].addr
+  else:
+    samples[profile_id].addr
+
+# each profile is compared once, and the distance reported for every
+# sample sharing it. With an index, only the profiles added since it was
+# built are scanned.
+proc process_neighbours(c: var CatWalk, sample1: Sample, sample1_index: int, distance: int, candidates: var int, deadline: Deadline): seq[(int, int)] =
   if sample1.status != Ok:
     return
-  for sample2_index in c.active_samples.keys:
-    if sample2_index == sample1_index:
-      continue
-    let
-      sample2 = c.active_samples[sample2_index]
-    if sample2.status != Ok:
+  let
+    q = make_signature(sample1, c.signature_block)
+    signatures = c.signatures
+    dense_store = c.dense
+  # made by query_distance if a comparison needs it
+  var dense1: DenseSequence
+  # profiles are looked up only once their signatures pass, and by
+  # reference, so rejected candidates' diffsets are never read
+  if c.index == nil:
+    let samples = c.profiles
+    for profile_id in samples.keys:
+      if deadline.passed:
+        break
+      inc candidates
+      if signatures.signature_bound(q, profile_id) > distance or samples[profile_id].status != Ok:
+        continue
+      let
+        d = dense_store.query_distance(sample1, dense1, profile_id, samples[profile_id], distance)
+      if d <= distance:
+        c.add_profile_hits(result, profile_id, d, sample1_index)
+    return
+
+  let
+    samples = c.profiles
+    tombstones = c.tombstones
+  var
+    found: seq[(int, int)]
+    compared = 0
+  c.index.search(proc (profile_id: int, max_distance: int): int =
+                   if deadline.passed:
+                     return -1
+                   inc compared
+                   if signatures.signature_bound(q, profile_id) > max_distance:
+                     return max_distance + 1
+                   dense_store.query_distance(sample1, dense1, profile_id,
+                                              indexed_profile(samples, tombstones, profile_id)[], max_distance),
+                 sample1.n_positions.len, distance, c.index_approximate,
+                 proc (profile_id: int, d: int) = found.add((profile_id, d)))
+  for profile_id in c.unindexed:
+    if deadline.passed:
+      break
+    inc compared
+    if signatures.signature_bound(q, profile_id) > distance:
       continue
     let
-      d = count_diff2(sample1.diffsets, sample2.diffsets, sample1.n_positions, sample2.n_positions, distance)
+      d = dense_store.query_distance(sample1, dense1, profile_id, samples[profile_id], distance)
     if d <= distance:
-      result.add((sample2_index, d))
+      found.add((profile_id, d))
+  candidates += compared
+  for (profile_id, d) in found:
+    c.add_profile_hits(result, profile_id, d, sample1_index)
 
-proc get_neighbours*(c: var CatWalk, sample_name: string, distance: int) : seq[(string, int)] =
-  let time1 = cpuTime()
+proc query_neighbours(c: var CatWalk, sample_name: string, sample: Sample, sample_index: int, distance: int, deadline: Deadline) : seq[(string, int)] =
+  let time1 = getMonoTime()
+  var candidates = 0
   let
-    sample_index = c.all_sample_indexes[sample_name]
-    sample = c.active_samples[sample_index]
-    neighbours = c.process_neighbours(sample, sample_index, distance)
-  let dt = cpuTime() - time1
-  c.neighbours_times[sample_name] = dt
-  let sam_num = c.active_samples.len
+    neighbours = c.process_neighbours(sample, sample_index, distance, candidates, deadline)
+  let dt = (getMonoTime() - time1).inNanoseconds.float / 1e9
+  c.query_log.add((sample_name: sample_name,
+                   distance: distance,
+                   latency: dt,
+                   candidates: candidates,
+                   hits: neighbours.len))
+  let sam_num = c.profiles.len
   echo "Performed " & $sam_num & " distance " & $distance & " comparisons on sample \"" & sample_name & "\" in " & $dt & " seconds (~" & $((1.0 / (dt.float32 / sam_num.float32)) / 1000).int & "k per second)"
 
   result = @[]
   for (neighbour_index, distance) in neighbours:
     result.add((c.all_sample_names[neighbour_index], distance))
 
+# neighbours of a stored sample. If the deadline passes, the scan stops and
+# the neighbours found so far are returned; check deadline.incomplete.
+proc get_neighbours*(c: var CatWalk, sample_name: string, distance: int, deadline: Deadline = nil) : seq[(string, int)] =
+  let
+    sample_index = c.all_sample_indexes[sample_name]
+    sample = c.get_sample(sample_index)
+  c.query_neighbours(sample_name, sample, sample_index, distance, deadline)
+
+# heap entry for get_nearest; the farthest entry is on top
+type Nearest = object
+  distance: int
+  name: string
+
+proc `<`(x, y: Nearest): bool = (x.distance, x.name) > (y.distance, y.name)
+
+# the k samples closest to sample_name, sorted by distance then name. The
+# best k found so far are kept in a heap, and once it is full the farthest
+# of them is the max_distance for the remaining comparisons, so early exit
+# cuts more of the scan as the query proceeds.
+proc get_nearest*(c: var CatWalk, sample_name: string, k: int, deadline: Deadline = nil) : seq[(string, int)] =
+  let
+    time1 = getMonoTime()
+    sample1_index = c.all_sample_indexes[sample_name]
+    sample1 = c.get_sample(sample1_index)
+    reflen = c.reference_sequence.len
+  var heap = initHeapQueue[Nearest]()
+  if sample1.status != Ok or k < 1:
+    return
+  let
+    q = make_signature(sample1, c.signature_block)
+    samples = c.profiles
+  var dense1: DenseSequence
+  for profile_id in samples.keys:
+    if deadline.passed:
+      break
+    let max_distance = if heap.len < k: reflen else: heap[0].distance
+    if c.signatures.signature_bound(q, profile_id) > max_distance or samples[profile_id].status != Ok:
+      continue
+    let
+      d = c.dense.query_distance(sample1, dense1, profile_id, samples[profile_id], max_distance)
+    if d > max_distance:
+      continue
+    for sample2_index in c.profile_samples[profile_id]:
+      if sample2_index == sample1_index:
+        continue
+      let entry = Nearest(distance: d, name: c.all_sample_names[sample2_index])
+      if heap.len < k:
+        heap.push(entry)
+      elif heap[0] < entry:
+        discard heap.replace(entry)
+  let dt = (getMonoTime() - time1).inNanoseconds.float / 1e9
+  echo "Found " & $heap.len & " nearest of " & $c.n_samples & " samples to \"" & sample_name & "\" in " & $dt & " seconds"
+
+  while heap.len > 0:
+    let entry = heap.pop()
+    result.add((entry.name, entry.distance))
+  result.reverse()
+
+# the neighbours of sample_name within distance, grouped by distance:
+# result[d] holds the names of the samples at distance d. One scan serves
+# every threshold up to distance. Names are sorted.
+proc get_neighbour_histogram*(c: var CatWalk, sample_name: string, distance: int, deadline: Deadline = nil) : seq[seq[string]] =
+  result = newSeq[seq[string]](max(distance + 1, 0))
+  for (name, d) in c.get_neighbours(sample_name, distance, deadline):
+    result[d].add(name)
+  for names in result.mitems:
+    names.sort()
+
+# neighbours of a sample stored elsewhere, e.g. on another shard. A stored
+# sample with the same name is not reported as its own neighbour.
+proc get_neighbours_from_refcomp*(c: var CatWalk, sample_name: string, refcomp_json: string, distance: int, deadline: Deadline = nil) : seq[(string, int)] =
+  let
+    sample = c.to_internal(sample_from_refcomp(refcomp_json, c.max_n_positions, c.reference_sequence.len, c.packed_diffsets))
+    sample_index = c.all_sample_indexes.getOrDefault(sample_name, -1)
+  c.query_neighbours(sample_name, sample, sample_index, distance, deadline)
+
 
 iterator get_matrix(sample_names: seq[string]) : (string, string) =
   for i in 0..<sample_names.len:
@@ -212,22 +818,104 @@ iterator get_matrix(sample_names: seq[string]) : (string, string) =
       yield (sample_names[i], sample_names[j])
 
 
-proc get_pairwise_distances*(c: CatWalk, sample_names: seq[string]) : seq[(string, string, int)] =
+# distances between every pair of sample_names, in get_matrix order. If the
+# deadline passes, the pairs computed so far are returned.
+proc get_pairwise_distances*(c: CatWalk, sample_names: seq[string], deadline: Deadline = nil) : seq[(string, string, int)] =
   let reflen = c.reference_sequence.len
   for sam1_name, sam2_name in get_matrix(sample_names):
+    if deadline.passed:
+      break
     let
-      sam1_index = c.all_sample_indexes[sam1_name]
-      sam2_index = c.all_sample_indexes[sam2_name]
-      sam1 = c.active_samples[sam1_index]
-      sam2 = c.active_samples[sam2_index]
-      d = count_diff2(sam1.diffsets, sam2.diffsets, sam1.n_positions, sam2.n_positions, reflen)
+      profile1 = c.profile_of[c.all_sample_indexes[sam1_name]]
+      profile2 = c.profile_of[c.all_sample_indexes[sam2_name]]
+      d = c.dense.profile_distance(c.profiles[profile1], c.dense.stored_dense(profile1),
+                                   profile2, c.profiles[profile2], reflen)
     result.add((sam1_name, sam2_name, d))
 
 
+# distances from samples outer[first..<last] to every inner sample, as
+# native int32s: outer-major, or (outer, inner, distance) triples of the
+# pairs within max_distance if sparse. Distances above max_distance are
+# reported as max_distance + 1.
+proc cross_block(samples: TableRef[int, Sample], dense_store: DenseStore, outer: seq[int], inner: seq[int], first: int, last: int, max_distance: int, sparse: bool) : string =
+  var ds: seq[int32]
+  for i in first..<last:
+    let
+      sam1 = samples[outer[i]]
+      dense1 = dense_store.stored_dense(outer[i])
+    for j in 0..<inner.len:
+      let
+        d = dense_store.profile_distance(sam1, dense1, inner[j], samples[inner[j]], max_distance)
+      if not sparse:
+        ds.add(d.int32)
+      elif d <= max_distance:
+        ds.add([i.int32, j.int32, d.int32])
+  result = newString(ds.len * 4)
+  if ds.len > 0:
+    copyMem(result[0].addr, ds[0].addr, result.len)
+
+# the fewest comparisons worth forking a worker for. Forking copies the
+# page tables of the whole store, so small tiles are computed in this
+# process.
+const fork_min_pairs = 50000
+
+# runs cross_block over the larger of the two sets, split between up to
+# workers forked processes, each with at least fork_min_pairs comparisons.
+# Returns the concatenated int32s and whether the outer set was names_b.
+proc cross_map(c: CatWalk, names_a: seq[string], names_b: seq[string], max_distance: int, sparse: bool, workers: int) : (seq[int32], bool) =
+  var indexes_a, indexes_b: seq[int]
+  for name in names_a: indexes_a.add(c.profile_of[c.all_sample_indexes[name]])
+  for name in names_b: indexes_b.add(c.profile_of[c.all_sample_indexes[name]])
+  let
+    transposed = names_b.len > names_a.len
+    outer = if transposed: indexes_b else: indexes_a
+    inner = if transposed: indexes_a else: indexes_b
+    samples = c.profiles
+    dense_store = c.dense
+    max_distance = if max_distance < 0: c.reference_sequence.len else: max_distance
+    workers = min(workers, outer.len * inner.len div fork_min_pairs)
+  let parts = fork_map(outer.len, workers, proc (first: int, last: int): string =
+    cross_block(samples, dense_store, outer, inner, first, last, max_distance, sparse))
+  var ds: seq[int32]
+  for part in parts:
+    let old_len = ds.len
+    ds.setLen(old_len + part.len div 4)
+    if part.len > 0:
+      copyMem(ds[old_len].addr, part[0].unsafeAddr, part.len)
+  return (ds, transposed)
+
+# distances between every sample in names_a and every sample in names_b,
+# row-major: result[i * names_b.len + j] is the distance from names_a[i] to
+# names_b[j]. With max_distance >= 0, comparisons stop early and larger
+# distances are reported as max_distance + 1.
+proc get_cross_distances*(c: CatWalk, names_a: seq[string], names_b: seq[string], max_distance: int = -1, workers: int = 1) : seq[int] =
+  let (ds, transposed) = c.cross_map(names_a, names_b, max_distance, false, workers)
+  result = newSeq[int](ds.len)
+  if transposed:
+    for j in 0..<names_b.len:
+      for i in 0..<names_a.len:
+        result[i * names_b.len + j] = ds[j * names_a.len + i]
+  else:
+    for k, d in ds:
+      result[k] = d
+
+# the pairs of samples from names_a and names_b within max_distance, as
+# (index in names_a, index in names_b, distance), sorted by index
+proc get_cross_distances_sparse*(c: CatWalk, names_a: seq[string], names_b: seq[string], max_distance: int, workers: int = 1) : seq[CrossDistance] =
+  let (ds, transposed) = c.cross_map(names_a, names_b, max_distance, true, workers)
+  for k in 0..<(ds.len div 3):
+    let (outer, inner, d) = (ds[3 * k].int, ds[3 * k + 1].int, ds[3 * k + 2].int)
+    if transposed:
+      result.add((a: inner, b: outer, distance: d))
+    else:
+      result.add((a: outer, b: inner, distance: d))
+  if transposed:
+    result.sort(proc (x, y: CrossDistance): int = cmp((x.a, x.b), (y.a, y.b)))
+
+
 proc get_sample_counts*(c: var CatWalk, sample_name: string): Table[string, int] =
   let
-    sample_index = c.all_sample_indexes[sample_name]
-    sample = c.active_samples[sample_index]
+    sample = c.external_sample(sample_name)
   { "N": sample.n_positions.len(),
     "A": sample.diffsets[0].len(),
     "C": sample.diffsets[1].len(),
@@ -237,23 +925,123 @@ proc get_sample_counts*(c: var CatWalk, sample_name: string): Table[string, int]
 
 proc dump_sample*(c: var CatWalk, sample_name: string): string =
   let
-    sample_index = c.all_sample_indexes[sample_name]
-    sample = c.active_samples[sample_index]
+    sample = c.external_sample(sample_name)
   return $sample
 
 let measure = false
 
+proc hash(sample: Sample): Hash =
+  var h: Hash = 0
+  h = h !& hash(sample.status)
+  for i in 0..3:
+    h = h !& hash(sample.diffsets.by_base[i])
+  h = h !& hash(sample.diffsets.codes)
+  # IntSet iteration order depends on its history, so combine the
+  # positions in an order-independent way
+  var n_hash: Hash = 0
+  for x in sample.n_positions:
+    n_hash = n_hash +% hash(x)
+  h = h !& n_hash !& hash(sample.n_positions.len)
+  !$h
+
+proc same_profile(x, y: Sample): bool =
+  x.status == y.status and x.diffsets == y.diffsets and x.n_positions == y.n_positions
+
+# detaches a sample from its profile, and drops the profile if no other
+# sample uses it
+proc unlink_sample(c: var CatWalk, sample_index: int) =
+  if not c.profile_of.hasKey(sample_index):
+    return
+  let profile_id = c.profile_of[sample_index]
+  c.profile_of.del(sample_index)
+  var members = c.profile_samples[profile_id]
+  members.delete(members.find(sample_index))
+  if members.len > 0:
+    c.profile_samples[profile_id] = members
+    return
+  let h = hash(c.profiles[profile_id])
+  var ids = c.profile_ids[h]
+  ids.delete(ids.find(profile_id))
+  if ids.len == 0:
+    c.profile_ids.del(h)
+  else:
+    c.profile_ids[h] = ids
+  var indexed = false
+  for t in [c.index, c.index_building]:
+    if t != nil and profile_id in t:
+      t.remove(profile_id)
+      indexed = true
+  if indexed:
+    c.tombstones[profile_id] = c.profiles[profile_id]
+  else:
+    if profile_id < c.dense.data.len:
+      c.dense.data[profile_id] = DenseSequence()
+    c.free_profile_ids.add(profile_id)
+  c.unindexed.excl(profile_id)
+  c.profiles.del(profile_id)
+  c.profile_samples.del(profile_id)
+
+# logs a mutation for followers. A template, so that sample is only built
+# when mutations are logged.
+template log_mutation(c: var CatWalk, sample_name: string, is_removal: bool, logged_sample: Sample) =
+  if c.mutation_log_size > 0:
+    c.mutations.addLast((generation: c.generation, name: sample_name, removed: is_removal, sample: logged_sample))
+    while c.mutations.len > c.mutation_log_size:
+      c.mutations.popFirst()
+
+# true if the mutations after generation are all still logged
+proc mutations_since_available*(c: CatWalk, generation: int): bool =
+  if generation >= c.generation:
+    return generation == c.generation
+  c.mutations.len > 0 and c.mutations[0].generation <= generation + 1
+
+# the logged mutations after generation, oldest first
+iterator mutations_since*(c: CatWalk, generation: int): Mutation =
+  for m in c.mutations:
+    if m.generation > generation:
+      yield m
+
+# stores a sample, sharing the profile of an identical sample if there is one
 proc register_sample(c: var CatWalk, sample: Sample, name: string) =
-  let sample_index = len(c.active_samples)
+  let
+    sample_index = c.next_sample_index
+    h = hash(sample)
+  var profile_id = -1
+  for candidate in c.profile_ids.getOrDefault(h):
+    if same_profile(c.profiles[candidate], sample):
+      profile_id = candidate
+      break
+  if profile_id < 0:
+    if c.free_profile_ids.len > 0:
+      profile_id = c.free_profile_ids.pop()
+    else:
+      profile_id = c.next_profile_id
+      inc c.next_profile_id
+    c.profiles[profile_id] = sample
+    if c.index != nil and sample.status == Ok:
+      c.unindexed.incl(profile_id)
+    c.signatures.set_signature(profile_id, make_signature(sample, c.signature_block))
+    c.store_dense(profile_id, sample)
+    c.profile_samples[profile_id] = @[]
+    c.profile_ids.mgetOrPut(h, @[]).add(profile_id)
+  c.profile_samples[profile_id].add(sample_index)
+  c.profile_of[sample_index] = profile_id
+  inc c.next_sample_index
+  # a sample added again under the same name replaces the old one
+  if c.all_sample_indexes.hasKey(name):
+    let old_index = c.all_sample_indexes[name]
+    c.all_sample_names.del(old_index)
+    c.unlink_sample(old_index)
   c.all_sample_indexes[name] = sample_index
   c.all_sample_names[sample_index] = name
-  c.active_samples[sample_index] = sample
+  inc c.generation
+  c.log_mutation(name, false, c.external_sample(sample_index))
 
 
 proc add_sample*(c: var CatWalk, name: string, sequence: string, keep: bool) =
   let time1 = cpuTime()
   var
-    sample = reference_compress(sequence, c.reference_sequence, c.mask, c.max_n_positions)
+    sample = reference_compress(sequence, c.internal_reference, c.mask, c.max_n_positions, c.packed_diffsets)
 
   c.register_sample(sample, name)
 
@@ -271,41 +1059,273 @@ proc add_sample*(c: var CatWalk, name: string, sequence: string, keep: bool) =
 
 proc remove_sample*(c: var CatWalk, name: string) =
   let sample_id = c.all_sample_indexes[name]
-  c.active_samples[sample_id].diffsets.empty_compressed_sequence()
-  c.active_samples[sample_id].n_positions = initIntSet()
-  c.active_samples[sample_id].status = Removed
+  c.unlink_sample(sample_id)
   c.all_sample_names.del(sample_id)
   c.all_sample_indexes.del(name)
+  inc c.generation
+  c.log_mutation(name, true, new_Sample())
 
 
 proc add_sample_from_refcomp*(c: var CatWalk, name: string, refcomp_json: string, keep: bool) =
-  let tbl = refcomp_json.fromJson(Table[string, seq[int]])
+  c.register_sample(c.to_internal(sample_from_refcomp(refcomp_json, c.max_n_positions, c.reference_sequence.len, c.packed_diffsets)), name)
 
-  if tbl["N"].len > c.max_n_positions:
-    var sample = new_Sample()
-    sample.status = TooManyNs
-    c.register_sample(sample, name)
-    return
+# stores a sample copied from another store, keeping the status it had there
+proc add_sample_from_refcomp*(c: var CatWalk, name: string, refcomp_json: string, status: SampleStatus) =
+  var sample = sample_from_refcomp(refcomp_json, c.max_n_positions, c.reference_sequence.len, c.packed_diffsets)
+  if status != Ok:
+    sample = new_Sample(c.packed_diffsets)
+    sample.status = status
+  c.register_sample(c.to_internal(sample), name)
 
-  var sample = new_Sample()
-  sample.status = Ok
-  sample.n_positions = toIntSet(tbl["N"])
+#
+# Rereference
+#
 
-  sample.diffsets[0] = tbl["A"]
-  sample.diffsets[1] = tbl["C"]
-  sample.diffsets[2] = tbl["G"]
-  sample.diffsets[3] = tbl["T"]
-  sample.diffsets[0].sort()
-  sample.diffsets[1].sort()
-  sample.diffsets[2].sort()
-  sample.diffsets[3].sort()
+# re-encodes the store against a consensus of its Ok samples: each position
+# gets the most common base among the samples without an N there. Samples
+# then only store the differences from the consensus, which shortens the
+# diffsets of differences most samples share. Distances don't change, so
+# neither does the index. Returns the number of positions at which the
+# consensus differs from the reference.
+proc rereference*(c: var CatWalk): int =
+  var
+    counts = initTable[int, array[5, int]]()
+    n_ok = 0
+  for profile_id, sample in c.profiles.pairs:
+    if sample.status != Ok:
+      continue
+    let weight = c.profile_samples[profile_id].len
+    n_ok += weight
+    for (base, position) in sample.diffsets.base_positions:
+      counts.mgetOrPut(position, [0, 0, 0, 0, 0])[base] += weight
+  # Ns only matter where some sample differs from the current reference
+  for profile_id, sample in c.profiles.pairs:
+    if sample.status != Ok:
+      continue
+    let weight = c.profile_samples[profile_id].len
+    for position in sample.n_positions:
+      if counts.hasKey(position):
+        counts[position][4] += weight
 
-  c.register_sample(sample, name)
+  var
+    consensus = c.internal_reference
+    changed = initIntSet()
+  for position, n in counts.pairs:
+    if c.reference_sequence[position] notin {'A', 'C', 'G', 'T'}:
+      continue
+    let unchanged = n_ok - n[0] - n[1] - n[2] - n[3] - n[4]
+    var best = 0
+    for base in 1..3:
+      if n[base] > n[best]:
+        best = base
+    if n[best] > unchanged:
+      consensus[position] = "ACGT"[best]
+      changed.incl(position)
+
+  if changed.len > 0:
+    c.profile_ids.clear()
+    if c.use_dense:
+      c.dense.reference = new_DenseSequence(consensus)
+      c.dense.data.setLen(0)
+    for profile_id, sample in c.profiles.mpairs:
+      sample = rebase(sample, c.internal_reference, consensus, changed)
+      c.profile_ids.mgetOrPut(hash(sample), @[]).add(profile_id)
+      c.signatures.set_signature(profile_id, make_signature(sample, c.signature_block))
+      c.store_dense(profile_id, sample)
+    # an index compares against its tombstones too
+    for profile_id, sample in c.tombstones.mpairs:
+      sample = rebase(sample, c.internal_reference, consensus, changed)
+      c.signatures.set_signature(profile_id, make_signature(sample, c.signature_block))
+      c.store_dense(profile_id, sample)
+    c.internal_reference = consensus
+    c.rebased_positions = initIntSet()
+    for position in 0..consensus.high:
+      if consensus[position] != c.reference_sequence[position]:
+        c.rebased_positions.incl(position)
+  return c.rebased_positions.len
+
+#
+# Index
+#
+
+const index_min_backlog = 1000
+
+# the number of profiles not in the index, which are scanned linearly
+proc index_backlog*(c: CatWalk): int =
+  if c.index != nil: c.unindexed.len else: c.profiles.len
+
+# the number of profiles in the index, not counting tombstones
+proc index_size*(c: CatWalk): int =
+  if c.index != nil: c.index.len - c.index.removed.len else: 0
+
+# drops a tombstone no index refers to any more
+proc release_tombstone(c: var CatWalk, profile_id: int) =
+  c.tombstones.del(profile_id)
+  if profile_id < c.dense.data.len:
+    c.dense.data[profile_id] = DenseSequence()
+  c.free_profile_ids.add(profile_id)
+
+proc start_index_build(c: var CatWalk) =
+  # a build started again drops the tombstones only it had
+  if c.index_building != nil:
+    for profile_id in c.index_building.removed:
+      if c.index == nil or profile_id notin c.index.removed:
+        c.release_tombstone(profile_id)
+  var ids: seq[int]
+  for profile_id, sample in c.profiles.pairs:
+    if sample.status == Ok:
+      ids.add(profile_id)
+  ids.sort()
+  c.index_building = new_VPTree(ids)
+
+# advances the index build by about budget comparisons, starting a build
+# once the profiles added and removed since the last one reach
+# index_min_backlog or a tenth of the index. Returns true if a build is
+# still in progress.
+proc index_step*(c: var CatWalk, budget: int = 20000): bool =
+  if not c.use_index:
+    return false
+  if c.index_building == nil:
+    if c.index_backlog + c.tombstones.len < max(index_min_backlog, c.index_size div 10):
+      return false
+    c.start_index_build()
+  let
+    samples = c.profiles
+    tombstones = c.tombstones
+    dense_store = c.dense
+    reflen = c.reference_sequence.len
+  if c.index_building.build_step(
+      proc (a: int, b: int): int =
+        dense_store.profile_distance(indexed_profile(samples, tombstones, a)[], dense_store.stored_dense(a), b,
+                                     indexed_profile(samples, tombstones, b)[], reflen),
+      proc (profile_id: int): int = indexed_profile(samples, tombstones, profile_id)[].n_positions.len,
+      budget):
+    let old = c.index
+    c.index = c.index_building
+    c.index_building = nil
+    if old != nil:
+      for profile_id in old.removed:
+        if profile_id notin c.index.removed:
+          c.release_tombstone(profile_id)
+    c.unindexed = initIntSet()
+    for profile_id, sample in c.profiles.pairs:
+      if sample.status == Ok and profile_id notin c.index:
+        c.unindexed.incl(profile_id)
+    echo "built index over " & $c.index_size & " profiles"
+    return false
+  return true
+
+# builds the index over every profile now, however small the backlog
+proc build_index*(c: var CatWalk) =
+  c.use_index = true
+  c.start_index_build()
+  while c.index_step(high(int)):
+    discard
+
+#
+# Memory
+#
+
+const
+  SeqHeaderBytes = 2 * sizeof(int)
+  IntSetSmallElems = 34 # IntSets up to this size are stored inline
+  IntSetTrunkBytes = 96 # next pointer, key, 512 bits and the gc header
+
+proc seq_bytes[T](xs: seq[T]): int =
+  if xs.len == 0: 0 else: SeqHeaderBytes + xs.len * sizeof(T)
+
+proc string_bytes(s: string): int =
+  SeqHeaderBytes + s.len + 1
+
+proc table_bytes(n_entries: int, entry_bytes: int): int =
+  let slots = nextPowerOfTwo(n_entries + n_entries div 2 + 4)
+  SeqHeaderBytes + slots * entry_bytes
+
+proc intset_bytes(s: IntSet): int =
+  if s.len <= IntSetSmallElems:
+    return 0
+  var trunks = initIntSet()
+  for x in s:
+    trunks.incl(x shr 9)
+  let slots = max(8, nextPowerOfTwo(trunks.len + trunks.len div 2 + 4))
+  trunks.len * IntSetTrunkBytes + SeqHeaderBytes + slots * sizeof(pointer)
+
+proc memory_breakdown*(c: CatWalk): MemoryBreakdown =
+  ## Walk the store and estimate the heap bytes used by each component.
+  ## Sequence capacities and allocator rounding are not visible, so these are
+  ## lower bounds; the remainder shows up as the gap to getOccupiedMem().
+  ## A profile shared by several samples, with its signature and any dense
+  ## copy, is split evenly between them in the per-sample figures.
+  const
+    profile_entry_bytes = sizeof(Hash) + sizeof(int) + sizeof(Sample)
+    index_entry_bytes = sizeof(Hash) + 2 * sizeof(int)
+    name_entry_bytes = sizeof(Hash) + sizeof(int) + sizeof(string)
+  var
+    per_sample: seq[float]
+    members_bytes = 0
+  for profile_id, sample in c.profiles.pairs:
+    var
+      diffsets_bytes = 0
+    for i in 0..3:
+      diffsets_bytes += seq_bytes(sample.diffsets.by_base[i])
+    diffsets_bytes += seq_bytes(sample.diffsets.codes)
+    let
+      n_bytes = intset_bytes(sample.n_positions)
+      members = c.profile_samples[profile_id]
+      # the profile's slots in the stores indexed by profile id
+      store_bytes = 2 * signature_blocks * sizeof(uint16) +
+                    (if profile_id < c.dense.data.len: c.dense.data[profile_id].bytes else: 0)
+      profile_bytes = diffsets_bytes + n_bytes + store_bytes + profile_entry_bytes + seq_bytes(members)
+    result.diffsets += diffsets_bytes
+    result.n_positions += n_bytes
+    members_bytes += seq_bytes(members)
+    for index in members:
+      var sample_bytes = profile_bytes.float / members.len.float + index_entry_bytes.float
+      if c.all_sample_names.contains(index):
+        let name_bytes = 2 * (name_entry_bytes + string_bytes(c.all_sample_names[index]))
+        result.name_tables += name_bytes
+        sample_bytes += name_bytes.float
+      per_sample.add(sample_bytes)
+  for sample in c.tombstones.values:
+    for i in 0..3:
+      result.diffsets += seq_bytes(sample.diffsets.by_base[i])
+    result.diffsets += seq_bytes(sample.diffsets.codes)
+    result.n_positions += intset_bytes(sample.n_positions)
+  result.sample_table = table_bytes(c.profiles.len, profile_entry_bytes) +
+                        table_bytes(c.tombstones.len, profile_entry_bytes) +
+                        seq_bytes(c.free_profile_ids) + intset_bytes(c.unindexed) +
+                        table_bytes(c.profile_samples.len, index_entry_bytes) + members_bytes +
+                        table_bytes(c.profile_of.len, index_entry_bytes) +
+                        table_bytes(c.profile_ids.len, index_entry_bytes)
+  result.name_tables += table_bytes(c.all_sample_indexes.len, name_entry_bytes) +
+                        table_bytes(c.all_sample_names.len, name_entry_bytes)
+  result.signatures = seq_bytes(c.signatures.data)
+  result.dense = seq_bytes(c.dense.data)
+  for d in c.dense.data:
+    result.dense += d.bytes
+  for m in c.mutations:
+    result.mutation_log += sizeof(Mutation) + string_bytes(m.name) + intset_bytes(m.sample.n_positions) +
+                           seq_bytes(m.sample.diffsets.codes)
+    for i in 0..3:
+      result.mutation_log += seq_bytes(m.sample.diffsets.by_base[i])
+  result.reference = string_bytes(c.reference_sequence) + string_bytes(c.internal_reference) +
+                     intset_bytes(c.mask.positions) + intset_bytes(c.rebased_positions)
+  if per_sample.len > 0:
+    per_sample.sort()
+    result.per_sample_mean = sum(per_sample) / per_sample.len.float
+    result.per_sample_p50 = percentile(per_sample, 50)
+    result.per_sample_p95 = percentile(per_sample, 95)
+    result.per_sample_p99 = percentile(per_sample, 99)
+    result.per_sample_max = per_sample[per_sample.high]
 
 #
 # test
 #
 when isMainModule:
+  import sequtils
+  import random
+  import json
+
   let
     mask = new_Mask("test", "0")
     rs = "AAACGT"
@@ -316,14 +1336,356 @@ when isMainModule:
   c.add_sample("s1", "AAACGT", true)
   c.add_sample("s2", "AAACGC", true)
 
+  var q = new_QueryLog(2)
+  q.add(("a", 1, 0.1, 3, 0))
+  q.add(("b", 2, 0.2, 3, 1))
+  q.add(("c", 1, 0.3, 3, 2))
+  var names: seq[string]
+  for r in q: names.add(r.sample_name)
+  assert names == @["b", "c"]
+  assert q.total == 3
+  assert q.latency_summary()[0].distance == 1
+  assert q.latency_summary()[0].p99 == 0.3
+  assert c.generation == 3
+
+  let m = c.memory_breakdown()
+  assert m.per_sample_max >= m.per_sample_p50
+  assert m.name_tables > 0
+
+  assert c.get_neighbours_from_refcomp("q", """{"A": [], "C": [5], "G": [], "T": [], "N": []}""", 0) == @[("s2", 0)]
+  assert c.get_neighbours_from_refcomp("q", """{"A": [], "C": [], "G": [], "T": [], "N": [5]}""", 0).len == 3
+  assert c.get_neighbours_from_refcomp("s0", """{"A": [], "C": [], "G": [], "T": [], "N": []}""", 0).len == 1
+
+  assert c.get_cross_distances(@["s0", "s2"], @["s1", "s2", "s0"]) == @[0, 1, 0, 1, 0, 1]
+  assert c.get_cross_distances(@["s0", "s2"], @["s1", "s2", "s0"], workers=2) == @[0, 1, 0, 1, 0, 1]
+  assert c.get_cross_distances(@["s1", "s2", "s0"], @["s0", "s2"], workers=3) == @[0, 1, 1, 0, 0, 1]
+  assert c.get_cross_distances_sparse(@["s0", "s2"], @["s1", "s2", "s0"], 0, workers=2) ==
+    @[(a: 0, b: 0, distance: 0), (a: 0, b: 2, distance: 0), (a: 1, b: 1, distance: 0)]
+  # tiles with enough comparisons are split between forked workers
+  block:
+    var many_a, many_b: seq[string]
+    for i in 0..<400: many_a.add(["s0", "s1", "s2"][i mod 3])
+    for i in 0..<300: many_b.add(["s2", "s0", "s1"][i mod 3])
+    assert c.get_cross_distances(many_a, many_b, workers=4) == c.get_cross_distances(many_a, many_b)
+    assert c.get_cross_distances_sparse(many_b, many_a, 0, workers=4) == c.get_cross_distances_sparse(many_b, many_a, 0)
+
+  assert c.get_nearest("s0", 1) == @[("s1", 0)]
+  assert c.get_nearest("s0", 2) == @[("s1", 0), ("s2", 1)]
+  assert c.get_nearest("s0", 5) == @[("s1", 0), ("s2", 1)]
+  assert c.get_nearest("s2", 1) == @[("s0", 1)]
+  assert c.get_nearest("s0", 0) == []
+
+  assert c.get_neighbour_histogram("s0", 2) == @[@["s1"], @["s2"], @[]]
+  assert c.get_neighbour_histogram("s0", -1).len == 0
+
+  let expired = new_Deadline(1e-9)
+  assert not expired.incomplete
+  for i in 1..1024: discard expired.passed
+  assert expired.incomplete
+  assert c.get_neighbours("s0", 10, expired).len == 0
+  assert c.get_pairwise_distances(@["s0", "s1", "s2"], expired).len == 0
+  assert c.get_pairwise_distances(@["s0", "s1", "s2"], new_Deadline(60)).len == 3
+  assert not new_Deadline(0).incomplete
+
   assert c.get_neighbours("s0", -1) == []
   assert c.get_neighbours("s0", 0) == [("s1", 0)]
-  assert c.get_neighbours("s0", 10) == [("s1", 0), ("s2", 1)]
+  assert c.get_neighbours("s0", 10).sorted == [("s1", 0), ("s2", 1)]
 
   c.add_sample_from_refcomp("s3", """{"A": [], "C": [], "G": [], "T": [], "N": []}""", true)
 
-  assert c.get_neighbours("s3", 10) == [("s1", 0),
-                                        ("s2", 1),
-                                        ("s0", 0)]
+  assert c.get_neighbours("s3", 10).sorted == [("s0", 0),
+                                               ("s1", 0),
+                                               ("s2", 1)]
+
+  # s0, s1 and s3 share a profile
+  assert c.profiles.len == 2
+  assert c.n_samples == 4
+  var comparisons = 0
+  discard c.process_neighbours(c.get_sample("s2"), c.all_sample_indexes["s2"], 10, comparisons, nil)
+  assert comparisons == 2
+
+  c.remove_sample("s0")
+  assert c.profiles.len == 2
+  assert c.sample_status(0) == Removed
+  assert c.get_neighbours("s3", 10).sorted == [("s1", 0), ("s2", 1)]
+  c.remove_sample("s1")
+  c.remove_sample("s3")
+  assert c.profiles.len == 1
+  assert c.profile_ids.len == 1
+  assert c.get_neighbours("s2", 10) == []
+
+  # the ids of dropped profiles are reused, so the stores indexed by them
+  # stay the size of the most profiles held at once
+  block:
+    var cr = new_CatWalk("testcw", "testref", "AAAAAAAAAA", mask, 130000)
+    for i in 0..<50:
+      var sequence = "AAAAAAAAAA"
+      sequence[i mod 10] = 'C'
+      sequence[(i div 10) mod 10] = 'G'
+      cr.add_sample("x" & $i, sequence, true)
+      if i >= 2:
+        cr.remove_sample("x" & $(i - 2))
+    assert cr.profiles.len == 2
+    assert cr.next_profile_id <= 3
+    assert cr.signatures.data.len <= 3 * 2 * signature_blocks
+    assert cr.get_neighbours("x49", 10).len == 1
+
+  # the index gives the same neighbours, exactly, in spite of Ns
+  block:
+    var ci = new_CatWalk("indexed", "testref", "AAAAAAAAAAAAAAAAAAAA", new_Mask("test", "0"), 130000)
+    var rng = 17
+    for i in 0..<300:
+      var sequence = "AAAAAAAAAAAAAAAAAAAA"
+      for j in 1..<sequence.len:
+        rng = (rng * 1103515245 + 12345) mod 2147483648
+        case rng mod 7
+        of 0: sequence[j] = 'C'
+        of 1: sequence[j] = 'N'
+        of 2: sequence[j] = 'G'
+        else: discard
+      ci.add_sample("r" & $i, sequence, true)
+    var unindexed: seq[seq[(string, int)]]
+    for i in 0..<20:
+      unindexed.add(ci.get_neighbours("r" & $i, 3).sorted)
+    ci.build_index()
+    assert ci.index != nil and ci.index.len > 100
+    for i in 0..<20:
+      assert ci.get_neighbours("r" & $i, 3).sorted == unindexed[i]
+    ci.add_sample("late", "AAAAAAAAAAAAAAAAAAAA", true)
+    assert ci.index_backlog == 1
+    assert ci.get_nearest("late", 1).len == 1
+    assert ("late", ci.get_nearest("late", 1)[0][1]) in ci.get_neighbours(ci.get_nearest("late", 1)[0][0], 20)
+    # removed profiles stay in the index as tombstones until it is rebuilt
+    let r0_profile_shared = ci.profile_samples[ci.profile_of[ci.all_sample_indexes["r0"]]].len > 1
+    ci.remove_sample("r0")
+    assert ci.index != nil
+    assert (ci.tombstones.len == 1) != r0_profile_shared
+    assert ci.get_neighbours("r1", 3).sorted == unindexed[1].filterIt(it[0] != "r0")
+    proc scanned(ci: var CatWalk, name: string): seq[(string, int)] =
+      let index = ci.index
+      ci.index = nil
+      result = ci.get_neighbours(name, 3).sorted
+      ci.index = index
+    for i in 1..<20:
+      ci.remove_sample("r" & $i)
+    for i in 20..<40:
+      assert ci.get_neighbours("r" & $i, 3).sorted == ci.scanned("r" & $i)
+    # a profile removed during a rebuild is a tombstone of the new index,
+    # and the others are dropped with the old one
+    ci.start_index_build()
+    ci.remove_sample("r20")
+    while ci.index_step(100):
+      discard
+    assert ci.tombstones.len <= 1 and ci.index.removed.len == ci.tombstones.len
+    for i in 21..<40:
+      assert ci.get_neighbours("r" & $i, 3).sorted == ci.scanned("r" & $i)
+
+    # a profile added since the build, even under a reused id, is scanned
+    let free_before = ci.free_profile_ids.len
+    ci.add_sample("late2", "ATTTTTTTTTTTTTTTTTTT", true)
+    assert free_before > 0 and ci.free_profile_ids.len == free_before - 1
+    ci.add_sample("late3", "ATTTTTTTTTTTTTTTTTTA", true)
+    assert ci.get_neighbours("late2", 3).sorted == ci.scanned("late2")
+    assert ci.get_neighbours("late2", 3) == @[("late3", 1)]
+
+  # signature bounds never exceed the distance, and reject distant samples
+  block:
+    var
+      rng = initRand(7)
+      seqs: seq[string]
+    let rs = "ACGT".repeat(50)
+    var cs = new_CatWalk("testcw", "testref", rs, new_Mask("test", "0"), 130000)
+    assert cs.signature_block == 4
+    for i in 0..<40:
+      var s = rs
+      for j in 0..<rng.rand(30):
+        s[rng.rand(s.len - 1)] = "ACGTN"[rng.rand(4)]
+      seqs.add(s)
+      cs.add_sample("g" & $i, s, true)
+    for i in 0..<seqs.len:
+      let
+        x = cs.get_sample("g" & $i)
+        q = make_signature(x, cs.signature_block)
+      for j in 0..<seqs.len:
+        let
+          y_id = cs.profile_of[cs.all_sample_indexes["g" & $j]]
+          y = cs.profiles[y_id]
+          d = count_diff2(x.diffsets, y.diffsets, x.n_positions, y.n_positions, rs.len)
+        assert cs.signatures.signature_bound(q, y_id) <= d
+    # Ns in the query's block don't hide its differences from the reference
+    var far = rs
+    for p in 4..<16: far[p] = 'N'
+    for p in 12..<15: far[p] = "CGTA"[p mod 4]
+    cs.add_sample("far", far, true)
+    cs.add_sample("ref", rs, true)
+    let
+      ref_id = cs.profile_of[cs.all_sample_indexes["ref"]]
+      far_q = make_signature(cs.get_sample("far"), cs.signature_block)
+    assert cs.signatures.signature_bound(far_q, ref_id) == 3
+    assert cs.get_neighbours("far", 2).allIt(it[0] != "ref")
+    assert ("ref", 3) in cs.get_neighbours("far", 3)
+
+  # the packed layout gives the same distances as the per-base one
+  block:
+    var rng = initRand(11)
+    let rs = "ACGT".repeat(25)
+    var
+      cu = new_CatWalk("unpacked", "testref", rs, new_Mask("test", "0"), 130000)
+      cp = new_CatWalk("packed", "testref", rs, new_Mask("test", "0"), 130000, packed_diffsets = true)
+    for i in 0..<30:
+      var s = rs
+      for j in 0..<rng.rand(15):
+        s[rng.rand(s.len - 1)] = "ACGTN"[rng.rand(4)]
+      cu.add_sample("p" & $i, s, true)
+      cp.add_sample("p" & $i, s, true)
+      assert cp.get_sample("p" & $i).diffsets.packed
+      assert recover_sequence_str(rs, cp.mask.positions, cp.get_sample("p" & $i).diffsets, cp.get_sample("p" & $i).n_positions) ==
+             recover_sequence_str(rs, cu.mask.positions, cu.get_sample("p" & $i).diffsets, cu.get_sample("p" & $i).n_positions)
+    for i in 0..<30:
+      for d in [0, 2, 8]:
+        assert cp.get_neighbours("p" & $i, d).sorted == cu.get_neighbours("p" & $i, d).sorted
+    assert cp.get_sample_counts("p3") == cu.get_sample_counts("p3")
+    let refcomp = """{"A": [6], "C": [4], "G": [], "T": [1], "N": [9]}"""
+    assert cp.get_neighbours_from_refcomp("q", refcomp, 5).sorted == cu.get_neighbours_from_refcomp("q", refcomp, 5).sorted
+    assert sample_from_refcomp(refcomp, 10, rs.len, true).diffsets[1] == @[4]
+
+  # dense copies give the same distances, whichever pairs use them
+  block:
+    var rng = initRand(13)
+    let rs = "ACGT".repeat(40)
+    var
+      cu = new_CatWalk("sparse", "testref", rs, new_Mask("test", "0"), 130000)
+      cd = new_CatWalk("dense", "testref", rs, new_Mask("test", "0"), 130000, use_dense = true)
+      names: seq[string]
+    assert cd.use_dense
+    for i in 0..<30:
+      var s = rs
+      for j in 0..<rng.rand(if i mod 3 == 0: 60 else: 3):
+        s[rng.rand(s.len - 1)] = "ACGTN"[rng.rand(4)]
+      cu.add_sample("d" & $i, s, true)
+      cd.add_sample("d" & $i, s, true)
+      names.add("d" & $i)
+    var n_dense = 0
+    for d in cd.dense.data:
+      if d.words > 0: inc n_dense
+    assert n_dense > 0 and n_dense < cd.profiles.len
+    assert cd.get_cross_distances(names, names) == cu.get_cross_distances(names, names)
+    assert cd.get_cross_distances(names, names, 5) == cu.get_cross_distances(names, names, 5)
+    for name in names:
+      assert cd.get_neighbours(name, 10).sorted == cu.get_neighbours(name, 10).sorted
+      assert cd.get_nearest(name, 3) == cu.get_nearest(name, 3)
+    assert cd.memory_breakdown().dense > 0
+    let d0_profile = cd.profile_of[cd.all_sample_indexes["d0"]]
+    assert cd.dense.stored_dense(d0_profile).words > 0
+    if cd.profile_samples[d0_profile].len == 1:
+      cd.remove_sample("d0")
+      assert cd.dense.stored_dense(d0_profile).words == 0
+    # close to a long reference, merging is cheaper within the cutoff and
+    # dense copies would be far larger than the diff lists
+    var long = new_CatWalk("long", "testref", "ACGT".repeat(7500), new_Mask("test", ""), 130000, use_dense = true)
+    for (name, n_diffs) in [("near", 65), ("far", 1000)]:
+      var s = "ACGT".repeat(7500)
+      for j in 0..<n_diffs:
+        s[j * 29] = if s[j * 29] == 'A': 'C' else: 'A'
+      long.add_sample(name, s, true)
+    assert long.dense.stored_dense(long.profile_of[long.all_sample_indexes["near"]]).words == 0
+    assert long.dense.stored_dense(long.profile_of[long.all_sample_indexes["far"]]).words > 0
+    # Ns in the reference can't be stored densely
+    assert not new_CatWalk("n", "testref", "ACGTN", new_Mask("test", ""), 10, use_dense = true).use_dense
+
+  # rereferencing shortens diffsets without changing what the API reports
+  block:
+    var rng = initRand(17)
+    let rs = "ACGT".repeat(30)
+    var
+      lineage = rs
+      names: seq[string]
+    for p in [3, 10, 50, 51, 90]:
+      lineage[p] = 'A'
+    for packed in [false, true]:
+      var
+        cr = new_CatWalk("rebased", "testref", rs, new_Mask("test", "0"), 130000, packed_diffsets = packed, use_dense = true)
+        seqs: seq[string]
+      names.setLen(0)
+      for i in 0..<25:
+        var s = if i < 20: lineage else: rs
+        for j in 0..<rng.rand(4):
+          s[rng.rand(s.len - 1)] = "ACGTN"[rng.rand(4)]
+        seqs.add(s)
+        cr.add_sample("r" & $i, s, true)
+        names.add("r" & $i)
+      let
+        distances = cr.get_cross_distances(names, names)
+        counts = cr.get_sample_counts("r0")
+        before = cr.memory_breakdown().diffsets
+      assert cr.rereference() == 5
+      assert cr.rebased_positions.len == 5
+      assert cr.memory_breakdown().diffsets < before
+      assert cr.get_cross_distances(names, names) == distances
+      assert cr.get_sample_counts("r0") == counts
+      for i, s in seqs:
+        let x = cr.external_sample("r" & $i)
+        assert recover_sequence_str(rs, cr.mask.positions, x.diffsets, x.n_positions) ==
+               recover_sequence_str(rs, cr.mask.positions, reference_compress(s, rs, cr.mask, 130000).diffsets, x.n_positions)
+      # samples added afterwards are encoded against the consensus
+      cr.add_sample("late", seqs[0], true)
+      assert ("late", 0) in cr.get_neighbours("r0", 0)
+      cr.add_sample_from_refcomp("late2", """{"A": [3, 10, 50, 51, 90], "C": [], "G": [], "T": [], "N": []}""", true)
+      assert cr.get_sample("late2").diffsets.len == 0
+      assert cr.get_neighbours_from_refcomp("q", """{"A": [3, 10, 50, 51, 90], "C": [], "G": [], "T": [], "N": []}""", 0).len ==
+             cr.get_neighbours("late2", 0).len + 1
+
+  # replaying the mutation log reproduces the store
+  block:
+    let rs = "ACGTACGTAC"
+    var
+      primary = new_CatWalk("primary", "testref", rs, new_Mask("test", ""), 3, mutation_log_size = 3)
+      follower = new_CatWalk("follower", "testref", rs, new_Mask("test", ""), 3)
+    assert primary.mutations_since_available(0)
+    primary.add_sample("m1", "ACGTACGTAA", true)
+    primary.add_sample("m2", "NNNNACGTAC", true)
+    primary.add_sample("m3", "ACGTACGTAC", true)
+    primary.remove_sample("m1")
+    assert not primary.mutations_since_available(0)
+    assert primary.mutations_since_available(1)
+    assert not primary.mutations_since_available(5)
+    follower.add_sample("m1", "ACGTACGTAA", true)
+    for m in primary.mutations_since(1):
+      if m.removed:
+        follower.remove_sample(m.name)
+      else:
+        let refcomp = $(%*{ "A": m.sample.diffsets[0], "C": m.sample.diffsets[1], "G": m.sample.diffsets[2],
+                            "T": m.sample.diffsets[3], "N": toSeq(m.sample.n_positions.items) })
+        follower.add_sample_from_refcomp(m.name, refcomp, m.sample.status)
+    assert follower.n_samples == 2
+    assert follower.get_sample("m2").status == TooManyNs
+    assert follower.get_neighbours("m3", 5) == primary.get_neighbours("m3", 5)
+
+  # adding a name again replaces the sample
+  c.add_sample("s2", "AAACGT", true)
+  c.add_sample("s4", "AAACGT", true)
+  assert c.n_samples == 2
+  assert c.profiles.len == 1
+  assert c.get_neighbours("s2", 10) == [("s4", 0)]
+  var indexes: seq[int]
+  for index in c.sample_indexes: indexes.add(index)
+  assert indexes == @[4, 5]
+
+  # refcomp_json is read back unchanged, with positions sorted
+  block:
+    var s = sample_from_refcomp("""{"A": [9, 3], "C": [], "G": [5], "T": [], "N": [8, 2, 20]}""", 100, 30)
+    assert s.refcomp_json == """{"N":[2,8,20],"A":[3,9],"C":[],"G":[5],"T":[]}"""
+    assert sample_from_refcomp(s.refcomp_json, 100, 30, true).refcomp_json == s.refcomp_json
+
+  # positions outside the reference are rejected
+  block:
+    for refcomp in ["""{"A": [30], "C": [], "G": [], "T": [], "N": []}""",
+                    """{"A": [], "C": [], "G": [], "T": [], "N": [-1]}"""]:
+      var raised = false
+      try:
+        discard sample_from_refcomp(refcomp, 100, 30)
+      except ValueError:
+        raised = true
+      assert raised
 
   echo "Tests passed."
@@ -7,18 +7,97 @@ import system
 import os
 import times
 import strformat
+import httpcore
+import endians
+import cpuinfo
+import macros
+import posix
+import asyncdispatch
+import httpclient except request
+import sets
+import algorithm
+import uri
+import std/exitprocs
 
 import catwalk
 import fasta
+import samplewriter
+import npyexport
 
 import jester
 import cligen
 
 var c: CatWalk
+# the other stores served by this process, by name, under /i/<name>/. The
+# store a request is for is swapped into c while it is handled.
+var instances: OrderedTable[string, CatWalk]
+# processes forked for cross distance requests
+var compute_workers = 1
+# seconds allowed for a scan if the request doesn't say; 0 means no limit
+var default_deadline = 0.0
 
 const compile_version = gorge "git describe --tags --always --dirty"
 const compile_time = gorge "date --rfc-3339=seconds"
 
+# with --readers, this process applies writes on --writer-port, and forked
+# reader processes, each a copy-on-write snapshot of it, answer on
+# --bind-port. Readers redirect writes here.
+var
+  n_readers = 0
+  is_reader = false
+  # the writer's pid, which readers inherit, so clients can find the
+  # server process from any /info answer
+  server_pid = getCurrentProcessId()
+  reader_pids: seq[Pid]
+  # readers replaced by a later publish, finishing their requests
+  retiring_pids: seq[Pid]
+  reader_settings: Settings
+  writer_port = 0
+  # writes since the readers were forked
+  unpublished = false
+  # in a reader: set by SIGUSR1 when newer readers have taken over
+  retiring = false
+  retired_at = 0.0
+  last_request_at = 0.0
+
+# a retired reader exits once it has answered no requests for
+# reader_drain_seconds, or at the first gap between requests after
+# reader_retire_seconds, so keep-alive clients move to the newer readers
+const
+  reader_drain_seconds = 0.25
+  reader_retire_seconds = 5.0
+
+# index builds advance by index_tick_budget comparisons every
+# index_tick_ms, a few milliseconds of work on large stores
+const
+  index_tick_ms = 20
+  index_tick_budget = 2000
+
+# with --follow, this server copies the store of another (the primary) and
+# applies its inserts and removals as they happen. Writes are redirected
+# to the primary.
+var
+  follow_url = ""
+  follow_interval = 0.5
+  # the primary's generation this store has caught up to, and the latest
+  # seen there
+  followed_generation = -1
+  primary_generation = -1
+  caught_up_at = 0.0
+  # the boot_id of the primary run the store was copied from; generations
+  # of another run aren't comparable
+  primary_boot_id = ""
+  # how many mutations each store logs for followers (--mutation-log-size)
+  # once one has started copying it
+  mutation_log_limit = 0
+
+proc prctl(option: cint, arg2: culong): cint {.importc, header: "<sys/prctl.h>".}
+const PR_SET_PDEATHSIG = 1.cint
+var SO_ACCEPTCONN {.importc, header: "<sys/socket.h>".}: cint
+
+# distinguishes generations of different server runs
+let boot_id = $getTime().toUnix() & "." & $getCurrentProcessId()
+
 
 template check_param(p: string) =
   if not js.contains(p):
@@ -35,28 +114,106 @@ proc add_samples_from_multifasta_singleline(filepath: string) =
   for (header, sequence) in parse_multifasta_singleline_file(filepath):
     let my_header = header.replace("/", "_")[1.. header.high]
     c.add_sample(my_header, sequence, true)
+    discard c.index_step()
     if i mod 1000 == 0:
       echo fmt"added {i} samples"
     i = i + 1
   echo fmt"added {i} samples in {cpuTime() - time_now} seconds."
 
 
-var n_pos_buf: seq[int]
+proc sample_refcomp(s: Sample): JsonNode =
+  var n_positions: seq[int]
+  for x in s.n_positions:
+    n_positions.add(x)
+  n_positions.sort()
+  %*{ "N": n_positions,
+      "A": s.diffsets[0],
+      "C": s.diffsets[1],
+      "G": s.diffsets[2],
+      "T": s.diffsets[3] }
+
 #
-# write sample reference compressed sequence to a file instance_name/sample_name
+# queue sample reference compressed sequence to be written to a file
+# instance_name/sample_name (see samplewriter.nim)
 #
+var pending_saves = new_SampleWriter()
+
 proc save_sample_refcomp(name: string) =
-  if not existsDir(c.name):
-    createDir(c.name)
-  let s = c.active_samples[c.all_sample_indexes[name]]
-  n_pos_buf.setLen(0)
-  for x in s.n_positions:
-    n_pos_buf.insert(x)
-  writeFile(c.name & "/" & name, $(%*{ "N": n_pos_buf,
-                                       "A": s.diffsets[0],
-                                       "C": s.diffsets[1],
-                                       "G": s.diffsets[2],
-                                       "T": s.diffsets[3] }))
+  pending_saves.save(c.name, name, c.external_sample(name))
+
+# set by SIGTERM and SIGINT; the next save_tick writes the queued samples
+# and exits
+var stop_requested = false
+
+proc request_stop(sig: cint) {.noconv.} =
+  stop_requested = true
+
+proc save_tick(fd: AsyncFD): bool {.gcsafe.} =
+  {.cast(gcsafe).}:
+    try:
+      discard pending_saves.flush()
+    except CatchableError as e:
+      echo "saving samples failed: " & e.msg
+      if stop_requested:
+        quit(1)
+    if stop_requested:
+      echo "stopping"
+      quit(0)
+
+#
+# the store generation, as an ETag for conditional requests
+#
+proc generation_tag(): string =
+  "\"" & boot_id & "-" & c.name & "-" & $c.generation & "\""
+
+template resp_tagged(code: HttpCode, content: string, content_type = "text/html;charset=utf-8") =
+  resp code, [("ETag", generation_tag()),
+              ("X-Catwalk-Generation", $c.generation),
+              ("Content-Type", content_type)], content
+
+# the seconds a request gives its scan: ?deadline=<seconds> or an
+# X-Catwalk-Deadline header, else --deadline, where 0 means no limit.
+# Raises ValueError if the request's value isn't a positive number.
+proc deadline_seconds(request: Request): float =
+  var given = ""
+  if request.params.hasKey("deadline"):
+    given = request.params["deadline"]
+  elif request.headers.hasKey("X-Catwalk-Deadline"):
+    given = request.headers["X-Catwalk-Deadline"]
+  else:
+    return default_deadline
+  result = given.parseFloat
+  if not (result > 0 and result < Inf):
+    raise newException(ValueError, "not a positive number: " & given)
+
+# the deadline for a request's scan. Responds 400 to an invalid deadline.
+template request_deadline(request: Request): Deadline =
+  var seconds: float
+  try:
+    seconds = deadline_seconds(request)
+  except ValueError:
+    resp Http400, "Invalid deadline: " & getCurrentExceptionMsg()
+  new_Deadline(seconds)
+
+# responds with the result of a scan. If the deadline cut the scan short,
+# the partial result is sent untagged (so it isn't cached) and marked with
+# X-Catwalk-Complete: false, or with ?partial=0, a 503 is sent instead.
+template resp_scan(deadline: Deadline, content: string, content_type: string) =
+  if deadline.incomplete:
+    if request.params.getOrDefault("partial") == "0":
+      resp Http503, "Deadline exceeded"
+    resp Http200, [("X-Catwalk-Complete", "false"),
+                   ("Content-Type", content_type)], content
+  resp_tagged Http200, content, content_type
+
+proc follow_info(): JsonNode =
+  if follow_url == "":
+    return newJNull()
+  %*{ "primary": follow_url,
+      "generation": followed_generation,
+      "primary_generation": primary_generation,
+      "lag_generations": max(primary_generation - followed_generation, 0),
+      "lag_seconds": (if followed_generation >= 0: epochTime() - caught_up_at else: -1.0) }
 
 proc route_info(): JsonNode =
   %*{ "name": c.name,
@@ -65,22 +222,226 @@ proc route_info(): JsonNode =
       "mask_name": c.mask.name,
       "mask_positions": c.mask.positions.len,
       "max_n_positions": c.max_n_positions,
+      "packed_diffsets": c.packed_diffsets,
+      "dense": c.use_dense,
+      "rebased_positions": c.rebased_positions.len,
+      "readers": n_readers,
+      "is_reader": is_reader,
+      "server_pid": server_pid,
+      "retiring_readers": retiring_pids.len,
+      "follow": follow_info(),
+      "unsaved_samples": pending_saves.len,
+      "dropped_samples": pending_saves.dropped,
+      "save_error": pending_saves.last_error,
+      "saves_samples": not defined(no_serialisation),
       "total_mem": getTotalMem(),
       "occupied_mem": getOccupiedMem(),
-      "n_samples": c.active_samples.len,
+      "n_samples": c.n_samples,
+      "n_profiles": c.profiles.len,
+      "generation": c.generation,
+      "generation_tag": generation_tag(),
+      "index": { "enabled": c.use_index,
+                 "approximate": c.index_approximate,
+                 "profiles": c.index_size,
+                 "backlog": c.index_backlog,
+                 "tombstones": c.tombstones.len,
+                 "building": c.index_building != nil },
       "compile_version": compile_version,
       "compile_time": compile_time
     }
 
-router app:
+proc route_memory(n_more: int): JsonNode =
+  let
+    m = c.memory_breakdown()
+    total_mem = getTotalMem()
+    occupied_mem = getOccupiedMem()
+    accounted = m.diffsets + m.n_positions + m.signatures + m.dense + m.mutation_log + m.sample_table +
+                m.name_tables + m.reference
+    projected_occupied = occupied_mem.float + n_more.float * m.per_sample_mean
+    overhead_ratio = if occupied_mem > 0: total_mem.float / occupied_mem.float else: 1.0
+  %*{ "n_samples": c.n_samples,
+      "total_mem": total_mem,
+      "occupied_mem": occupied_mem,
+      "free_mem": getFreeMem(),
+      "components": { "diffsets": m.diffsets,
+                      "n_positions": m.n_positions,
+                      "signatures": m.signatures,
+                      "dense": m.dense,
+                      "mutation_log": m.mutation_log,
+                      "sample_table": m.sample_table,
+                      "name_tables": m.name_tables,
+                      "reference_and_mask": m.reference,
+                      "unaccounted": occupied_mem - accounted,
+                      "allocator_overhead": total_mem - occupied_mem },
+      "per_sample": { "mean": m.per_sample_mean,
+                      "p50": m.per_sample_p50,
+                      "p95": m.per_sample_p95,
+                      "p99": m.per_sample_p99,
+                      "max": m.per_sample_max },
+      "projection": { "additional_samples": n_more,
+                      "occupied_mem": projected_occupied.int,
+                      "total_mem": (projected_occupied * overhead_ratio).int }
+    }
+
+# the request's path and query string, to redirect it elsewhere. The
+# instance is already in the path.
+proc path_and_query(request: Request): string =
+  var query: seq[(string, string)]
+  for key, value in request.params:
+    if key != "instance":
+      query.add((key, value))
+  result = request.path
+  if query.len > 0:
+    result.add("?" & encodeQuery(query))
+
+# starts a route only the writer can answer. Readers redirect it there.
+template writer_route() =
+  if is_reader:
+    let host = request.headers.getOrDefault("Host").split(':')[0]
+    resp Http307, [("Location", "http://" & host & ":" & $writer_port & path_and_query(request))], ""
+
+# starts a route that changes a store. Followers redirect it to the
+# primary and readers to the writer.
+template write_route() =
+  if follow_url != "":
+    resp Http307, [("Location", follow_url & path_and_query(request))], ""
+  writer_route()
+  unpublished = true
+
+#
+# instances
+#
+
+# runs body with c set to the store called instance_name
+template with_instance(instance_name: string, body: untyped) =
+  let name = instance_name
+  if name == c.name:
+    body
+  elif not instances.hasKey(name):
+    resp Http404, "Instance " & name & " doesn't exist"
+  else:
+    swap(c, instances[name])
+    try:
+      body
+    finally:
+      swap(c, instances[name])
+
+# routes about the whole process, not served per instance
+const shared_routes = ["/metrics"]
+
+# a jester router with every route in body, and each route that isn't
+# shared also under /i/@instance, handled by that instance
+macro instance_router(name: untyped, body: untyped): untyped =
+  var routes = newStmtList()
+  for route in body:
+    # retiring readers wait for requests to stop arriving (see reader_tick)
+    if route.kind == nnkCommand and route.len == 3:
+      route[2].insert(0, quote do:
+        last_request_at = epochTime())
+    routes.add(route)
+  for route in body:
+    if route.kind == nnkCommand and route.len == 3 and route[1].kind == nnkStrLit and
+       route[1].strVal notin shared_routes:
+      let
+        route_body = route[2]
+        prefixed = copyNimTree(route)
+      prefixed[1] = newLit("/i/@instance" & route[1].strVal)
+      prefixed[2] = quote do:
+        with_instance(@"instance"):
+          `route_body`
+      routes.add(prefixed)
+  result = newTree(nnkCommand, ident("router"), name, routes)
+
+proc metric_value(store: CatWalk, metric: string): string =
+  case metric
+    of "catwalk_samples": $store.n_samples
+    of "catwalk_profiles": $store.profiles.len
+    of "catwalk_generation": $store.generation
+    of "catwalk_queries_total": $store.query_log.total
+    of "catwalk_index_profiles": $store.index_size
+    else: raise newException(ValueError, "unknown metric: " & metric)
+
+proc latency_lines(store: CatWalk): string =
+  for s in store.query_log.latency_summary():
+    for (quantile, value) in [("0.5", s.p50), ("0.95", s.p95), ("0.99", s.p99)]:
+      result.add(fmt"""catwalk_neighbours_latency_seconds{{instance="{store.name}",distance="{s.distance}",quantile="{quantile}"}} {value}""" & "\n")
+
+# Prometheus text format metrics for every instance
+proc route_metrics(): string =
+  const metrics = [("catwalk_samples", "gauge", "samples stored"),
+                   ("catwalk_profiles", "gauge", "distinct sample profiles stored"),
+                   ("catwalk_generation", "gauge", "inserts and removals since start"),
+                   ("catwalk_queries_total", "counter", "neighbour queries since start"),
+                   ("catwalk_index_profiles", "gauge", "profiles in the neighbour index")]
+  for (metric, kind, help) in metrics:
+    result.add(fmt"# HELP {metric} {help}" & "\n")
+    result.add(fmt"# TYPE {metric} {kind}" & "\n")
+    result.add(fmt"""{metric}{{instance="{c.name}"}} {c.metric_value(metric)}""" & "\n")
+    for store in instances.values:
+      result.add(fmt"""{metric}{{instance="{store.name}"}} {store.metric_value(metric)}""" & "\n")
+  result.add("# HELP catwalk_neighbours_latency_seconds recent neighbour query latency, by distance\n")
+  result.add("# TYPE catwalk_neighbours_latency_seconds gauge\n")
+  result.add(c.latency_lines())
+  for store in instances.values:
+    result.add(store.latency_lines())
+  result.add("# HELP catwalk_workers processes forked for cross distance requests\n")
+  result.add("# TYPE catwalk_workers gauge\n")
+  result.add(fmt"catwalk_workers {compute_workers}" & "\n")
+  result.add("# TYPE catwalk_occupied_mem_bytes gauge\n")
+  result.add(fmt"catwalk_occupied_mem_bytes {getOccupiedMem()}" & "\n")
+  result.add("# TYPE catwalk_total_mem_bytes gauge\n")
+  result.add(fmt"catwalk_total_mem_bytes {getTotalMem()}" & "\n")
+
+instance_router app:
+  get "/metrics":
+    resp Http200, route_metrics(), "text/plain; version=0.0.4"
+
   get "/info":
     resp route_info()
 
+  get "/memory":
+    var n_more = 0
+    if request.params.contains("n"):
+      try:
+        n_more = request.params["n"].parseInt()
+      except ValueError:
+        resp Http400, "n must be an integer"
+      if n_more < 0:
+        resp Http400, "n can't be negative"
+    resp route_memory(n_more)
+
   get "/debug":
     resp %*($c)
 
+  # latest query time per sample, kept in this shape for benchmark/bench.py
   get "/neighbours_times":
-    resp %*(c.neighbours_times)
+    var ret = initTable[string, float]()
+    for r in c.query_log:
+      ret[r.sample_name] = r.latency
+    resp %*(ret)
+
+  get "/neighbours_latency":
+    var distances = newJObject()
+    for s in c.query_log.latency_summary():
+      distances[$s.distance] = %*{ "count": s.count,
+                                   "p50": s.p50,
+                                   "p95": s.p95,
+                                   "p99": s.p99,
+                                   "max": s.max }
+    resp %*{ "capacity": c.query_log.capacity,
+             "recorded": c.query_log.records.len,
+             "total_queries": c.query_log.total,
+             "distances": distances }
+
+  get "/query_log":
+    var ret = newJArray()
+    for r in c.query_log:
+      ret.add(%*{ "sample_name": r.sample_name,
+                  "distance": r.distance,
+                  "latency": r.latency,
+                  "candidates": r.candidates,
+                  "hits": r.hits })
+    resp ret
 
   get "/sample_counts/@name":
     resp %*(c.get_sample_counts(@"name"))
@@ -89,22 +450,21 @@ router app:
     resp %*(c.dump_sample(@"name"))
 
   post "/clear_neighbours_times":
-    c.neighbours_times = initTable[string, float]()
+    c.query_log.clear()
     resp Http200, "ok"
 
   get "/list_samples":
     var
       ret = newJArray()
-    for k in c.active_samples.keys:
-      if c.active_samples[k].status != Removed:
-        ret.add(%*c.all_sample_names[k])
+    for k in c.sample_indexes:
+      ret.add(%*c.all_sample_names[k])
     resp ret
 
   get "/list_ok_samples":
     var
       ret = newJArray()
-    for k in c.active_samples.keys:
-      if c.active_samples[k].status == Ok:
+    for k in c.sample_indexes:
+      if c.get_sample(k).status == Ok:
         ret.add(%*c.all_sample_names[k])
     resp ret
 
@@ -117,19 +477,35 @@ router app:
       j = parseInt(@"to")
     if i < 0:
       i = 0
-    if j >= len(c.active_samples):
-      j = len(c.active_samples)
     var
       r = newJArray()
-    for k in i..<j:
-      r.add(%*c.all_sample_names[k])
+      n = 0
+    for k in c.sample_indexes:
+      if n >= j:
+        break
+      if n >= i:
+        r.add(%*c.all_sample_names[k])
+      inc n
     resp %*(r)
 
+  # builds the neighbour index now rather than between requests
+  post "/build_index":
+    write_route()
+    c.build_index()
+    resp Http200, $c.index_size
+
+  # re-encode the store against a consensus of its samples
+  post "/rereference":
+    write_route()
+    resp Http200, $c.rereference()
+
   get "/remove_sample/@name":
+    write_route()
     c.remove_sample(@"name")
-    resp Http200, "removed " & @"name"
+    resp_tagged Http200, "removed " & @"name"
 
   post "/add_sample":
+    write_route()
     let
       js = parseJson(request.body)
 
@@ -142,11 +518,15 @@ router app:
       sequence = js["sequence"].getStr()
 
     if c.all_sample_indexes.contains(name):
-      let index = c.all_sample_indexes[name]
-      let sample = c.active_samples[index]
+      let sample = c.get_sample(name)
       if sample.status == Ok:
         resp Http200, fmt"Sample {name} already exists (status: {sample.status})"
 
+    # refused before it is stored, rather than stored and not saved
+    when not defined(no_serialisation):
+      if pending_saves.full:
+        resp Http503, "Samples can't be saved: " & pending_saves.last_error
+
     c.add_sample(name, sequence, true)
 
     when defined(no_serialisation):
@@ -159,26 +539,106 @@ router app:
     #  deepCopy sq, sequence
     #  c.add_sample(name & "-" & $i, sq, true)
 
-    resp Http201, fmt"Added {name}"
+    resp_tagged Http201, fmt"Added {name}"
 
   post "/add_sample_from_refcomp":
+    write_route()
     let
       js = parseJson(request.body)
       name = js["name"].getStr()
       refcomp = js["refcomp"].getStr()
 
     if c.all_sample_indexes.contains(name):
-      let index = c.all_sample_indexes[name]
-      let sample = c.active_samples[index]
+      let sample = c.get_sample(name)
       if sample.status == Ok:
         resp Http200, fmt"Sample {name} already exists (status: {sample.status})"
 
-    add_sample_from_refcomp(name, refcomp, true)
-    resp Http201, "Added " & name
+    try:
+      add_sample_from_refcomp(name, refcomp, true)
+    except ValueError:
+      resp Http400, getCurrentExceptionMsg()
+    resp_tagged Http201, "Added " & name
+
+  get "/get_refcomp/@name":
+    if not c.all_sample_indexes.contains(@"name"):
+      resp Http404, "Sample " & @"name" & " doesn't exist"
+    let sample = c.external_sample(@"name")
+    var ret = sample_refcomp(sample)
+    ret["status"] = %*($sample.status)
+    resp ret
+
+  # the inserts and removals after generation since, for followers
+  get "/mutations":
+    writer_route()
+    let
+      since = request.params.getOrDefault("since", "0").parseInt
+      limit = request.params.getOrDefault("limit", "1000").parseInt
+    if not c.mutations_since_available(since):
+      resp Http410, "Mutations since generation " & $since & " are no longer logged"
+    var ret = newJArray()
+    for m in c.mutations_since(since):
+      if ret.len >= limit:
+        break
+      var js = if m.removed: newJObject() else: sample_refcomp(m.sample)
+      js["generation"] = %m.generation
+      js["name"] = %m.name
+      js["op"] = %(if m.removed: "remove" else: "add")
+      js["status"] = %($m.sample.status)
+      ret.add(js)
+    resp %*{ "boot_id": boot_id, "generation": c.generation, "mutations": ret }
+
+  # up to limit samples with internal indexes above after, in index order,
+  # for followers to copy. Indexes are stable, so paging doesn't skip
+  # samples when others are removed.
+  get "/refcomps":
+    writer_route()
+    # a follower copies the store before reading mutations, so the log
+    # is only kept once one has
+    if c.mutation_log_size == 0 and mutation_log_limit > 0:
+      c.mutation_log_size = mutation_log_limit
+      echo fmt"{c.name}: logging the last {mutation_log_limit} mutations for followers"
+    let
+      after = request.params.getOrDefault("after", "-1").parseInt
+      limit = request.params.getOrDefault("limit", "1000").parseInt
+    var
+      samples = newJArray()
+      last = after
+    for index in max(after + 1, 0)..<c.next_sample_index:
+      if samples.len >= limit:
+        break
+      if c.sample_status(index) == Removed:
+        continue
+      let sample = c.external_sample(index)
+      var js = sample_refcomp(sample)
+      js["name"] = %c.all_sample_names[index]
+      js["status"] = %($sample.status)
+      samples.add(js)
+      last = index
+    resp %*{ "boot_id": boot_id, "generation": c.generation, "last": last, "samples": samples }
+
+  # neighbours of a sample given as a refcomp, which need not be stored here
+  post "/neighbours_from_refcomp":
+    let
+      js = parseJson(request.body)
+    check_param "name"
+    check_param "refcomp"
+    check_param "distance"
+    let deadline = request_deadline(request)
+    var ns: seq[(string, int)]
+    try:
+      ns = c.get_neighbours_from_refcomp(js["name"].getStr(), js["refcomp"].getStr(), js["distance"].getInt(), deadline)
+    except ValueError:
+      resp Http400, getCurrentExceptionMsg()
+    var
+      ret = newJArray()
+    for n in ns:
+      ret.add(%*[n[0], $n[1]])
+    resp_scan deadline, $ret, "application/json"
 
   # mfsl - multifasta singleline
   # (sequence data on a single line, no line breaks)
   post "/add_samples_from_mfsl":
+    write_route()
     let js = request.body.fromJson(Table[string, string])
     let filepath = js["filepath"]
     add_samples_from_multifasta_singleline(filepath)
@@ -186,17 +646,85 @@ router app:
 
   post "/get_pairwise_distances":
     let sample_names = request.body.fromJson(seq[string])
-    let data = c.get_pairwise_distances(sample_names)
+    let deadline = request_deadline(request)
+    let data = c.get_pairwise_distances(sample_names, deadline)
     var ret = newJArray()
     for n in data:
       ret.add(%*[n[0], n[1], $n[2]])
-    resp(Http200, $(%*(ret)), content_type="application/json")
+    resp_scan deadline, $(%*(ret)), "application/json"
+
+  # the distances of get_pairwise_distances, without the names, as
+  # little-endian int32s: (0,1), (0,2), ..., (0,n-1), (1,2), ...
+  # Pairs not reached before the deadline are -1.
+  post "/get_pairwise_distances_condensed":
+    let sample_names = request.body.fromJson(seq[string])
+    let deadline = request_deadline(request)
+    let data = c.get_pairwise_distances(sample_names, deadline)
+    let n_pairs = sample_names.len * (sample_names.len - 1) div 2
+    var ret = newString(n_pairs * 4)
+    for i in 0..<n_pairs:
+      var d = if i < data.len: data[i][2].int32 else: -1'i32
+      littleEndian32(ret[i * 4].addr, d.addr)
+    resp_scan deadline, ret, "application/octet-stream"
+
+
+  # distances between two lists of samples. body: {"a": [...], "b": [...]}
+  # and optionally "cutoff": int, "sparse": bool. Dense responses are
+  # little-endian int32s in row-major order: (a0,b0), (a0,b1), ..., (a1,b0),
+  # ..., with distances above the cutoff reported as cutoff + 1. Sparse
+  # responses are little-endian int32 triples (index in a, index in b,
+  # distance) of the pairs within the cutoff.
+  post "/get_cross_distances":
+    let js = parseJson(request.body)
+    if not js.hasKey("a") or not js.hasKey("b"):
+      resp Http400, "Missing a or b"
+    let
+      names_a = js["a"].to(seq[string])
+      names_b = js["b"].to(seq[string])
+      cutoff = js{"cutoff"}.getInt(-1)
+      sparse = js{"sparse"}.getBool(false)
+    if sparse and cutoff < 0:
+      resp Http400, "sparse requires a cutoff"
+    for name in names_a & names_b:
+      if not c.all_sample_indexes.hasKey(name):
+        resp Http404, &"No such sample: {name}"
+    var ret: string
+    if sparse:
+      let data = c.get_cross_distances_sparse(names_a, names_b, cutoff, compute_workers)
+      ret = newString(data.len * 12)
+      for i, n in data:
+        var triple = [n.a.int32, n.b.int32, n.distance.int32]
+        for k in 0..2:
+          littleEndian32(ret[i * 12 + k * 4].addr, triple[k].addr)
+    else:
+      let data = c.get_cross_distances(names_a, names_b, cutoff, compute_workers)
+      ret = newString(data.len * 4)
+      for i, n in data:
+        var d = n.int32
+        littleEndian32(ret[i * 4].addr, d.addr)
+    resp(Http200, ret, content_type="application/octet-stream")
+
+  # writes the whole store as .npy files to path, a directory relative to
+  # the server's (default <instance name>_export), see npyexport.nim.
+  # Readers can answer this, so exports don't hold up writes.
+  post "/export":
+    let
+      js = if request.body.len > 0: parseJson(request.body) else: newJObject()
+      path = js{"path"}.getStr(c.name & "_export")
+    if path.len == 0 or path.isAbsolute or ".." in path.split({'/', '\\'}):
+      resp Http400, "path must be relative to the server directory and can't contain .."
+    let t0 = epochTime()
+    var n: int
+    try:
+      n = c.export_store(path)
+    except ValueError:
+      resp Http400, getCurrentExceptionMsg()
+    resp %*{ "path": path, "n_samples": n, "generation": c.generation, "seconds": epochTime() - t0 }
 
 
   get "/get_sequence_str":
     let sample_name = request.params["sample_name"]
-    let index = c.all_sample_indexes[sample_name]
-    let sample = c.active_samples[index]
+    let sample = c.external_sample(sample_name)
     resp Http200, recover_sequence_str(c.reference_sequence, c.mask.positions, sample.diffsets, sample.n_positions)
 
 
@@ -204,58 +732,386 @@ router app:
     if not c.all_sample_indexes.contains(@"name"):
       resp Http404, "Sample " & @"name" & " doesn't exist"
 
+    # nothing has been added or removed since the client's copy
+    let if_none_match: string = request.headers.getOrDefault("If-None-Match")
+    if if_none_match == generation_tag():
+      resp_tagged Http304, ""
+
     let
       distance = @"distance".parseInt
-      ns = c.get_neighbours(@"name", distance)
+      deadline = request_deadline(request)
+      ns = c.get_neighbours(@"name", distance, deadline)
     var
       ret = newJArray()
     for n in ns:
       ret.add(%*[n[0], $n[1]])
-    resp ret
+    resp_scan deadline, $ret, "application/json"
+
+  # the number of samples at each distance 0..distance, from one scan.
+  # ?names=1 also returns the names at each distance.
+  get "/neighbour_histogram/@name/@distance":
+    if not c.all_sample_indexes.contains(@"name"):
+      resp Http404, "Sample " & @"name" & " doesn't exist"
+    let
+      deadline = request_deadline(request)
+      histogram = c.get_neighbour_histogram(@"name", @"distance".parseInt, deadline)
+    var
+      counts: seq[int]
+    for names in histogram:
+      counts.add(names.len)
+    var ret = %*{ "counts": counts }
+    if request.params.getOrDefault("names") == "1":
+      ret["names"] = %histogram
+    resp_scan deadline, $ret, "application/json"
+
+  # the k nearest samples, sorted by distance then name
+  get "/nearest/@name/@k":
+    if not c.all_sample_indexes.contains(@"name"):
+      resp Http404, "Sample " & @"name" & " doesn't exist"
+    let
+      deadline = request_deadline(request)
+      ns = c.get_nearest(@"name", @"k".parseInt, deadline)
+    var
+      ret = newJArray()
+    for n in ns:
+      ret.add(%*[n[0], $n[1]])
+    resp_scan deadline, $ret, "application/json"
 
 #
 # load all compressed sequences saved by save_sample_refcomp
 #
-proc load_instance_samples() =
-  if existsDir(c.name):
+#
+# follower
+#
+
+proc follow_get(client: AsyncHttpClient, path: string): Future[JsonNode] {.async.} =
+  let r = await client.get(follow_url & path)
+  let body = await r.body
+  if r.code == Http410:
+    return nil
+  if r.code != Http200:
+    raise newException(IOError, follow_url & path & " answered " & $r.code)
+  return parseJson(body)
+
+# stores a sample as sent by the primary's /refcomps or /mutations
+proc apply_refcomp(js: JsonNode) =
+  var refcomp = newJObject()
+  for base in ["A", "C", "G", "T", "N"]:
+    refcomp[base] = js[base]
+  c.add_sample_from_refcomp(js["name"].getStr(), $refcomp, parseEnum[SampleStatus](js["status"].getStr()))
+
+# copies the primary's store a page at a time, then drops samples the
+# primary no longer has. Changes made while copying are replayed from the
+# generation of the first page.
+proc copy_primary(client: AsyncHttpClient) {.async.} =
+  var
+    after = -1
+    first_generation = -1
+    seen = initHashSet[string]()
+  while true:
+    let js = await client.follow_get("/refcomps?after=" & $after & "&limit=1000")
+    if first_generation < 0:
+      first_generation = js["generation"].getInt()
+      primary_boot_id = js["boot_id"].getStr()
+    elif js["boot_id"].getStr() != primary_boot_id:
+      raise newException(IOError, "the primary restarted while it was being copied")
+    if js["samples"].len == 0:
+      break
+    for sample in js["samples"]:
+      seen.incl(sample["name"].getStr())
+      apply_refcomp(sample)
+    after = js["last"].getInt()
+  var stale: seq[string]
+  for name in c.all_sample_indexes.keys:
+    if name notin seen:
+      stale.add(name)
+  for name in stale:
+    c.remove_sample(name)
+  followed_generation = first_generation
+  caught_up_at = epochTime()
+  unpublished = true
+  echo fmt"copied {seen.len} samples from {follow_url}"
+
+proc follow_primary() {.async.} =
+  let client = newAsyncHttpClient()
+  var copied = false
+  while true:
+    try:
+      if not copied:
+        await client.copy_primary()
+        copied = true
+      let js = await client.follow_get("/mutations?since=" & $followed_generation & "&limit=1000")
+      if js == nil:
+        echo "the primary no longer logs the mutations this store needs; copying it again"
+        copied = false
+        continue
+      # a restarted primary may have other samples at the same generation
+      if js["boot_id"].getStr() != primary_boot_id:
+        echo "the primary restarted; copying it again"
+        copied = false
+        continue
+      primary_generation = js["generation"].getInt()
+      for m in js["mutations"]:
+        let name = m["name"].getStr()
+        if m["op"].getStr() == "remove":
+          if c.all_sample_indexes.hasKey(name):
+            c.remove_sample(name)
+        else:
+          apply_refcomp(m)
+        followed_generation = m["generation"].getInt()
+        unpublished = true
+      if followed_generation == primary_generation:
+        caught_up_at = epochTime()
+        await sleepAsync(max(int(follow_interval * 1000), 1))
+    except CatchableError as e:
+      echo "following " & follow_url & " failed: " & e.msg
+      await sleepAsync(max(int(follow_interval * 1000), 1))
+
+#
+# readers
+#
+
+# the sockets this process has open
+proc open_sockets(): seq[cint] =
+  for kind, path in walkDir("/proc/self/fd"):
+    var fd: cint
+    try:
+      fd = parseInt(extractFilename(path)).cint
+    except ValueError:
+      continue
+    var st: Stat
+    if fstat(fd, st) == 0 and S_ISSOCK(st.st_mode):
+      result.add(fd)
+
+proc is_listening(fd: cint): bool =
+  var
+    accepting: cint
+    size = sizeof(accepting).SockLen
+  getsockopt(fd.SocketHandle, SOL_SOCKET, SO_ACCEPTCONN, accepting.addr, size.addr) == 0 and accepting != 0
+
+proc retire(sig: cint) {.noconv.} =
+  retiring = true
+
+# timer callback in readers. Once retired, a reader closes its listening
+# socket, so new connections go to the newer readers, then exits (see
+# reader_drain_seconds). Requests run to completion first, as timers only
+# run between them.
+proc reader_tick(fd: AsyncFD): bool {.gcsafe.} =
+  {.cast(gcsafe).}:
+    if not retiring:
+      return false
+    if retired_at == 0.0:
+      retired_at = epochTime()
+      for socket in open_sockets():
+        if is_listening(socket):
+          discard posix.close(socket)
+    let now = epochTime()
+    if now - max(retired_at, last_request_at) > reader_drain_seconds or
+       now - retired_at > reader_retire_seconds:
+      exitnow(0)
+
+proc serve_reader() =
+  is_reader = true
+  # readers have nothing to save, so stop at once
+  discard signal(SIGTERM, SIG_DFL)
+  discard signal(SIGINT, SIG_DFL)
+  discard signal(SIGUSR1, retire)
+  # don't outlive the writer
+  discard prctl(PR_SET_PDEATHSIG, SIGTERM.culong)
+  # the writer's listening socket and connections are its own
+  for socket in open_sockets():
+    discard posix.close(socket)
+  setGlobalDispatcher(newDispatcher())
+  addTimer(100, false, reader_tick)
+  var jester = initJester(app, settings=reader_settings)
+  jester.serve()
+  exitnow(0)
+
+# forks n_readers processes serving the stores as they are now, then
+# retires the previous ones, which finish the requests they have and exit.
+# The kernel shares memory between the writer and its readers until one of
+# them writes to it.
+proc publish_readers() =
+  var pids: seq[Pid]
+  for i in 0..<n_readers:
+    let pid = fork()
+    if pid < 0:
+      echo "could not fork a reader: " & osErrorMsg(osLastError())
+      break
+    if pid == 0:
+      serve_reader()
+    pids.add(pid)
+  if pids.len == 0:
+    return
+  for pid in reader_pids:
+    discard kill(pid, SIGUSR1)
+    retiring_pids.add(pid)
+  reader_pids = pids
+  unpublished = false
+
+# reaps the retired readers that have exited
+proc reap_readers() =
+  var running: seq[Pid]
+  for pid in retiring_pids:
+    var status: cint
+    if waitpid(pid, status, WNOHANG) == 0:
+      running.add(pid)
+  retiring_pids = running
+
+# timer callback in the writer
+proc publish_tick(fd: AsyncFD): bool {.gcsafe.} =
+  {.cast(gcsafe).}:
+    if is_reader:
+      return true
+    reap_readers()
+    if unpublished:
+      publish_readers()
+
+# advances a store's index build by a slice (see index_step). A finished
+# build is published to the readers like a write.
+proc step_index(store: var CatWalk) =
+  let building = store.index_building != nil
+  if not store.index_step(index_tick_budget) and building:
+    unpublished = true
+
+# runs index builds between requests, whether or not there are writes
+proc index_tick(fd: AsyncFD): bool {.gcsafe.} =
+  {.cast(gcsafe).}:
+    if is_reader:
+      return true
+    step_index(c)
+    for store in instances.mvalues:
+      step_index(store)
+
+proc load_instance_samples(store: var CatWalk) =
+  if existsDir(store.name):
     var i = 0
-    for kind, path in walkDir(c.name):
+    for kind, path in walkDir(store.name):
       if i %% 1000 == 0:
         echo "loaded " & $i & " cached files"
       i = i + 1
-      c.add_sample_from_refcomp(extractFilename(path), readFile(path), true)
+      store.add_sample_from_refcomp(extractFilename(path), readFile(path), true)
     echo "loaded " & $i & " cached files"
 
+# a store, with the samples saved in its instance directory loaded
+proc open_instance(instance_name: string,
+                   reference_filepath: string,
+                   mask_filepath: string,
+                   max_n_positions: int,
+                   query_log_size: int,
+                   index: bool,
+                   index_approximate: bool,
+                   packed_diffsets: bool,
+                   dense: bool,
+                   dense_cutoff: int,
+                   rereference: bool,
+                   load_samples: bool): CatWalk =
+  let
+    (_, refseq) = parse_fasta_file(reference_filepath)
+    mask = new_Mask(mask_filepath, readFile(mask_filepath))
+
+  result = new_CatWalk(instance_name, reference_filepath, refseq, mask, max_n_positions, query_log_size, packed_diffsets, dense,
+                       dense_cutoff = dense_cutoff)
+  echo fmt"{instance_name}: mask positions: {mask.positions.len}"
+  echo fmt"{instance_name}: max unknown non-masked positions: {max_n_positions}"
+
+  when defined(no_serialisation):
+    echo "skipping loading instance files because this catwalk was built with -d:no_serialisation"
+  when not defined(no_serialisation):
+    if load_samples:
+      echo "loading instance files. To skip this build with -d:no_serialisation"
+      load_instance_samples(result)
+
+  if rereference:
+    echo fmt"{instance_name}: rereferenced at {result.rereference()} positions"
+
+  result.use_index = index
+  result.index_approximate = index_approximate
+  if index:
+    result.build_index()
+
 proc main(bind_host: string = "0.0.0.0",
           bind_port: int = 5000,
           instance_name: string,
           reference_filepath: string,
           mask_filepath: string,
-          max_n_positions: int = 130000) =
+          max_n_positions: int = 130000,
+          query_log_size: int = 10000,
+          workers: int = 0,
+          deadline: float = 0.0,
+          index: bool = false,
+          index_approximate: bool = false,
+          packed_diffsets: bool = false,
+          dense: bool = false,
+          dense_cutoff: int = 20,
+          rereference: bool = false,
+          instances_filepath: string = "",
+          readers: int = 0,
+          writer_port: int = 0,
+          publish_interval: float = 1.0,
+          mutation_log_size: int = 10000,
+          follow: string = "",
+          follow_interval: float = 0.5,
+          save_interval: float = 0.2,
+          save_queue: int = 10000,
+          fsync: SyncPolicy = SyncNone) =
   echo "starting cw_server " & compile_version &
     " (build time: " & compile_time & ")"
 
-  let
-    (_, refseq) = parse_fasta_file(reference_filepath)
-    mask = new_Mask(mask_filepath, readFile(mask_filepath))
-
-  c = new_CatWalk(instance_name, reference_filepath, refseq, mask, max_n_positions)
-  echo fmt"mask positions: {mask.positions.len}"
-  echo fmt"max unknown non-masked positions: {max_n_positions}"
+  compute_workers = if workers > 0: workers else: countProcessors()
+  default_deadline = deadline
+  mutation_log_limit = mutation_log_size
+  c = open_instance(instance_name, reference_filepath, mask_filepath, max_n_positions, query_log_size,
+                    index, index_approximate, packed_diffsets, dense, dense_cutoff, rereference,
+                    load_samples = follow == "")
 
-  when defined(no_serialisation):
-    echo "skipping loading instance files because this catwalk was built with -d:no_serialisation"
-  when not defined(no_serialisation):
-    echo "loading instance files. To skip this build with -d:no_serialisation"
-    load_instance_samples()
+  # more stores, as a JSON array of objects with instance_name,
+  # reference_filepath, mask_filepath and optionally max_n_positions. The
+  # other settings are shared.
+  if instances_filepath != "":
+    for js in parseFile(instances_filepath):
+      let name = js["instance_name"].getStr()
+      if name == instance_name or instances.hasKey(name):
+        quit fmt"instance {name} is given more than once"
+      instances[name] = open_instance(name, js["reference_filepath"].getStr(), js["mask_filepath"].getStr(),
+                                      js{"max_n_positions"}.getInt(max_n_positions), query_log_size,
+                                      index, index_approximate, packed_diffsets, dense,
+                                      dense_cutoff, rereference, load_samples = true)
 
   when not defined(release):
     echo "this catwalk was not built with -d:release. We recommend using -d:release for better performance"
   when not defined(danger):
     echo "this catwalk was not built with -d:danger. We recommend using -d:danger for better performance"
 
+  if readers > 0:
+    n_readers = readers
+    cw_server.writer_port = if writer_port > 0: writer_port else: bind_port + 1
+    reader_settings = newSettings(bindAddr=bind_host, port=bind_port.Port, reusePort=true)
+    publish_readers()
+    echo fmt"{readers} readers on port {bind_port}, writer on port {cw_server.writer_port}"
+    # readers pick up writes once per publish_interval
+    addTimer(max(int(publish_interval * 1000), 1), false, publish_tick)
+
+  addTimer(index_tick_ms, false, index_tick)
+
+  # new samples are saved in batches every save_interval seconds, and any
+  # still queued on exit, including on SIGTERM and SIGINT
+  pending_saves = new_SampleWriter(fsync, save_queue)
+  addTimer(max(int(save_interval * 1000), 1), false, save_tick)
+  addExitProc(proc () = discard pending_saves.flush())
+  discard signal(SIGTERM, request_stop)
+  discard signal(SIGINT, request_stop)
+
+  # a follower starts empty, copies the primary's store and then keeps up
+  # with its changes
+  if follow != "":
+    follow_url = follow.strip(leading = false, chars = {'/'})
+    cw_server.follow_interval = follow_interval
+    echo fmt"following {follow_url}"
+    asyncCheck follow_primary()
+
   var
-    port = bind_port.Port
+    port = (if readers > 0: cw_server.writer_port else: bind_port).Port
     settings = newSettings(bindAddr=bind_host, port=port)
     jester = initJester(app, settings=settings)
   jester.serve()
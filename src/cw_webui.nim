@@ -44,7 +44,9 @@ router app:
       sample = parseJson(r1.body)
       r2 = client.request(cw_server_url() & "/neighbours/" & @"sample_name" & "/20")
       neighbours = parseJson(r2.body)
-    resp generateSamplePage(sample, neighbours)
+      r3 = client.request(cw_server_url() & "/nearest/" & @"sample_name" & "/10")
+      nearest = parseJson(r3.body)
+    resp generateSamplePage(sample, neighbours, nearest)
 
 proc main(bind_host: string = "0.0.0.0", bind_port: int = 5001, cw_server_host = "127.0.0.1", cw_server_port = 5000) =
   var
@@ -0,0 +1,87 @@
+## This module contains a 2-bit packed representation of whole sequences,
+## for samples far from the reference.
+##
+## Each position takes two bits (A, C, G, T = 0..3), 32 positions to a
+## word, and N positions are flagged in a parallel bitmap that uses the
+## low bit of each pair. The distance between two sequences is then a
+## popcount over the XOR of their words, with the Ns of either masked
+## out, and costs the same however many differences they have.
+
+import bitops
+
+type
+  DenseSequence* = object
+    bits: seq[uint64]
+    n_bits: seq[uint64]
+
+const even_bits = 0x5555555555555555'u64
+
+proc base_code(base: char): int {.inline.} =
+  case base:
+    of 'C', 'c': 1
+    of 'G', 'g': 2
+    of 'T', 't': 3
+    else: 0
+
+# a sequence of sequence.len positions, all set to their base in sequence.
+# Anything other than ACGT is stored as A.
+proc new_DenseSequence*(sequence: string): DenseSequence =
+  let words = (sequence.len + 31) div 32
+  result.bits = newSeq[uint64](words)
+  result.n_bits = newSeq[uint64](words)
+  for i, base in sequence:
+    result.bits[i shr 5] = result.bits[i shr 5] or (base_code(base).uint64 shl (2 * (i and 31)))
+
+# the number of words; 0 for an empty DenseSequence
+proc words*(d: DenseSequence): int =
+  d.bits.len
+
+proc bytes*(d: DenseSequence): int =
+  8 * (d.bits.len + d.n_bits.len)
+
+proc set_base*(d: var DenseSequence, position: int, base: int) {.inline.} =
+  let shift = 2 * (position and 31)
+  d.bits[position shr 5] = (d.bits[position shr 5] and not (3'u64 shl shift)) or (base.uint64 shl shift)
+
+proc set_n*(d: var DenseSequence, position: int) {.inline.} =
+  d.n_bits[position shr 5] = d.n_bits[position shr 5] or (1'u64 shl (2 * (position and 31)))
+
+# the number of positions at which x and y have different bases and neither
+# is N. Stops at max_distance + 1.
+proc dense_distance*(x: DenseSequence, y: DenseSequence, max_distance: int): int =
+  for w in 0..<x.bits.len:
+    let
+      diff = x.bits[w] xor y.bits[w]
+      differing = (diff or (diff shr 1)) and even_bits and not (x.n_bits[w] or y.n_bits[w])
+    result += popcount(differing)
+    if result > max_distance:
+      return max_distance + 1
+
+when isMainModule:
+  let reference = "ACGTACGTACGTACGTACGTACGTACGTACGTACGTA"
+  var
+    x = new_DenseSequence(reference)
+    y = new_DenseSequence(reference)
+  assert x.words == 2
+  assert dense_distance(x, y, 100) == 0
+
+  x.set_base(0, 3)
+  x.set_base(33, 0)
+  y.set_base(36, 1)
+  assert dense_distance(x, y, 100) == 3
+  assert dense_distance(x, y, 1) == 2
+
+  # a difference at an N position is ignored, from either side
+  y.set_n(0)
+  assert dense_distance(x, y, 100) == 2
+  x.set_n(36)
+  assert dense_distance(x, y, 100) == 1
+
+  # bases that differ in only the high bit are counted
+  var z = new_DenseSequence(reference)
+  z.set_base(1, 3)
+  assert dense_distance(new_DenseSequence(reference), z, 100) == 1
+
+  assert dense_distance(new_DenseSequence("ACGTN"), new_DenseSequence("ACGTA"), 100) == 0
+
+  echo "Tests passed."
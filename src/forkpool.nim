@@ -0,0 +1,125 @@
+## This module runs work in forked child processes.
+##
+## Children see a copy-on-write snapshot of the parent's memory, so they
+## can read the sample store without locks or copying, but anything they
+## change is lost. Each child returns its result as a string over a pipe.
+
+import os
+import posix
+
+proc write_all(fd: cint, s: string): bool =
+  var written = 0
+  while written < s.len:
+    let n = posix.write(fd, s[written].unsafeAddr, s.len - written)
+    if n < 0:
+      if errno == EINTR: continue
+      return false
+    written += n
+  return true
+
+proc read_all(fd: cint): string =
+  var buf = newString(65536)
+  while true:
+    let n = posix.read(fd, buf[0].addr, buf.len)
+    if n < 0:
+      if errno == EINTR: continue
+      raiseOSError(osLastError())
+    if n == 0: break
+    let old_len = result.len
+    result.setLen(old_len + n)
+    copyMem(result[old_len].addr, buf[0].addr, n)
+
+proc reap(pid: Pid): bool =
+  var status: cint
+  while waitpid(pid, status, 0) < 0:
+    if errno != EINTR: return false
+  return WIFEXITED(status) and WEXITSTATUS(status) == 0
+
+# splits 0..<n into up to `workers` contiguous ranges, calls work(first, last)
+# for each range (last is exclusive) in a child process and returns the
+# results in range order. With one worker, work is called in this process.
+proc fork_map*(n: int, workers: int, work: proc (first: int, last: int): string) : seq[string] =
+  let workers = max(1, min(workers, n))
+  if workers == 1:
+    return @[work(0, n)]
+
+  var
+    pids: seq[Pid]
+    fds: seq[cint]
+  for w in 0..<workers:
+    let
+      first = n * w div workers
+      last = n * (w + 1) div workers
+    var fd: array[2, cint]
+    if pipe(fd) != 0:
+      let err = osLastError()
+      for i, pid in pids:
+        discard close(fds[i])
+        discard kill(pid, SIGKILL)
+        discard reap(pid)
+      raiseOSError(err)
+    let pid = fork()
+    if pid < 0:
+      let err = osLastError()
+      discard close(fd[0])
+      discard close(fd[1])
+      for i, pid in pids:
+        discard close(fds[i])
+        discard kill(pid, SIGKILL)
+        discard reap(pid)
+      raiseOSError(err)
+    if pid == 0:
+      # child: don't run the parent's exit handlers or flush its buffers
+      discard close(fd[0])
+      var code: cint = 1
+      try:
+        if write_all(fd[1], work(first, last)):
+          code = 0
+      except CatchableError:
+        discard
+      exitnow(code)
+    discard close(fd[1])
+    pids.add(pid)
+    fds.add(fd[0])
+
+  var failed = false
+  for i, pid in pids:
+    try:
+      result.add(read_all(fds[i]))
+    except OSError:
+      failed = true
+    discard close(fds[i])
+    if not reap(pid):
+      failed = true
+  if failed:
+    raise newException(IOError, "a forked worker failed")
+
+when isMainModule:
+  proc squares(first: int, last: int): string =
+    for i in first..<last:
+      result.add($(i * i) & ",")
+
+  var expected = ""
+  for i in 0..<1000:
+    expected.add($(i * i) & ",")
+
+  for workers in [1, 2, 3, 8]:
+    var got = ""
+    for s in fork_map(1000, workers, squares):
+      got.add(s)
+    assert got == expected
+
+  assert fork_map(2, 8, squares).len == 2
+  assert fork_map(0, 8, squares) == @[""]
+
+  proc fails(first: int, last: int): string =
+    if first > 0:
+      raise newException(ValueError, "failed")
+  var raised = false
+  try:
+    discard fork_map(10, 2, fails)
+  except IOError:
+    raised = true
+  assert raised
+
+  echo "Tests passed."
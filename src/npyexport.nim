@@ -0,0 +1,182 @@
+## This module exports a whole store as NumPy .npy files, for analysis
+## outside catwalk.
+##
+## An export is a directory with one array per file, so that each can be
+## memory-mapped (np.load(..., mmap_mode="r"), which doesn't work inside
+## an .npz). Samples are rows, in the order they were added:
+##
+##   meta.json                    instance, reference, generation, n_samples
+##                                and the status names
+##   names.npy, name_offsets.npy  UTF-8 names, row i is
+##                                names[name_offsets[i]:name_offsets[i + 1]]
+##   status.npy                   uint8 index into the status names
+##   <B>_positions.npy,           for B in A, C, G, T and N, the sorted
+##   <B>_offsets.npy              positions of row i are
+##                                positions[offsets[i]:offsets[i + 1]]
+##
+## Positions are against the store's reference, as in refcomps. Offsets are
+## int64 and positions int32.
+
+import os
+import json
+import algorithm
+import tables
+import intsets
+
+import catwalk
+
+const byte_order = if cpuEndian == littleEndian: "<" else: ">"
+
+# the .npy header of a 1-d array of n items
+proc npy_header(descr: string, n: int): string =
+  var header = "{'descr': '" & descr & "', 'fortran_order': False, 'shape': (" & $n & ",), }"
+  # the magic string, version and length take 10 bytes, and the data must
+  # start at a multiple of 64
+  while (10 + header.len + 1) mod 64 != 0:
+    header.add(' ')
+  header.add('\n')
+  result = "\x93NUMPY\x01\x00"
+  result.add(char(header.len and 0xff))
+  result.add(char(header.len shr 8))
+  result.add(header)
+
+proc write_npy[T](path: string, descr: string, data: openArray[T]) =
+  var f = open(path, fmWrite)
+  defer: f.close()
+  f.write(npy_header(descr, data.len))
+  if data.len > 0:
+    if f.writeBuffer(data[0].unsafeAddr, data.len * sizeof(T)) != data.len * sizeof(T):
+      raise newException(IOError, "could not write " & path)
+
+# writes every sample in the store to the directory dir, replacing any
+# export there. The export is written to a directory beside dir and moved
+# into place once whole, so dir never holds a partial export. Returns the
+# number of samples written; raises ValueError if dir exists and isn't an
+# export.
+proc export_store*(c: CatWalk, dir: string): int =
+  var
+    names = ""
+    name_offsets = @[0'i64]
+    status: seq[uint8]
+    positions: array[5, seq[int32]]
+    offsets: array[5, seq[int64]]
+  for b in 0..4:
+    offsets[b].add(0)
+  for index in c.sample_indexes:
+    let sample = c.external_sample(index)
+    names.add(c.all_sample_names[index])
+    name_offsets.add(names.len.int64)
+    status.add(sample.status.ord.uint8)
+    for b in 0..3:
+      for position in sample.diffsets[b]:
+        positions[b].add(position.int32)
+    var n_positions: seq[int]
+    for position in sample.n_positions:
+      n_positions.add(position)
+    n_positions.sort()
+    for position in n_positions:
+      positions[4].add(position.int32)
+    for b in 0..4:
+      offsets[b].add(positions[b].len.int64)
+    inc result
+
+  if existsDir(dir) and not existsFile(dir / "meta.json"):
+    for _ in walkDir(dir):
+      raise newException(ValueError, dir & " exists and isn't an export")
+
+  # unique to this process, as readers can export at the same time
+  let partial = dir.normalizedPath & ".partial-" & $getCurrentProcessId()
+  removeDir(partial)
+  createDir(partial)
+  try:
+    write_npy(partial / "names.npy", "|u1", names)
+    write_npy(partial / "name_offsets.npy", byte_order & "i8", name_offsets)
+    write_npy(partial / "status.npy", "|u1", status)
+    for b in 0..4:
+      let base = "ACGTN"[b]
+      write_npy(partial / (base & "_positions.npy"), byte_order & "i4", positions[b])
+      write_npy(partial / (base & "_offsets.npy"), byte_order & "i8", offsets[b])
+    var statuses = newJArray()
+    for s in SampleStatus:
+      statuses.add(%($s))
+    writeFile(partial / "meta.json", $(%*{ "format": 1,
+                                           "instance_name": c.name,
+                                           "reference_name": c.reference_name,
+                                           "reference_length": c.reference_sequence.len,
+                                           "generation": c.generation,
+                                           "n_samples": result,
+                                           "statuses": statuses }))
+  except CatchableError:
+    removeDir(partial)
+    raise
+  removeDir(dir)
+  moveDir(partial, dir)
+
+when isMainModule:
+  import strutils
+
+  let
+    mask = new_Mask("test", "")
+    dir = getTempDir() / "npyexport_test"
+  var c = new_CatWalk("testcw", "testref", "AAACGTAAAA", mask, 130000)
+  c.add_sample("s0", "AAACGTAAAA", true)
+  c.add_sample("s1", "ANACGCAAAG", true)
+  c.add_sample("s2", "CAACGTNNAA", true)
+  c.remove_sample("s0")
+  removeDir(dir)
+  assert c.export_store(dir) == 2
+
+  proc npy_data(path: string): string =
+    let s = readFile(path)
+    let header_len = s[8].ord + 256 * s[9].ord
+    assert (10 + header_len) mod 64 == 0
+    assert s[10 + header_len - 1] == '\n'
+    s[10 + header_len..^1]
+
+  proc int64s(path: string): seq[int64] =
+    let data = npy_data(path)
+    result.setLen(data.len div 8)
+    if data.len > 0:
+      copyMem(result[0].addr, data[0].unsafeAddr, data.len)
+
+  proc int32s(path: string): seq[int32] =
+    let data = npy_data(path)
+    result.setLen(data.len div 4)
+    if data.len > 0:
+      copyMem(result[0].addr, data[0].unsafeAddr, data.len)
+
+  assert npy_data(dir / "names.npy") == "s1s2"
+  assert int64s(dir / "name_offsets.npy") == @[0'i64, 2, 4]
+  assert npy_data(dir / "status.npy") == $char(Ok.ord) & $char(Ok.ord)
+  assert int32s(dir / "C_positions.npy") == @[5'i32, 0]
+  assert int64s(dir / "C_offsets.npy") == @[0'i64, 1, 2]
+  assert int32s(dir / "G_positions.npy") == @[9'i32]
+  assert int64s(dir / "G_offsets.npy") == @[0'i64, 1, 1]
+  assert int32s(dir / "N_positions.npy") == @[1'i32, 6, 7]
+  assert int64s(dir / "N_offsets.npy") == @[0'i64, 1, 3]
+  assert int32s(dir / "A_positions.npy").len == 0
+  assert parseFile(dir / "meta.json")["n_samples"].getInt() == 2
+
+  # a new export replaces the old one whole
+  c.remove_sample("s1")
+  assert c.export_store(dir) == 1
+  assert npy_data(dir / "names.npy") == "s2"
+  assert parseFile(dir / "meta.json")["n_samples"].getInt() == 1
+  for (_, path) in walkDir(dir.parentDir):
+    assert "npyexport_test.partial" notin path
+
+  # but a directory that isn't an export isn't touched
+  let other = getTempDir() / "npyexport_test_other"
+  createDir(other)
+  writeFile(other / "keep", "")
+  var raised = false
+  try:
+    discard c.export_store(other)
+  except ValueError:
+    raised = true
+  assert raised
+  assert existsFile(other / "keep")
+  removeDir(other)
+
+  removeDir(dir)
+  echo "Tests passed."
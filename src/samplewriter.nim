@@ -0,0 +1,162 @@
+## This module saves samples to instance directories in batches, away from
+## the request that added them.
+##
+## save queues a sample and flush writes everything queued, so an insert
+## only pays for compression and registration while the server calls flush
+## from a timer. Each flush is one group commit: all files are written,
+## then, with SyncBatch, each file and each directory written to is synced
+## once. A full queue is flushed by the save that fills it, which bounds
+## both the memory held and what a crash can lose. With SyncAlways every
+## save is written and synced before it returns. A batch that fails is
+## queued again, ahead of later saves, for the next flush.
+##
+## save never raises, so it can follow an insert. While writes fail the
+## queue stays full; callers should check full before inserting, and a
+## save to a full queue drops the oldest queued sample, counting it in
+## dropped.
+
+import os
+import posix
+
+import catwalk
+
+type
+  SyncPolicy* = enum
+    SyncNone = "none"
+    SyncBatch = "batch"
+    SyncAlways = "always"
+
+  SampleWriter* = ref object
+    policy*: SyncPolicy
+    max_queued*: int
+    queue: seq[tuple[dir: string, name: string, sample: Sample]]
+    # samples written since the writer was made
+    written*: int
+    # samples dropped from a full queue that couldn't be written
+    dropped*: int
+    # the error of the last flush that failed, or "" once one succeeds
+    last_error*: string
+
+proc new_SampleWriter*(policy: SyncPolicy = SyncBatch, max_queued: int = 10000): SampleWriter =
+  SampleWriter(policy: policy, max_queued: max(max_queued, 1))
+
+proc len*(w: SampleWriter): int =
+  w.queue.len
+
+# true if the queue is full: the last flush failed, and a save would drop
+# a queued sample
+proc full*(w: SampleWriter): bool =
+  w.queue.len >= w.max_queued
+
+proc sync_path(path: string) =
+  let fd = posix.open(path.cstring, O_RDONLY)
+  if fd < 0:
+    raiseOSError(osLastError(), path)
+  let ok = fsync(fd) == 0
+  discard posix.close(fd)
+  if not ok:
+    raiseOSError(osLastError(), path)
+
+proc write_batch(w: SampleWriter, batch: seq[tuple[dir: string, name: string, sample: Sample]]) =
+  var dirs: seq[string]
+  for (dir, name, sample) in batch:
+    if dir notin dirs:
+      if not existsDir(dir):
+        createDir(dir)
+      dirs.add(dir)
+    writeFile(dir / name, sample.refcomp_json)
+  if w.policy != SyncNone:
+    for (dir, name, _) in batch:
+      sync_path(dir / name)
+    for dir in dirs:
+      sync_path(dir)
+
+# writes every queued sample, then syncs them if the policy asks for it.
+# Returns the number written. If anything fails, the whole batch stays
+# queued and the error is raised.
+proc flush*(w: SampleWriter): int =
+  if w.queue.len == 0:
+    return 0
+  let batch = move(w.queue)
+  w.queue = @[]
+  try:
+    w.write_batch(batch)
+  except CatchableError as e:
+    w.queue = batch & w.queue
+    w.last_error = e.msg
+    raise
+  w.written += batch.len
+  w.last_error = ""
+  batch.len
+
+# queues sample to be saved as dir/name, a later save of the same name
+# overwriting it. If the queue is full and can't be written, the oldest
+# queued sample is dropped.
+proc save*(w: SampleWriter, dir: string, name: string, sample: Sample) =
+  if w.full:
+    try:
+      discard w.flush()
+    except CatchableError:
+      w.queue.delete(0)
+      inc w.dropped
+  w.queue.add((dir, name, sample))
+  if w.policy == SyncAlways or w.full:
+    try:
+      discard w.flush()
+    except CatchableError:
+      discard
+
+when isMainModule:
+  let dir = getTempDir() / "samplewriter_test"
+  removeDir(dir)
+  var s = new_Sample()
+  s.status = Ok
+
+  var w = new_SampleWriter(SyncBatch, 3)
+  w.save(dir, "a", s)
+  w.save(dir, "b", s)
+  assert w.len == 2
+  assert not existsFile(dir / "a")
+  assert w.flush() == 2
+  assert readFile(dir / "a") == s.refcomp_json
+  assert w.flush() == 0
+
+  # a full queue is flushed by the save that fills it
+  for name in ["c", "d", "e"]:
+    w.save(dir, name, s)
+  assert w.len == 0
+  assert existsFile(dir / "e")
+  assert w.written == 5
+
+  var always = new_SampleWriter(SyncAlways)
+  always.save(dir, "f", s)
+  assert existsFile(dir / "f")
+
+  # a batch that can't be written stays queued
+  let blocked = dir / "blocked"
+  writeFile(blocked, "")
+  w.save(blocked, "g", s)
+  var raised = false
+  try:
+    discard w.flush()
+  except CatchableError:
+    raised = true
+  assert raised
+  assert w.len == 1 and w.last_error != ""
+  removeFile(blocked)
+  assert w.flush() == 1
+  assert existsFile(blocked / "g")
+  assert w.last_error == ""
+
+  # while writes fail, saves don't raise and the queue stays bounded
+  writeFile(blocked & "2", "")
+  for i in 0..<10:
+    w.save(blocked & "2", "h" & $i, s)
+  assert w.len == 3 and w.full
+  assert w.dropped == 7
+  removeFile(blocked & "2")
+  assert w.flush() == 3
+  assert existsFile(blocked & "2" / "h9") and not existsFile(blocked & "2" / "h6")
+
+  removeDir(dir)
+  echo "Tests passed."
@@ -57,6 +57,46 @@ proc sum_sym_diff1*(xs0, xs1, xs2, xs3, xs4, xs5, xs6, xs7: seq[int], s1_n_posit
   symdiff1(xs6, xs7, buf2, s1_n_positions, s2_n_positions, max_dist)
   result = buf2.len
 
+# the number of positions at which two packed diff lists (position shl 2 or
+# base, sorted) differ, ignoring positions in the other sample's N set. A
+# position present in both with different bases is one difference. Stops
+# at max_dist + 1.
+proc packed_diff*(xs: seq[int], ys: seq[int], s1_n_positions: IntSet, s2_n_positions: IntSet, max_dist: int) : int =
+  var
+    i = 0
+    j = 0
+  while i < xs.len and j < ys.len:
+    let
+      px = xs[i] shr 2
+      py = ys[j] shr 2
+    if px < py:
+      if not s2_n_positions.contains(px):
+        inc result
+      inc i
+    elif py < px:
+      if not s1_n_positions.contains(py):
+        inc result
+      inc j
+    else:
+      if xs[i] != ys[j]:
+        inc result
+      inc i
+      inc j
+    if result > max_dist:
+      return max_dist + 1
+  while i < xs.len:
+    if not s2_n_positions.contains(xs[i] shr 2):
+      inc result
+      if result > max_dist:
+        return max_dist + 1
+    inc i
+  while j < ys.len:
+    if not s1_n_positions.contains(ys[j] shr 2):
+      inc result
+      if result > max_dist:
+        return max_dist + 1
+    inc j
+
 when isMainModule:
   var
     is1: IntSet
@@ -214,4 +254,18 @@ when isMainModule:
   sym_diff1(xs1, xs2, buf, is1, is2, 20)
   assert $buf == "@[0, 10, 3, 4]"
 
+  # packed lists: A=0, C=1, G=2, T=3
+  is1 = initIntSet()
+  is2 = initIntSet()
+  xs1 = @[1 shl 2 or 0, 2 shl 2 or 1, 5 shl 2 or 3]
+  xs2 = @[1 shl 2 or 0, 2 shl 2 or 2, 4 shl 2 or 3]
+  assert packed_diff(xs1, xs2, is1, is2, 20) == 3
+  assert packed_diff(xs1, xs2, is1, is2, 1) == 2
+  is2.incl(5)
+  assert packed_diff(xs1, xs2, is1, is2, 20) == 2
+  is1.incl(4)
+  assert packed_diff(xs1, xs2, is1, is2, 20) == 1
+  assert packed_diff(@[], xs2, initIntSet(), initIntSet(), 20) == 3
+  assert packed_diff(xs1, @[], initIntSet(), initIntSet(), 20) == 3
+
   echo "Tests passed."
@@ -0,0 +1,216 @@
+## This module contains a vantage-point tree for range queries over ids,
+## with the distance supplied by the caller.
+##
+## SNP distances ignore positions that are N in either sample, so they
+## break the triangle inequality by up to the number of Ns involved. If
+## n(x) is the number of N positions of x, then for any q, v and x
+##
+##   d(q, x) >= d(q, v) - d(v, x) - n(x)
+##   d(q, x) >= d(v, x) - d(q, v) - n(q)
+##
+## Each node records the largest n(x) in its inside subtree, which keeps
+## the search exact. In approximate mode the N terms are dropped, which
+## prunes more but can miss samples whose Ns hide differences.
+##
+## Trees are built in steps (build_step), so a server can spread the work
+## between requests. Removed ids stay in the tree as tombstones (remove):
+## they still guide the search, so the caller must keep answering their
+## distances, but aren't reported, until the tree is rebuilt without them.
+
+import algorithm
+import intsets
+
+type
+  VPNode = object
+    id: int
+    # samples within mu of the vantage point are inside, the rest outside
+    mu: int
+    max_n_inside: int
+    inside: int
+    outside: int
+
+  VPWork = object
+    parent: int
+    is_inside: bool
+    ids: seq[int]
+    # the distances from the vantage point to ids[0..<measured], so a
+    # partition can be spread over several steps
+    others: seq[(int, int)]
+    measured: int
+
+  VPTree* = ref object
+    nodes: seq[VPNode]
+    pending: seq[VPWork]
+    # ids the tree was built over, and those of them since removed
+    members: IntSet
+    removed: IntSet
+
+proc new_VPTree*(ids: seq[int]): VPTree =
+  result = VPTree(members: initIntSet(), removed: initIntSet())
+  for id in ids:
+    result.members.incl(id)
+  if ids.len > 0:
+    result.pending.add(VPWork(parent: -1, ids: ids))
+
+proc done*(t: VPTree): bool =
+  t.pending.len == 0
+
+# the number of ids in the tree, tombstones included
+proc len*(t: VPTree): int =
+  t.members.len
+
+# true if id is in the tree and not removed
+proc contains*(t: VPTree, id: int): bool =
+  id in t.members and id notin t.removed
+
+# marks id as removed: searches no longer report it
+proc remove*(t: VPTree, id: int) =
+  if id in t.members:
+    t.removed.incl(id)
+
+# the ids removed since the tree was built
+proc removed*(t: VPTree): IntSet =
+  t.removed
+
+# builds nodes until about budget distances have been computed or the tree
+# is complete, stopping part way through a partition if need be. Returns
+# true when the tree is complete.
+proc build_step*(t: VPTree, distance: proc (a: int, b: int): int, n_count: proc (id: int): int, budget: int): bool =
+  var spent = 0
+  while t.pending.len > 0 and spent < budget:
+    # the middle id as vantage point keeps builds deterministic
+    let v = t.pending[^1].ids[t.pending[^1].ids.len div 2]
+    while t.pending[^1].measured < t.pending[^1].ids.len and spent < budget:
+      let id = t.pending[^1].ids[t.pending[^1].measured]
+      if id != v:
+        t.pending[^1].others.add((distance(v, id), id))
+        inc spent
+      inc t.pending[^1].measured
+    if t.pending[^1].measured < t.pending[^1].ids.len:
+      break
+    let
+      work = t.pending.pop()
+      others = work.others
+    var node = VPNode(id: v, inside: -1, outside: -1)
+    if others.len > 0:
+      var ds: seq[int]
+      for (d, _) in others:
+        ds.add(d)
+      ds.sort()
+      node.mu = ds[(ds.len - 1) div 2]
+    let node_index = t.nodes.len
+    var inside, outside: seq[int]
+    for (d, id) in others:
+      if d <= node.mu:
+        inside.add(id)
+        node.max_n_inside = max(node.max_n_inside, n_count(id))
+      else:
+        outside.add(id)
+    t.nodes.add(node)
+    if work.parent >= 0:
+      if work.is_inside:
+        t.nodes[work.parent].inside = node_index
+      else:
+        t.nodes[work.parent].outside = node_index
+    if inside.len > 0:
+      t.pending.add(VPWork(parent: node_index, is_inside: true, ids: inside))
+    if outside.len > 0:
+      t.pending.add(VPWork(parent: node_index, is_inside: false, ids: outside))
+  return t.done
+
+# calls visit(id, d) for every id within radius of the query. distance(id,
+# max_distance) is the distance from the query to id, or any value above
+# max_distance if it is further; a negative value stops the search.
+# n_query is the number of N positions of the query.
+proc search*(t: VPTree, distance: proc (id: int, max_distance: int): int, n_query: int, radius: int, approximate: bool, visit: proc (id: int, d: int)) =
+  if t.nodes.len == 0:
+    return
+  let n_query = if approximate: 0 else: n_query
+  var stack = @[0]
+  while stack.len > 0:
+    let
+      node = t.nodes[stack.pop()]
+      max_n = if approximate: 0 else: node.max_n_inside
+      # beyond this the inside subtree is pruned whatever the distance is
+      d = distance(node.id, radius + node.mu + max_n + 1)
+    if d < 0:
+      return
+    if d <= radius and node.id notin t.removed:
+      visit(node.id, d)
+    if node.inside >= 0 and d - node.mu - max_n <= radius:
+      stack.add(node.inside)
+    if node.outside >= 0 and node.mu + 1 - d - n_query <= radius:
+      stack.add(node.outside)
+
+when isMainModule:
+  import random
+
+  var
+    rng = initRand(1)
+    points: seq[int]
+  for i in 0..<500:
+    points.add(rng.rand(1000))
+
+  proc point_distance(a: int, b: int): int = abs(points[a] - points[b])
+  proc no_ns(id: int): int = 0
+
+  var ids: seq[int]
+  for i in 0..<points.len:
+    ids.add(i)
+  let t = new_VPTree(ids)
+  var
+    steps = 0
+    computed = 0
+  proc counted_distance(a: int, b: int): int =
+    inc computed
+    point_distance(a, b)
+  while true:
+    computed = 0
+    let done = t.build_step(counted_distance, no_ns, 100)
+    # steps stop at the budget, even part way through the root
+    assert computed <= 100
+    if done:
+      break
+    inc steps
+  assert steps > 5
+  assert t.len == points.len
+
+  for q in [0, 17, 250, 999]:
+    for radius in [0, 3, 40, 2000]:
+      var found: seq[int]
+      var computed = 0
+      t.search(proc (id: int, max_distance: int): int =
+                 inc computed
+                 abs(points[id] - q),
+               0, radius, false,
+               proc (id: int, d: int) = found.add(id))
+      var expected: seq[int]
+      for i, p in points:
+        if abs(p - q) <= radius:
+          expected.add(i)
+      assert found.sorted == expected
+      if radius == 0:
+        assert computed < points.len
+
+  # a negative distance stops the search
+  var visited = 0
+  t.search(proc (id: int, max_distance: int): int = -1, 0, 10, false,
+           proc (id: int, d: int) = inc visited)
+  assert visited == 0
+
+  # removed ids are no longer reported, but the rest still are
+  for id in 0..<250:
+    t.remove(id)
+  assert 0 notin t and 300 in t
+  for q in [17, 250, 999]:
+    var found: seq[int]
+    t.search(proc (id: int, max_distance: int): int = abs(points[id] - q),
+             0, 40, false,
+             proc (id: int, d: int) = found.add(id))
+    var expected: seq[int]
+    for i, p in points:
+      if i >= 250 and abs(p - q) <= 40:
+        expected.add(i)
+    assert found.sorted == expected
+
+  echo "Tests passed."
@@ -0,0 +1,59 @@
+""" runs unittest for pycw_async_client
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+
+
+"""
+
+import asyncio
+import unittest
+from pyclient.pycw_client import CatWalk
+from pyclient.pycw_async_client import AsyncCatWalk
+
+# unit tests
+class test_async_cw(unittest.IsolatedAsyncioTestCase):
+    """starts a server with the synchronous client, and talks to it with AsyncCatWalk
+
+    Note: requires CW_BINARY_FILEPATH environment variable to point to the catwalk binary."""
+
+    def setUp(self):
+        self.cw = CatWalk(
+            cw_binary_filepath=None,
+            reference_name="H37RV",
+            reference_filepath="reference/TB-ref.fasta",
+            mask_filepath="reference/TB-exclude-adaptive.txt",
+            max_n_positions=130000,
+            bind_host="localhost",
+            bind_port=5999,
+            unittesting=True,
+        )
+
+    def tearDown(self):
+        self.cw.stop()
+
+    async def test_operations(self):
+        payload1 = {"A": [100000, 100001, 100002], "G": [], "T": [], "C": [], "N": []}
+        payload2 = {"A": [100003, 100004, 100005], "G": [], "T": [], "C": [], "N": []}
+
+        async with AsyncCatWalk(self.cw.cw_url, max_concurrency=10) as acw:
+            self.assertIsInstance(await acw.info(), dict)
+            self.assertEqual(await acw.add_sample_from_refcomp("guid1", payload1), 201)
+            self.assertEqual(await acw.add_sample_from_refcomp("guid2", payload2), 201)
+            self.assertEqual(await acw.add_sample_from_refcomp("guid2", payload2), 200)
+            self.assertEqual(set(await acw.sample_names()), set(["guid1", "guid2"]))
+
+            results = await asyncio.gather(*[acw.neighbours("guid1", 6) for _ in range(200)])
+            self.assertEqual(results, [[("guid2", 6)]] * 200)
+            self.assertEqual(await acw.nearest("guid1", 5), [("guid2", 6)])
+            self.assertEqual(await acw.neighbour_histogram("guid1", 6), [0, 0, 0, 0, 0, 0, 1])
+
+            self.assertEqual(
+                await acw.pairwise_distances(["guid1", "guid2"]), [["guid1", "guid2", "6"]]
+            )
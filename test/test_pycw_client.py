@@ -12,14 +12,22 @@ by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and
 
 """
 
+import json
+import os
+import shutil
+import time
 import unittest
 import requests
-from pyclient.pycw_client import CatWalk
+from pyclient.pycw_client import CatWalk, CatWalkIncompleteResultError
+from pyclient.cw_export import CatWalkExport
 
 # unit tests
 class test_cw(unittest.TestCase):
     """starts server, and shuts it down"""
 
+    # more command line arguments for the server
+    server_args = []
+
     def setUp(self):
         """cw_binary_filepath must point to the catwalk server and mask & reference files to the relevant data files.
         Shuts down **any catwalk server** running initially.
@@ -33,6 +41,7 @@ class test_cw(unittest.TestCase):
             max_n_positions=130000,
             bind_host="localhost",
             bind_port=5999,
+            server_args=self.server_args,
         )
 
         # stop the server if it is running
@@ -254,3 +263,446 @@ class test_cw_6(test_cw):
         ]
 
         self.assertEqual(distmat, expected)
+
+        names, matrix = self.cw.pairwise_distance_matrix(["guid1", "guid2", "guid3"])
+        self.assertEqual(names, ["guid1", "guid2", "guid3"])
+        self.assertEqual(matrix.tolist(), [[0, 2, 2], [2, 0, 4], [2, 4, 0]])
+
+        df = self.cw.pairwise_distance_matrix(["guid3", "guid1"], as_dataframe=True)
+        self.assertEqual(df.loc["guid1", "guid3"], 2)
+
+
+class test_cw_7(test_cw):
+    """tests the client can be shared across threads"""
+
+    def runTest(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        payload = {"A": [1000], "G": [], "T": [], "C": [], "N": []}
+        self.cw.add_sample_from_refcomp("guid1", payload)
+        self.cw.add_sample_from_refcomp("guid2", payload)
+
+        with ThreadPoolExecutor(8) as pool:
+            results = list(pool.map(lambda _: self.cw.neighbours("guid1", 5), range(200)))
+        self.assertEqual(results, [[("guid2", 0)]] * 200)
+
+
+class test_cw_8(test_cw):
+    """tests the store generation and the client neighbour cache"""
+
+    def runTest(self):
+        cached = CatWalk(
+            cw_binary_filepath=None,
+            reference_name="H37RV",
+            reference_filepath="reference/TB-ref.fasta",
+            mask_filepath="reference/TB-exclude-adaptive.txt",
+            max_n_positions=130000,
+            bind_host="localhost",
+            bind_port=5999,
+            neighbour_cache_size=10,
+        )
+        payload = {"A": [1000], "G": [], "T": [], "C": [], "N": []}
+        generation = self.cw.info()["generation"]
+        self.cw.add_sample_from_refcomp("guid1", payload)
+        self.cw.add_sample_from_refcomp("guid2", payload)
+        self.assertEqual(self.cw.info()["generation"], generation + 2)
+
+        self.assertEqual(cached.neighbours("guid1", 5), [("guid2", 0)])
+        self.assertEqual(cached.neighbours("guid1", 5), [("guid2", 0)])     # cached
+
+        self.cw.add_sample_from_refcomp("guid3", payload)     # insert through another client
+        cached.neighbour_cache_ttl = 0     # always revalidate
+        self.assertEqual(set(cached.neighbours("guid1", 5)), set([("guid2", 0), ("guid3", 0)]))
+
+        self.cw.remove_sample("guid3")
+        self.assertEqual(cached.neighbours("guid1", 5), [("guid2", 0)])
+
+
+class test_cw_9(test_cw):
+    """tests fetching refcomps and querying by refcomp"""
+
+    def runTest(self):
+        payload = {"A": [1000], "G": [], "T": [], "C": [], "N": []}
+        self.cw.add_sample_from_refcomp("guid1", payload)
+        self.cw.add_sample_from_refcomp("guid2", {"A": [1000, 1001], "G": [], "T": [], "C": [], "N": []})
+
+        refcomp = self.cw.sample_refcomp("guid1")
+        self.assertEqual(refcomp["A"], [1000])
+        self.assertEqual(refcomp["status"], "Ok")
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.cw.sample_refcomp("missing")
+
+        self.assertEqual(self.cw.neighbours_from_refcomp("guid1", payload, 5), [("guid2", 1)])
+        self.assertEqual(
+            set(self.cw.neighbours_from_refcomp("other", payload, 5)), set([("guid1", 0), ("guid2", 1)])
+        )
+        self.assertEqual(self.cw.sample_names(), ["guid1", "guid2"])     # nothing was stored
+
+
+class test_cw_10(test_cw):
+    """tests cross-set distances and the tiled matrix fetcher"""
+
+    def runTest(self):
+        names = ["guid{0}".format(i) for i in range(7)]
+        for i, name in enumerate(names):
+            self.cw.add_sample_from_refcomp(name, {"A": [1000 + i], "G": [], "T": [], "C": [], "N": []})
+
+        block = self.cw.cross_distances(names[:2], names[2:])
+        self.assertEqual(block.shape, (2, 5))
+        self.assertTrue((block == 2).all())
+        self.assertTrue((self.cw.cross_distances(names[:2], names[2:], cutoff=1) == 2).all())
+        self.assertTrue((self.cw.cross_distances(names[2:], names[:2], cutoff=5) == 2).all())
+
+        self.cw.add_sample_from_refcomp("twin", {"A": [1000], "G": [], "T": [], "C": [], "N": []})
+        sparse = self.cw.cross_distances(["twin", "guid1"], names, cutoff=0, sparse=True)
+        self.assertEqual(sparse.tolist(), [[0, 0, 0]])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.cw.cross_distances(["missing"], names)
+
+        expected_names, expected = self.cw.pairwise_distance_matrix(names)
+        for tile_size in (1, 3, 7, 100):
+            tiled_names, tiled = self.cw.pairwise_distance_matrix_tiled(names, tile_size=tile_size, max_workers=3)
+            self.assertEqual(tiled_names, expected_names)
+            self.assertTrue((tiled == expected).all())
+
+
+class test_cw_11(test_cw):
+    """tests the k nearest neighbours query"""
+
+    def runTest(self):
+        self.cw.add_sample_from_refcomp("guid0", {"A": [1000], "G": [], "T": [], "C": [], "N": []})
+        for i in range(1, 6):
+            self.cw.add_sample_from_refcomp(
+                "guid{0}".format(i), {"A": [1000 + j for j in range(i + 1)], "G": [], "T": [], "C": [], "N": []}
+            )
+
+        self.assertEqual(self.cw.nearest("guid0", 1), [("guid1", 1)])
+        self.assertEqual(self.cw.nearest("guid0", 3), [("guid1", 1), ("guid2", 2), ("guid3", 3)])
+        self.assertEqual(len(self.cw.nearest("guid0", 100)), 5)
+        self.assertEqual(self.cw.nearest("guid3", 2), [("guid2", 1), ("guid4", 1)])
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.cw.nearest("missing", 1)
+
+        self.assertEqual(self.cw.neighbour_histogram("guid0", 3), [0, 1, 1, 1])
+        self.assertEqual(self.cw.neighbour_histogram("guid3", 1, names=True), [[], ["guid2", "guid4"]])
+
+
+class test_cw_12(test_cw):
+    """tests per-request deadlines"""
+
+    def runTest(self):
+        for i in range(3000):
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), {"A": [1000 + i], "G": [], "T": [], "C": [], "N": []})
+
+        r = requests.get(self.cw.cw_url + "/neighbours/guid0/5", params={"deadline": 60})
+        self.assertEqual(r.status_code, 200)
+        self.assertNotIn("X-Catwalk-Complete", r.headers)
+        self.assertEqual(len(r.json()), 2999)
+
+        r = requests.get(self.cw.cw_url + "/neighbours/guid0/5", params={"deadline": 1e-9})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers["X-Catwalk-Complete"], "false")
+        self.assertNotIn("ETag", r.headers)
+        self.assertLess(len(r.json()), 2999)
+
+        r = requests.get(self.cw.cw_url + "/neighbours/guid0/5", params={"deadline": 1e-9, "partial": 0})
+        self.assertEqual(r.status_code, 503)
+
+        for bad in ["soon", "0", "-1", "nan", "inf"]:
+            r = requests.get(self.cw.cw_url + "/neighbours/guid0/5", params={"deadline": bad})
+            self.assertEqual(r.status_code, 400)
+            r = requests.get(self.cw.cw_url + "/neighbours/guid0/5", headers={"X-Catwalk-Deadline": bad})
+            self.assertEqual(r.status_code, 400)
+
+        r = requests.post(
+            self.cw.cw_url + "/get_pairwise_distances_condensed",
+            json=["guid{0}".format(i) for i in range(100)],
+            headers={"X-Catwalk-Deadline": "1e-9"},
+        )
+        self.assertEqual(r.headers["X-Catwalk-Complete"], "false")
+        self.assertEqual(len(r.content), 4 * 100 * 99 // 2)
+
+        hasty = CatWalk(
+            cw_binary_filepath=None,
+            reference_name="H37RV",
+            reference_filepath="reference/TB-ref.fasta",
+            mask_filepath="reference/TB-exclude-adaptive.txt",
+            max_n_positions=130000,
+            bind_host="localhost",
+            bind_port=5999,
+            deadline=1e-9,
+        )
+        with self.assertRaises(CatWalkIncompleteResultError):
+            hasty.neighbours("guid0", 5)
+        hasty.allow_partial = True
+        self.assertLess(len(hasty.neighbours("guid0", 5)), 2999)
+
+
+class test_cw_13(test_cw):
+    """tests samples with identical profiles are stored once"""
+
+    def runTest(self):
+        payload = {"A": [1000], "G": [], "T": [], "C": [], "N": [2000]}
+        for name in ["guid1", "guid2", "guid3"]:
+            self.cw.add_sample_from_refcomp(name, payload)
+        self.cw.add_sample_from_refcomp("guid4", {"A": [1001], "G": [], "T": [], "C": [], "N": []})
+
+        info = self.cw.info()
+        self.assertEqual(info["n_samples"], 4)
+        self.assertEqual(info["n_profiles"], 2)
+        self.assertEqual(sorted(self.cw.neighbours("guid1", 5)), [("guid2", 0), ("guid3", 0), ("guid4", 2)])
+
+        self.cw.remove_sample("guid1")
+        self.assertEqual(sorted(self.cw.neighbours("guid2", 5)), [("guid3", 0), ("guid4", 2)])
+        self.assertEqual(self.cw.info()["n_profiles"], 2)
+
+
+class test_cw_14(test_cw):
+    """tests neighbour queries through the index give the same results as a scan"""
+
+    def runTest(self):
+        import random
+
+        rng = random.Random(1)
+        for i in range(300):
+            refcomp = {base: [] for base in "ACGTN"}
+            for position in range(1000, 1030):
+                x = rng.random()
+                if x < 0.15:
+                    refcomp["A"].append(position)
+                elif x < 0.2:
+                    refcomp["N"].append(position)
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), refcomp)
+
+        names = ["guid{0}".format(i) for i in range(0, 300, 15)]
+        scanned = {name: sorted(self.cw.neighbours(name, 4)) for name in names}
+        self.assertEqual(self.cw.build_index(), self.cw.info()["n_profiles"])
+        self.assertEqual(self.cw.info()["index"]["backlog"], 0)
+        for name in names:
+            self.assertEqual(sorted(self.cw.neighbours(name, 4)), scanned[name])
+
+
+class test_cw_15(test_cw):
+    """tests rereferencing keeps neighbours and refcomps unchanged"""
+
+    def runTest(self):
+        lineage = list(range(2000, 2100, 10))
+        refcomps = {}
+        for i in range(20):
+            refcomp = {"A": list(lineage), "C": [2001 + i], "G": [], "T": [], "N": [3000]}
+            if i % 5 == 0:
+                refcomp = {"A": [], "C": [2002 + i], "G": [], "T": [], "N": []}
+            refcomps["guid{0}".format(i)] = refcomp
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), refcomp)
+
+        before = {name: sorted(self.cw.neighbours(name, 15)) for name in refcomps}
+        n_rebased = self.cw.rereference()
+        self.assertEqual(self.cw.info()["rebased_positions"], n_rebased)
+        for name, refcomp in refcomps.items():
+            self.assertEqual(sorted(self.cw.neighbours(name, 15)), before[name])
+            stored = self.cw.sample_refcomp(name)
+            for base in "ACGTN":
+                self.assertEqual(sorted(stored[base]), sorted(refcomp[base]))
+
+
+class test_cw_16(test_cw):
+    """tests the instance prefixed routes and the metrics"""
+
+    def runTest(self):
+        self.cw.add_sample_from_refcomp("guid1", {"A": [100], "C": [], "G": [], "T": [], "N": []})
+        prefix = "{0}/i/{1}".format(self.cw.cw_url, self.cw.instance_name)
+
+        r = requests.get(prefix + "/info")
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()["n_samples"], 1)
+        self.assertEqual(requests.get(prefix + "/list_samples").json(), ["guid1"])
+        self.assertEqual(requests.get("{0}/i/no_such_instance/info".format(self.cw.cw_url)).status_code, 404)
+
+        metrics = requests.get(self.cw.cw_url + "/metrics").text
+        self.assertIn('catwalk_samples{{instance="{0}"}} 1'.format(self.cw.instance_name), metrics)
+
+
+class test_cw_17(test_cw):
+    """tests the routes followers copy a store through"""
+
+    def runTest(self):
+        # mutations are only logged once a follower has started copying
+        self.cw.add_sample_from_refcomp("unlogged", {"A": [99], "C": [], "G": [], "T": [], "N": []})
+        r = requests.get(self.cw.cw_url + "/mutations", params={"since": 0})
+        self.assertEqual(r.status_code, 410)
+        self.cw.remove_sample("unlogged")
+        requests.get(self.cw.cw_url + "/refcomps")
+
+        for i in range(3):
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), {"A": [100 + i], "C": [], "G": [], "T": [], "N": []})
+        self.cw.remove_sample("guid1")
+
+        r = requests.get(self.cw.cw_url + "/refcomps", params={"after": -1, "limit": 1}).json()
+        self.assertEqual([s["name"] for s in r["samples"]], ["guid0"])
+        self.assertEqual(r["samples"][0]["A"], [100])
+        r = requests.get(self.cw.cw_url + "/refcomps", params={"after": r["last"]}).json()
+        self.assertEqual([s["name"] for s in r["samples"]], ["guid2"])
+
+        generation = r["generation"]
+        r = requests.get(self.cw.cw_url + "/mutations", params={"since": generation - 2}).json()
+        self.assertEqual([(m["op"], m["name"]) for m in r["mutations"]], [("add", "guid2"), ("remove", "guid1")])
+        self.assertEqual(r["mutations"][0]["A"], [102])
+        self.assertEqual(requests.get(self.cw.cw_url + "/mutations", params={"since": generation}).json()["mutations"], [])
+        self.assertIsNone(self.cw.info()["follow"])
+
+
+class test_cw_18(test_cw):
+    """tests exporting the store and loading the export"""
+
+    def runTest(self):
+        refcomps = {
+            "guid1": {"A": [100, 200], "C": [], "G": [5], "T": [], "N": [300, 7]},
+            "guid2": {"A": [], "C": [50], "G": [], "T": [60], "N": []},
+        }
+        for name, refcomp in refcomps.items():
+            self.cw.add_sample_from_refcomp(name, refcomp)
+        # the server runs in this directory, and exports only below it
+        path = "test_cw_18_export"
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        self.assertEqual(self.cw.export(path)["n_samples"], 2)
+        ex = CatWalkExport(path)
+        self.assertEqual(ex.names, ["guid1", "guid2"])
+        self.assertEqual(ex.status_name(ex.index("guid2")), "Ok")
+        for name, refcomp in refcomps.items():
+            stored = ex.refcomp(ex.index(name))
+            for base in "ACGTN":
+                self.assertEqual(stored[base], sorted(refcomp[base]))
+        self.assertEqual(ex.counts("A").tolist(), [2, 0])
+
+        # exporting again replaces the export
+        self.cw.remove_sample("guid1")
+        self.assertEqual(self.cw.export(path)["n_samples"], 1)
+        self.assertEqual(CatWalkExport(path).names, ["guid2"])
+
+        for bad_path in [os.path.abspath("elsewhere"), "../elsewhere", "reference"]:
+            r = requests.post(self.cw.cw_url + "/export", json={"path": bad_path})
+            self.assertEqual(r.status_code, 400)
+
+
+class test_cw_19(test_cw):
+    """tests samples added just before the server is stopped are saved and loaded on restart"""
+
+    def runTest(self):
+        if not self.cw.info()["saves_samples"]:
+            self.skipTest("cw_server was built with -d:no_serialisation")
+        with open("reference/TB-ref.fasta") as f:
+            reference = "".join(line.strip() for line in f if not line.startswith(">"))
+        names = ["guid{0}".format(i) for i in range(5)]
+        for i, name in enumerate(names):
+            position = 1000 + i
+            base = "C" if reference[position] == "A" else "A"
+            sequence = reference[:position] + base + reference[position + 1 :]
+            r = requests.post(self.cw.cw_url + "/add_sample", json={"name": name, "sequence": sequence, "keep": True})
+            self.assertEqual(r.status_code, 201)
+
+        self.cw.stop()
+        self.cw.start()
+        self.assertEqual(sorted(self.cw.sample_names()), names)
+        self.cw.stop()
+        shutil.rmtree(self.cw.instance_name, ignore_errors=True)
+
+
+class test_cw_20(test_cw):
+    """tests reads are answered while readers are replaced, and writes to readers are redirected"""
+
+    server_args = ["--readers", "2", "--writer_port", "6000", "--publish_interval", "0.2"]
+
+    def runTest(self):
+        info = self.cw.info()
+        self.assertEqual(info["readers"], 2)
+        self.assertTrue(info["is_reader"])
+
+        # a write to a reader is redirected to the writer
+        payload = {"name": "guid0", "refcomp": json.dumps({"A": [1000], "C": [], "G": [], "T": [], "N": []}), "keep": True}
+        r = requests.post(self.cw.cw_url + "/add_sample_from_refcomp", json=payload, allow_redirects=False)
+        self.assertEqual(r.status_code, 307)
+        self.assertTrue(r.headers["Location"].endswith(":6000/add_sample_from_refcomp"))
+        self.cw.add_sample_from_refcomp("guid0", {"A": [1000], "C": [], "G": [], "T": [], "N": []})
+
+        # every insert is followed by a publish; reads keep succeeding throughout, and
+        # see each insert once it is published
+        session = requests.Session()
+        for i in range(1, 20):
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), {"A": [1000 + i], "C": [], "G": [], "T": [], "N": []})
+            r = session.get(self.cw.cw_url + "/list_samples")
+            self.assertEqual(r.status_code, 200)
+            time.sleep(0.05)
+        deadline = time.monotonic() + 10
+        while len(requests.get(self.cw.cw_url + "/list_samples").json()) < 20:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.1)
+
+
+class test_cw_21(test_cw):
+    """tests a follower converges on its primary's adds and removes, and redirects writes to it"""
+
+    def runTest(self):
+        self.cw.add_sample_from_refcomp("guid0", {"A": [1000], "C": [], "G": [], "T": [], "N": []})
+        follower = CatWalk(
+            cw_binary_filepath=None,
+            reference_name="H37RV",
+            reference_filepath="reference/TB-ref.fasta",
+            mask_filepath="reference/TB-exclude-adaptive.txt",
+            max_n_positions=130000,
+            bind_host="localhost",
+            bind_port=5998,
+            server_args=["--follow", self.cw.cw_url, "--follow_interval", "0.1"],
+        )
+        follower.stop()
+        follower.start()
+        self.addCleanup(follower.stop)
+
+        def converge():
+            deadline = time.monotonic() + 10
+            while sorted(follower.sample_names()) != sorted(self.cw.sample_names()):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.1)
+
+        converge()
+        for i in range(1, 10):
+            self.cw.add_sample_from_refcomp("guid{0}".format(i), {"A": [1000 + i], "C": [], "G": [], "T": [], "N": []})
+        for i in range(0, 10, 3):
+            self.cw.remove_sample("guid{0}".format(i))
+        converge()
+        self.assertEqual(follower.sample_refcomp("guid1")["A"], [1001])
+        self.assertEqual(sorted(follower.neighbours("guid1", 2)), sorted(self.cw.neighbours("guid1", 2)))
+
+        follow = follower.info()["follow"]
+        self.assertEqual(follow["generation"], follow["primary_generation"])
+        self.assertLess(follow["lag_seconds"], 10)
+
+        # writes to the follower are redirected to the primary
+        payload = {"name": "guid10", "refcomp": json.dumps({"A": [1010], "C": [], "G": [], "T": [], "N": []}), "keep": True}
+        r = requests.post(follower.cw_url + "/add_sample_from_refcomp", json=payload, allow_redirects=False)
+        self.assertEqual(r.status_code, 307)
+        self.assertTrue(r.headers["Location"].startswith(self.cw.cw_url))
+
+
+class test_cw_22(test_cw):
+    """tests refcomps with positions outside the reference are rejected"""
+
+    def runTest(self):
+        reference_length = self.cw.info()["reference_sequence_length"]
+        for positions in [[-1], [reference_length]]:
+            refcomp = json.dumps({"A": positions, "C": [], "G": [], "T": [], "N": []})
+            r = requests.post(self.cw.cw_url + "/add_sample_from_refcomp", json={"name": "bad", "refcomp": refcomp})
+            self.assertEqual(r.status_code, 400)
+            r = requests.post(self.cw.cw_url + "/neighbours_from_refcomp", json={"name": "bad", "refcomp": refcomp, "distance": 5})
+            self.assertEqual(r.status_code, 400)
+        self.assertEqual(self.cw.sample_names(), [])
+
+
+class test_cw_23(test_cw):
+    """tests /memory rejects an n that isn't a non-negative integer"""
+
+    def runTest(self):
+        for n in ["many", "1.5", "-1"]:
+            r = requests.get(self.cw.cw_url + "/memory", params={"n": n})
+            self.assertEqual(r.status_code, 400)
+        r = requests.get(self.cw.cw_url + "/memory", params={"n": 10})
+        self.assertEqual(r.status_code, 200)
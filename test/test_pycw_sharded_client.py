@@ -0,0 +1,67 @@
+""" runs unittest for pycw_sharded_client
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+Note: requires CW_BINARY_FILEPATH environment variable to point to the catwalk binary.
+"""
+
+import unittest
+from pyclient.pycw_client import CatWalk
+from pyclient.pycw_sharded_client import ShardedCatWalk, shard_index
+
+
+class test_shard_index(unittest.TestCase):
+    """tests placement is stable and uses every shard"""
+
+    def runTest(self):
+        self.assertEqual(shard_index("guid1", 3), shard_index("guid1", 3))
+        self.assertEqual(set(shard_index("guid{0}".format(i), 3) for i in range(100)), set([0, 1, 2]))
+
+
+class test_sharded_cw(unittest.TestCase):
+    """starts two servers, and shuts them down"""
+
+    def setUp(self):
+        self.shards = [
+            CatWalk(
+                cw_binary_filepath=None,
+                reference_name="H37RV",
+                reference_filepath="reference/TB-ref.fasta",
+                mask_filepath="reference/TB-exclude-adaptive.txt",
+                max_n_positions=130000,
+                bind_host="localhost",
+                bind_port=port,
+            )
+            for port in (5997, 5998)
+        ]
+        for shard in self.shards:
+            shard.stop()
+            shard.start()
+        self.cw = ShardedCatWalk(self.shards)
+
+    def tearDown(self):
+        self.cw.close()
+        for shard in self.shards:
+            shard.stop()
+
+    def runTest(self):
+        names = ["guid{0}".format(i) for i in range(10)]
+        for i, name in enumerate(names):
+            self.cw.add_sample_from_refcomp(name, {"A": [1000 + i], "G": [], "T": [], "C": [], "N": []})
+
+        self.assertEqual(sorted(self.cw.sample_names()), sorted(names))
+        self.assertTrue(all(len(shard.sample_names()) < len(names) for shard in self.shards))
+
+        # every other sample differs from guid0 at two positions, wherever it is stored
+        self.assertEqual(self.cw.neighbours("guid0", 5), [(name, 2) for name in names[1:]])
+        self.assertEqual(self.cw.neighbours("guid0", 1), [])
+
+        self.cw.remove_sample("guid1")
+        self.assertNotIn("guid1", self.cw.sample_names())
+        self.assertEqual(len(self.cw.info()), 2)
@@ -0,0 +1,97 @@
+""" runs unittest for refcompress
+
+A component of the findNeighbour4 system for bacterial relatedness monitoring
+Copyright (C) 2021 David Wyllie david.wyllie@phe.gov.uk
+repo: https://github.com/davidhwyllie/findNeighbour4
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the MIT License as published
+by the Free Software Foundation.  See <https://opensource.org/licenses/MIT>, and the LICENSE file.
+
+
+
+"""
+
+import os
+import random
+import tempfile
+import unittest
+from pyclient.refcompress import ReferenceCompressor
+
+
+def slow_compress(sequence, reference, mask):
+    """the per-position loop of reference_compress in catwalk.nim"""
+    refcomp = {"A": [], "C": [], "G": [], "T": [], "N": []}
+    for i, (s, r) in enumerate(zip(sequence, reference.upper())):
+        if i in mask:
+            continue
+        s_upper = s.upper() if s in "acgt" else s
+        if s_upper != r:
+            refcomp[s_upper if s_upper in "ACGT" else "N"].append(i)
+    return refcomp
+
+
+class test_refcompress(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        random.seed(1)
+        self.reference = "".join(random.choice("ACGTacgt") for _ in range(1000))
+        self.mask = set(range(0, 1000, 7))
+        self.reference_filepath = os.path.join(self.tmpdir.name, "ref.fasta")
+        self.mask_filepath = os.path.join(self.tmpdir.name, "mask.txt")
+        with open(self.reference_filepath, "w") as f:
+            f.write(">ref\n")
+            for i in range(0, 1000, 60):
+                f.write(self.reference[i : i + 60] + "\n")
+        with open(self.mask_filepath, "w") as f:
+            f.write("\n".join(map(str, sorted(self.mask))) + "\n")
+        self.rc = ReferenceCompressor(self.reference_filepath, self.mask_filepath)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def mutate(self):
+        seq = list(self.reference)
+        for i in random.sample(range(1000), 100):
+            seq[i] = random.choice("ACGTacgtN-RY")
+        return "".join(seq)
+
+    def test_matches_reference_compress(self):
+        for _ in range(20):
+            seq = self.mutate()
+            refcomp = self.rc.compress(seq)
+            self.assertEqual(
+                {k: v.tolist() for k, v in refcomp.items()},
+                slow_compress(seq, self.reference, self.mask),
+            )
+
+    def test_identical(self):
+        refcomp = self.rc.compress(self.reference.upper())
+        self.assertEqual(sum(len(v) for v in refcomp.values()), 0)
+
+    def test_invalid_length(self):
+        with self.assertRaises(ValueError):
+            self.rc.compress("ACGT")
+
+    def test_multifasta(self):
+        seqs = [self.mutate() for _ in range(5)]
+        filepath = os.path.join(self.tmpdir.name, "samples.fasta")
+        with open(filepath, "w") as f:
+            for i, seq in enumerate(seqs):
+                f.write(">sample/{0}\n{1}\n".format(i, seq))
+        for processes in [1, 2]:
+            results = list(self.rc.compress_multifasta(filepath, processes=processes))
+            self.assertEqual([name for name, _ in results], ["sample_{0}".format(i) for i in range(5)])
+            for (_, refcomp), seq in zip(results, seqs):
+                self.assertEqual(
+                    {k: v.tolist() for k, v in refcomp.items()},
+                    slow_compress(seq, self.reference, self.mask),
+                )
+
+    def test_mask_skips_non_integer_lines(self):
+        filepath = os.path.join(self.tmpdir.name, "commented_mask.txt")
+        with open(filepath, "w") as f:
+            f.write("position\n\n# excluded\n")
+            f.write("\n".join(map(str, sorted(self.mask))) + "\n\n")
+        rc = ReferenceCompressor(self.reference_filepath, filepath)
+        self.assertEqual(rc.unmasked.tolist(), self.rc.unmasked.tolist())